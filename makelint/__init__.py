@@ -1,268 +1,777 @@
 # -*- coding: utf-8 -*-
-import collections
 import hashlib
 import logging
-import json
+import mmap
 import os
-import fcntl
 import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent import futures
+
+from makelint import depindex
+from makelint import depmap
+from makelint import fingerprints
+from makelint import fsmemo
+from makelint import gitindex
+from makelint import manifest
+from makelint import statcache
+
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
 
 VERSION = "0.1.0"
 DEPENDENCY_SUFFIX = ".dep"
-MANIFEST_FILENAME = "manifest.txt"
 SUCCESS_STAMP = ".success"
 FAIL_STAMP = ".fail"
 
+# Files at least this large are memory-mapped for hashing. Smaller files are
+# read with readinto() into a per-thread buffer of DIGEST_BUFFER_SIZE.
+DIGEST_MMAP_THRESHOLD = 1024 * 1024
+DIGEST_BUFFER_SIZE = 64 * 1024
+DIGEST_THREAD_STATE = threading.local()
+
+# Number of digest files to accumulate before writing them out
+DIGEST_BATCH_SIZE = 256
+
+DEFAULT_DIGEST_ALGORITHM = "sha1"
+
+# Stores the name of the digest algorithm used for the target tree
+DIGEST_ALGORITHM_FILENAME = "digest_algorithm"
+
+# Stores the version of the dependency map format used in the target tree
+DEPMAP_FORMAT_FILENAME = "depmap_format"
+
 logger = logging.getLogger()
 
 
-def waitforsize(pidset, njobs):
+def waitforsize(pidset, njobs, on_exit=None):
   """
-  Given a set() of pids, wait until it has at most njobs alive children
+  Given a set() of pids, wait until it has at most njobs alive children. If
+  given, ``on_exit(pid)`` is called as each child is reaped.
   """
   output = 0
   while len(pidset) > njobs:
     pid, status = os.wait()
     pidset.remove(pid)
     output |= status
+    if on_exit is not None:
+      on_exit(pid)
   return output
 
 
-def discover_sourcetree(
-    source_tree, target_tree, exclude_patterns, include_patterns,
-    progress):
+def scan_directory(source_tree, relpath_cwd, mtime_ns, path_filter):
   """
-  The discovery step performs a filesystem walk in order to build up an index
-  of files to be checked. You can use configuration files to setup inclusion
-  and exclusion filters for the discovery process. In general, though, each
-  directory that is scanned produces a list of files to lint. If the timestamp
-  of a tracked directory changes, it is rescanned for new files, or new
-  directories.
+  List the content of a single source directory and return a
+  `DirectoryRecord` of the subdirectories and files within it that are
+  tracked, along with a dictionary mapping each tracked subdirectory name to
+  its modification time (taken from the cached `DirEntry` stat so that
+  the subdirectory doesn't need to be stat'ed again).
+  """
+  source_cwd = os.path.join(source_tree, relpath_cwd)
+  logger.debug("Scanning: %s", source_cwd)
+
+  dirents = {}
+  filenames = []
+  for dirent in os.scandir(source_cwd):
+    # NOTE(josh): match os.walk(), which lists symlinks to directories as
+    # directories but does not descend into them.
+    if dirent.is_dir():
+      if not dirent.is_symlink():
+        dirents[dirent.name] = dirent
+    else:
+      filenames.append(dirent.name)
+
+  filtered_dirnames = []
+  child_mtimes = {}
+  for dirname in sorted(dirents):
+    if path_filter.excludes(os.path.join(relpath_cwd, dirname)):
+      continue
+    filtered_dirnames.append(dirname)
+    child_mtimes[dirname] = dirents[dirname].stat().st_mtime_ns
+
+  filtered_filenames = []
+  for filename in sorted(filenames):
+    if path_filter.includes_file(os.path.join(relpath_cwd, filename)):
+      filtered_filenames.append(filename)
+
+  record = manifest.DirectoryRecord(
+      relpath_cwd, mtime_ns, filtered_dirnames, filtered_filenames)
+  return record, child_mtimes
 
-  The output of the discovery phase is a manifest file per-directory tracked.
-  The creation of this manifest depends on the modification time of the
-  directory it corresponds to and will be re-built if the directory is changed.
-  If a new subdirectory is added, the system will recursively index that new
-  directory. If a directory is removed, it will recursively purge that
-  directory from the manifest index.
+
+def visit_directory(source_tree, target_tree, index, relpath_cwd, path_filter,
+                    mtime_ns=None):
+  """
+  Return an up-to-date record for the directory at relpath_cwd, reusing the
+  record from the index if the directory is unchanged. ``mtime_ns`` is the
+  modification time of the directory, if it is already known. Returns the
+  record and a dictionary of known subdirectory modification times (see
+  `scan_directory()`).
   """
+  if mtime_ns is None:
+    mtime_ns = os.stat(os.path.join(source_tree, relpath_cwd)).st_mtime_ns
+
+  record = index.get(relpath_cwd)
+  if record is not None and index.is_fresh(record, mtime_ns):
+    # NOTE(josh): this directory has not changed since the last time that we
+    # scanned it, so we do not need to list it again.
+    return record, {}
+
+  record, child_mtimes = scan_directory(
+      source_tree, relpath_cwd, mtime_ns, path_filter)
+  target_cwd = os.path.join(target_tree, relpath_cwd)
+  if not os.path.exists(target_cwd):
+    os.makedirs(target_cwd)
+  return record, child_mtimes
 
-  if not os.path.exists(target_tree):
-    os.makedirs(target_tree)
 
+def walk_sourcetree(source_tree, target_tree, index, path_filter, progress,
+                    on_record=None):
+  """
+  Visit each tracked directory in a single-threaded depth-first walk and
+  return the list of directory records. If given, ``on_record(record)`` is
+  called with each record as soon as it is ready.
+  """
+  records = []
   ndirs = 1
   dir_idx = 0
-  for source_cwd, dirnames, filenames in os.walk(source_tree):
+  stack = [("", None)]
+  while stack:
+    relpath_cwd, mtime_ns = stack.pop()
     dir_idx += 1
     progress(dir_idx=dir_idx, ndirs=ndirs)
-    relpath_cwd = os.path.relpath(source_cwd, source_tree)
-    if relpath_cwd == ".":
-      # NOTE(josh): os.path.join("", "foo") == "foo"
-      relpath_cwd = ""
 
+    record, child_mtimes = visit_directory(
+        source_tree, target_tree, index, relpath_cwd, path_filter, mtime_ns)
+    records.append(record)
+    if on_record is not None:
+      on_record(record)
+    ndirs += len(record.dirnames)
+    # Only recurse on directories that are tracked
+    stack.extend((os.path.join(relpath_cwd, dirname), child_mtimes.get(dirname))
+                 for dirname in reversed(record.dirnames))
+  return records
+
+
+def walk_sourcetree_parallel(
+    source_tree, target_tree, index, path_filter, progress, njobs,
+    on_record=None):
+  """
+  Visit each tracked directory, fanning out the stat and scandir of
+  subdirectories across a pool of ``njobs`` threads. This helps a lot when
+  each stat is a network round trip (e.g. NFS). Return the list of directory
+  records. They are visited in arbitrary order, but the index sorts them
+  back into walk order. If given, ``on_record(record)`` is called with each
+  record as soon as it is ready.
+  """
+  records = []
+  ndirs = 1
+  dir_idx = 0
+  with futures.ThreadPoolExecutor(max_workers=njobs) as pool:
+    pending = set([pool.submit(
+        visit_directory, source_tree, target_tree, index, "", path_filter)])
+    while pending:
+      done, pending = futures.wait(
+          pending, return_when=futures.FIRST_COMPLETED)
+      for future in done:
+        record, child_mtimes = future.result()
+        dir_idx += 1
+        records.append(record)
+        if on_record is not None:
+          on_record(record)
+        ndirs += len(record.dirnames)
+        progress(dir_idx=dir_idx, ndirs=ndirs)
+        for dirname in record.dirnames:
+          pending.add(pool.submit(
+              visit_directory, source_tree, target_tree, index,
+              os.path.join(record.relpath, dirname), path_filter,
+              child_mtimes.get(dirname)))
+  return records
+
+
+def read_git_sourcetree(source_tree, target_tree, index, path_filter,
+                        progress):
+  """
+  Build the directory records from the tracked files listed in the git index
+  of the checkout containing source_tree, rather than walking the filesystem.
+  Untracked files are not indexed. If the git index is unchanged since the
+  last time it was read, the existing records are returned as-is.
+
+  Returns None if source_tree is not in a git checkout or if the index can't
+  be read.
+  """
+  index_path, prefix = gitindex.find_index(source_tree)
+  if index_path is None:
+    logger.warning("%s is not in a git checkout", source_tree)
+    return None
+
+  def get_stamp(stat):
+    return "git:{}:{}:{}:{}".format(
+        index_path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+  try:
+    if index.stamp == get_stamp(os.stat(index_path)):
+      # NOTE(josh): the git index is unchanged since the last time we read
+      # it, so the file list is the same
+      return list(index.records)
+    stat, entries = gitindex.read_index(index_path)
+  except (IOError, OSError, gitindex.UnsupportedIndex) as ex:
+    logger.warning("Can't use git index %s: %s", index_path, ex)
+    return None
+  index.set_stamp(get_stamp(stat))
+
+  if prefix:
+    prefix += "/"
+
+  # Map of directory relpath -> (dirnames, filenames) for every tracked
+  # directory. A directory is tracked if neither it nor any of its parents
+  # are excluded.
+  contents = {"": (set(), [])}
+  excluded = set()
+
+  def track_directory(relpath_dir):
+    if relpath_dir in contents:
+      return True
+    if relpath_dir in excluded:
+      return False
+    parent, dirname = os.path.split(relpath_dir)
+    if (not track_directory(parent) or path_filter.excludes(relpath_dir)):
+      excluded.add(relpath_dir)
+      return False
+    contents[parent][0].add(dirname)
+    contents[relpath_dir] = (set(), [])
+    return True
+
+  previous_path = None
+  for entry in entries:
+    if entry.path == previous_path:
+      # NOTE(josh): unmerged paths have an entry for each of stages 1-3 that
+      # they exist in (e.g. only 2 and 3 for an add/add conflict). The index
+      # is sorted by path and then stage, so keep the first.
+      continue
+    previous_path = entry.path
+    if not entry.path.startswith(prefix):
+      continue
+    mode_type = entry.mode & gitindex.MODE_TYPE_MASK
+    if mode_type == gitindex.MODE_GITLINK:
+      continue
+    relpath_file = entry.path[len(prefix):]
+    relpath_cwd, filename = os.path.split(relpath_file)
+    if not track_directory(relpath_cwd):
+      continue
+    if not path_filter.includes_file(relpath_file):
+      continue
+    if (mode_type == gitindex.MODE_SYMLINK and
+        os.path.isdir(os.path.join(source_tree, relpath_file))):
+      # NOTE(josh): match os.walk(), which lists symlinks to directories as
+      # directories but does not descend into them.
+      continue
+    contents[relpath_cwd][1].append(filename)
+
+  ndirs = len(contents)
+  records = []
+  for dir_idx, (relpath_cwd, (dirnames, filenames)) in enumerate(
+      sorted(contents.items())):
+    progress(dir_idx=dir_idx + 1, ndirs=ndirs)
     target_cwd = os.path.join(target_tree, relpath_cwd)
     if not os.path.exists(target_cwd):
       os.makedirs(target_cwd)
+    # NOTE(josh): directory modification times are not used in this mode. Zero
+    # ensures that the records are rescanned if we switch back to a walk.
+    records.append(manifest.DirectoryRecord(
+        relpath_cwd, 0, sorted(dirnames), sorted(set(filenames))))
+  return records
 
-    # NOTE(josh): is it faster to re-apply filters? or load the result
-    # from the manifest?
-    filtered_dirnames = []
-    for dirname in sorted(dirnames):
-      if dirname in (".", ".."):
-        continue
-      relpath_dir = os.path.join(relpath_cwd, dirname)
-      if any(pattern.match(relpath_dir) for pattern in exclude_patterns):
-        continue
-      filtered_dirnames.append(dirname)
 
-    # Only recurse on directories that are tracked
-    dirnames[:] = filtered_dirnames
-    ndirs += len(filtered_dirnames)
-
-    manifest_path = os.path.join(target_cwd, MANIFEST_FILENAME)
-    if (os.path.exists(manifest_path) and
-        os.path.getmtime(manifest_path) > os.path.getmtime(source_cwd)):
-      # NOTE(josh): this directory has not changed since the last time that
-      # we scanned it, so we do not need to rewrite the manifest
+def discover_sourcetree(source_tree, target_tree, path_filter, progress,
+                        njobs=1, mode="walk", on_record=None):
+  """
+  The discovery step performs a filesystem walk in order to build up an index
+  of files to be checked. You can use configuration files to setup inclusion
+  and exclusion filters for the discovery process (see `PathFilter` in
+  `makelint.configuration`). In general, though, each directory that is
+  scanned produces a list of files to lint. If the timestamp of a tracked
+  directory changes, it is rescanned for new files, or new directories.
+
+  The output of the discovery phase is a single manifest index with one record
+  per tracked directory (see `makelint.manifest`). Each record depends on the
+  modification time of the directory it corresponds to and will be re-built if
+  the directory is changed. Directories which are unchanged are not listed
+  again: their record is reused as-is. If a new subdirectory is added, the
+  system will recursively index that new directory. If a directory is removed,
+  it will recursively purge that directory from the manifest index.
+
+  If ``mode`` is "parallel" then directories are visited concurrently by
+  ``njobs`` threads. The resulting index is the same either way. If ``mode``
+  is "git" then the tracked files are read directly from the git index of the
+  checkout and no directories are listed at all (see `read_git_sourcetree()`).
+
+  If given, ``on_record(record)`` is called with the record of each tracked
+  directory as soon as it is ready, before the index is complete (e.g. to
+  start digesting it's files).
+
+  Returns the updated `ManifestIndex`.
+  """
+
+  if not os.path.exists(target_tree):
+    os.makedirs(target_tree)
+
+  index = manifest.ManifestIndex.load(target_tree)
+  records = None
+  if mode == "git":
+    records = read_git_sourcetree(
+        source_tree, target_tree, index, path_filter, progress)
+    if records is None:
+      logger.warning("Falling back to a filesystem walk for discovery")
+    elif on_record is not None:
+      for record in records:
+        on_record(record)
+
+  if records is None:
+    index.set_stamp("")
+    if mode == "parallel" and njobs > 1:
+      records = walk_sourcetree_parallel(
+          source_tree, target_tree, index, path_filter, progress, njobs,
+          on_record)
+    else:
+      records = walk_sourcetree(
+          source_tree, target_tree, index, path_filter, progress, on_record)
+
+  # Directories in the target tree which are no longer tracked in the source
+  # tree. We need to remove them
+  for relpath_cwd in index.replace(records):
+    target_cwd = os.path.join(target_tree, relpath_cwd)
+    if relpath_cwd and os.path.isdir(target_cwd):
+      shutil.rmtree(target_cwd)
+  index.save()
+
+  progress(dir_idx=len(records), ndirs=len(records))
+  return index
+
+
+def filter_file_list(source_tree, target_tree, paths, path_filter):
+  """
+  Take a list of paths of source files (either relative to ``source_tree``
+  or absolute) given by the user, rather than discovered by a walk, and
+  return the sorted relpaths of those which exist and which pass the
+  filters. This creates the target directories for them as well.
+  """
+  source_tree = os.path.realpath(source_tree)
+  excluded_dirs = {}
+
+  def dir_is_excluded(relpath_dir):
+    if not relpath_dir:
+      return False
+    if relpath_dir not in excluded_dirs:
+      excluded_dirs[relpath_dir] = (
+          dir_is_excluded(os.path.dirname(relpath_dir))
+          or path_filter.excludes(relpath_dir))
+    return excluded_dirs[relpath_dir]
+
+  relpaths = set()
+  for path in paths:
+    source_path = os.path.realpath(os.path.join(source_tree, path))
+    relpath = os.path.relpath(source_path, source_tree)
+    if relpath.startswith(os.pardir + os.sep):
+      logger.warning("%s is not in the source tree", path)
       continue
-    logger.debug("Scanning: %s", source_cwd)
+    if not os.path.isfile(source_path):
+      logger.info("Skipping %s, it doesn't exist", path)
+      continue
+    if dir_is_excluded(os.path.dirname(relpath)):
+      continue
+    if not path_filter.includes_file(relpath):
+      continue
+    relpaths.add(relpath)
+
+  for relpath_cwd in set(os.path.dirname(relpath) for relpath in relpaths):
+    target_cwd = os.path.join(target_tree, relpath_cwd)
+    if not os.path.exists(target_cwd):
+      os.makedirs(target_cwd)
+  return sorted(relpaths)
+
+
+def get_file_list(target_tree, index=None, relpaths=None):
+  """
+  Return a list of (relpath_cwd, filename) for the files to process, in walk
+  order. This is every file in the manifest index, unless ``relpaths`` is
+  given in which case it is only those files.
+  """
+  if relpaths is not None:
+    return sorted(
+        (os.path.split(relpath) for relpath in set(relpaths)),
+        key=lambda pair: (manifest.get_walk_key(pair[0]), pair[1]))
+  if index is None:
+    index = manifest.ManifestIndex.load(target_tree)
+  return list(index.iter_files())
+
+
+def new_hasher(algorithm):
+  """
+  Return a new hash object for the named digest algorithm. The xxhash
+  algorithms require the optional ``xxhash`` package.
+  """
+  if algorithm == "sha1":
+    return hashlib.sha1()
+  if algorithm == "blake2b":
+    # NOTE(josh): a 160 bit digest is plenty to detect changes, and it keeps
+    # the digest files the same size as sha1
+    return hashlib.blake2b(digest_size=20)
+  if algorithm in ("xxh64", "xxh3_128"):
+    if xxhash is None:
+      raise ValueError(
+          "digest algorithm {} requires the xxhash package".format(algorithm))
+    return getattr(xxhash, algorithm)()
+  raise ValueError("Unknown digest algorithm {}".format(algorithm))
+
+
+def get_digest_suffix(algorithm):
+  """
+  Return the filename suffix of digest files for the named algorithm.
+  """
+  return "." + algorithm
+
 
-    filtered_filenames = []
-    for filename in sorted(filenames):
-      relpath_file = os.path.join(relpath_cwd, filename)
-      if any(pattern.match(relpath_file) for pattern in exclude_patterns):
+def check_digest_algorithm(target_tree, algorithm):
+  """
+  Ensure that the digests in the target tree are computed with ``algorithm``.
+  If they were computed with a different algorithm, then remove the digest
+  files, dependency maps, stat cache and dependency index so that everything
+  is rebuilt from scratch rather than mixing digests. Trees which predate this
+  check are assumed to use sha1.
+  """
+  new_hasher(algorithm)
+  if not os.path.exists(target_tree):
+    os.makedirs(target_tree)
+
+  record_path = os.path.join(target_tree, DIGEST_ALGORITHM_FILENAME)
+  previous = read_digest(record_path)
+  if previous == algorithm:
+    return
+
+  index = manifest.ManifestIndex.load(target_tree)
+  if previous is None:
+    previous = DEFAULT_DIGEST_ALGORITHM
+  if previous != algorithm and index.records:
+    logger.info("Digest algorithm changed from %s to %s, rebuilding",
+                previous, algorithm)
+    old_suffix = get_digest_suffix(previous)
+    for relpath_cwd, filename in index.iter_files():
+      target_path = os.path.join(target_tree, relpath_cwd, filename)
+      for path in (target_path + old_suffix,
+                   target_path + DEPENDENCY_SUFFIX,
+                   target_path + DEPENDENCY_SUFFIX + old_suffix):
+        if os.path.exists(path):
+          os.remove(path)
+    for filename in (statcache.STATCACHE_FILENAME,
+                     depindex.DEPINDEX_FILENAME):
+      cache_path = os.path.join(target_tree, filename)
+      if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+  write_digest(record_path, algorithm)
+
+
+def check_depmap_format(target_tree):
+  """
+  Ensure that the dependency maps in the target tree are stored in the
+  current format (see `makelint.depmap`), converting any that were written by
+  an earlier version. This only does any work once per target tree.
+  """
+  if not os.path.exists(target_tree):
+    os.makedirs(target_tree)
+
+  record_path = os.path.join(target_tree, DEPMAP_FORMAT_FILENAME)
+  current = str(depmap.FORMAT_VERSION)
+  if read_digest(record_path) == current:
+    return
+
+  index = manifest.ManifestIndex.load(target_tree)
+  nconverted = 0
+  for relpath_cwd, filename in index.iter_files():
+    depmap_path = os.path.join(
+        target_tree, relpath_cwd, filename + DEPENDENCY_SUFFIX)
+    try:
+      with open(depmap_path, "rb") as infile:
+        content = infile.read()
+      if not depmap.is_legacy(content):
         continue
-      if any(pattern.match(relpath_file) for pattern in include_patterns):
-        filtered_filenames.append(filename)
+      content = depmap.DependencyMap.parse(content).pack()
+      stat = os.stat(depmap_path)
+    except (IOError, OSError, ValueError):
+      continue
 
-    source_dirset = set(dirnames)
-    target_dirset = set(dirent.name for dirent in os.scandir(target_cwd)
-                        if dirent.is_dir())
+    # NOTE(josh): the map is unchanged, just stored differently. We keep it's
+    # digest file and modification time so that it (and the tool stamps that
+    # depend on it) are still up to date.
+    times_ns = (stat.st_atime_ns, stat.st_mtime_ns)
+    with manifest.write_atomic(depmap_path, times_ns=times_ns) as outfile:
+      outfile.write(content)
+    nconverted += 1
 
-    # Directories in the target tree which are not tracked in the source
-    # tree. We need to remove them
-    for dirname in target_dirset.difference(source_dirset):
-      shutil.rmtree(os.path.join(target_cwd, dirname))
+  if nconverted:
+    logger.info("Converted %d dependency maps to the current format",
+                nconverted)
+  write_digest(record_path, current)
 
-    with open(manifest_path, "w") as outfile:
-      for filename in filtered_filenames:
-        if any(pattern.match(relpath_dir) for pattern in exclude_patterns):
-          continue
-        outfile.write(filename)
-        outfile.write("\n")
 
-  progress(dir_idx=ndirs)
+def remove_dependency_maps(target_tree,
+                           digest_algorithm=DEFAULT_DIGEST_ALGORITHM):
+  """
+  Remove the dependency map (and it's digest) of every file in the manifest
+  index, so that they are all mapped again. The reverse dependency index is
+  kept: the files are found stale because their maps are missing.
+  """
+  digest_suffix = get_digest_suffix(digest_algorithm)
+  index = manifest.ManifestIndex.load(target_tree)
+  for relpath_cwd, filename in index.iter_files():
+    depmap_path = os.path.join(
+        target_tree, relpath_cwd, filename + DEPENDENCY_SUFFIX)
+    for path in (depmap_path, depmap_path + digest_suffix):
+      if os.path.exists(path):
+        os.remove(path)
 
 
-def chunk_iter_file(infile, chunk_size=4096):
+def remove_tool_stamps(target_tree, tool):
   """
-  Read a file chunk by chunk
+  Remove the stamps (and logs) of ``tool`` for every file in the manifest
+  index, so that it is executed on all of them again.
   """
-  chunk = infile.read(chunk_size)
-  while chunk != b"":
-    yield chunk
-    chunk = infile.read(chunk_size)
+  index = manifest.ManifestIndex.load(target_tree)
+  for relpath_cwd, filename in index.iter_files():
+    toolstamp_path = tool.get_stamp(
+        os.path.join(target_tree, relpath_cwd), filename)
+    for path in (toolstamp_path, toolstamp_path + ".log"):
+      if os.path.exists(path):
+        os.remove(path)
 
 
-def digest_file(source_path, digest_path):
+def compute_digest(source_path, algorithm=DEFAULT_DIGEST_ALGORITHM):
   """
-  Compute a message digest of the file content, write the digest
-  (in hexadecimal ascii encoding) to the output file
+  Return the message digest of the file content (in hexadecimal ascii
+  encoding). Large files are memory mapped and hashed in one call. Smaller
+  files are read into a buffer which is reused by each thread.
   """
-  hasher = hashlib.sha1()
+  hasher = new_hasher(algorithm)
   with open(source_path, "rb") as infile:
-    for chunk in chunk_iter_file(infile):
-      hasher.update(chunk)
+    if os.fstat(infile.fileno()).st_size >= DIGEST_MMAP_THRESHOLD:
+      with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        hasher.update(mapped)
+      return hasher.hexdigest()
+
+    buf = getattr(DIGEST_THREAD_STATE, "buf", None)
+    if buf is None:
+      buf = bytearray(DIGEST_BUFFER_SIZE)
+      DIGEST_THREAD_STATE.buf = buf
+    view = memoryview(buf)
+    nbytes = infile.readinto(buf)
+    while nbytes:
+      hasher.update(view[:nbytes])
+      nbytes = infile.readinto(buf)
+  return hasher.hexdigest()
+
+
+def write_digest(digest_path, hexdigest):
   with open(digest_path, "w") as outfile:
-    outfile.write(hasher.hexdigest())
+    outfile.write(hexdigest)
     outfile.write("\n")
 
 
-def digest_sourcetree_content(source_tree, target_tree, progress, njobs):
+def digest_file(source_path, digest_path,
+                algorithm=DEFAULT_DIGEST_ALGORITHM):
   """
-  The sha1 of each tracked file is computed and stored in a digest file
-  (one per source file). The digest file depends on the modification time of
-  the source file. If the sourcefile hasn't changed, the digest file doesn't
-  need to be updated.
+  Compute a message digest of the file content, write the digest
+  (in hexadecimal ascii encoding) to the output file
   """
+  write_digest(digest_path, compute_digest(source_path, algorithm))
 
-  progress(tool_idx=1, tool="sha1")
-  pidset = set()
-  file_idx = 0
-  nfiles = 0
-  for target_cwd, dirnames, filenames in os.walk(target_tree):
-    dirnames[:] = sorted(dirnames)  # stable walk
 
-    relpath_cwd = os.path.relpath(target_cwd, target_tree)
-    if relpath_cwd == ".":
-      # NOTE(josh): os.path.join("", "foo") == "foo"
-      relpath_cwd = ""
-    source_cwd = os.path.join(source_tree, relpath_cwd)
+def read_digest(digest_path):
+  """
+  Return the digest stored in the file at digest_path, or None if it doesn't
+  exist.
+  """
+  try:
+    with open(digest_path) as infile:
+      return infile.read().strip()
+  except (IOError, OSError):
+    return None
+
+
+def digest_job(job, algorithm):
+  """
+  Thread pool job for `digest_sourcetree_content()`. Return the job and the
+  hex digest, or None for the digest if the file can't be read.
+  """
+  source_path = job[1]
+  try:
+    return job, compute_digest(source_path, algorithm)
+  except (IOError, OSError) as ex:
+    logger.warning("Failed to digest %s: %s", source_path, ex)
+    return job, None
 
-    manifest_path = os.path.join(target_cwd, MANIFEST_FILENAME)
-    with open(manifest_path) as infile:
-      filenames = list(line.strip() for line in infile)
 
-    nfiles += len(filenames)
-    progress(nfiles=nfiles)
-    for filename in sorted(filenames):
+def digest_sourcetree_content(
+    source_tree, target_tree, progress, njobs, index=None, relpaths=None,
+    digest_algorithm=DEFAULT_DIGEST_ALGORITHM, memo=None):
+  """
+  The digest of each tracked file is computed and stored in a digest file
+  (one per source file). The inode, size and modification time of each source
+  file are recorded in the stat cache along with it's digest. If these haven't
+  changed, the file isn't hashed again. If the file is hashed but the digest
+  is unchanged, the digest file isn't rewritten (so that it's mtime doesn't
+  invalidate anything downstream).
+
+  Hashing is done on a pool of ``njobs`` threads within this process
+  (hashlib releases the GIL while hashing). The digest files are written
+  from this thread in batches as the results come in.
+
+  If ``memo`` (a `FileMemo`) is given, the stat results of the source files
+  and the digests written are recorded in it for the later phases.
+  """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  files = get_file_list(target_tree, index, relpaths)
+  progress(tool_idx=1, tool=digest_algorithm, nfiles=len(files))
+  digest_suffix = get_digest_suffix(digest_algorithm)
+
+  cache = statcache.StatCache.load(target_tree)
+  stale = []
+  for relpath_cwd, filename in files:
+    relpath_file = os.path.join(relpath_cwd, filename)
+    source_path = os.path.join(source_tree, relpath_file)
+    stat = memo.stat(source_path)
+    if stat is None:
+      logger.warning("Failed to stat %s", source_path)
+      continue
+    if (cache.is_clean(relpath_file, stat) and memo.exists(
+        os.path.join(target_tree, relpath_file + digest_suffix))):
+      # NOTE(josh): this source file has not changed since the last time
+      # that we digested it, and the digest file is still there, so we do not
+      # need to
+      continue
+    logger.debug("Digesting: %s", relpath_file)
+    stale.append((relpath_file, source_path, stat))
+
+  if relpaths is None:
+    cache.retain(os.path.join(relpath_cwd, filename)
+                 for relpath_cwd, filename in files)
+
+  file_idx = len(files) - len(stale)
+  progress(file_idx=file_idx)
+
+  def write_batch(batch):
+    for digest_path, hexdigest in batch:
+      write_digest(digest_path, hexdigest)
+      memo.put_text(digest_path, hexdigest)
+
+  batch = []
+  with futures.ThreadPoolExecutor(max_workers=max(njobs, 1)) as pool:
+    results = pool.map(
+        lambda job: digest_job(job, digest_algorithm), stale)
+    for (relpath_file, _, stat), hexdigest in results:
       file_idx += 1
       progress(file_idx=file_idx)
-      digest_name = filename + ".sha1"
-      source_path = os.path.join(source_cwd, filename)
-      digest_path = os.path.join(target_cwd, digest_name)
-      if (os.path.exists(digest_path) and
-          os.path.getmtime(digest_path) > os.path.getmtime(source_path)):
-          # NOTE(josh): this source file has not changed since the last time
-          # that we digested it, so we do not need to
+      if hexdigest is None:
         continue
-      logger.debug("Digesting: %s/%s", relpath_cwd, filename)
-      waitforsize(pidset, njobs - 1)
-      pid = os.fork()
-      if pid == 0:
-        digest_file(source_path, digest_path)
-        os._exit(0)  # pylint: disable=protected-access
-      pidset.add(pid)
-  waitforsize(pidset, 0)
-
-
-# pylint: disable=E1123
-if sys.version_info < (2, 6, 0):
-  DependencyItem = collections.namedtuple(
-      "DependencyItem", ["path", "digest", "name"])
-  DependencyItem.__new__.func_defaults = (None,)
-if sys.version_info < (3, 7, 0):
-  DependencyItem = collections.namedtuple(
-      "DependencyItem", ["path", "digest", "name"])
-  DependencyItem.__new__.__defaults__ = (None,)
-else:
-  DependencyItem = collections.namedtuple(
-      "DependencyItem", ["path", "digest", "name"],
-      defaults=(None,))
-
-
-def depmap_is_uptodate(target_tree, relpath_file):
+      digest_path = os.path.join(target_tree, relpath_file + digest_suffix)
+      record = cache.get(relpath_file)
+      if record is None:
+        old_digest = memo.read_text(digest_path)
+      elif memo.exists(digest_path):
+        old_digest = record.digest
+      else:
+        old_digest = None
+      if hexdigest != old_digest:
+        batch.append((digest_path, hexdigest))
+      cache.update(relpath_file, stat, hexdigest)
+      if len(batch) >= DIGEST_BATCH_SIZE:
+        write_batch(batch)
+        batch = []
+  write_batch(batch)
+  cache.save()
+  memo.log_counts("digest")
+
+
+def depmap_is_uptodate(target_tree, relpath_file, source_tree=None,
+                       digest_algorithm=DEFAULT_DIGEST_ALGORITHM, memo=None,
+                       env=None):
   """
   Given a dictionary of dependency data, return true if all of the files
-  listed are unchanged since we last ran the scan.f
+  listed are unchanged since we last ran the scan. Relative paths of
+  dependencies that are not tracked are resolved against ``source_tree``
+  (or the current directory, if not given). Filesystem queries go through
+  ``memo`` (a `FileMemo`) if given. Environment fingerprints are compared
+  against ``env`` (an `EnvironmentFingerprints`) if given.
   """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  if env is None:
+    env = fingerprints.EnvironmentFingerprints()
   relpath_depmap = relpath_file + DEPENDENCY_SUFFIX
   depmap_path = os.path.join(target_tree, relpath_depmap)
+  digest_suffix = get_digest_suffix(digest_algorithm)
 
-  if not os.path.exists(depmap_path):
+  if not memo.exists(depmap_path):
     return False
-  if not os.path.exists(depmap_path + ".sha1"):
+  if not memo.exists(depmap_path + digest_suffix):
     return False
 
-  depmap_mtime = os.path.getmtime(depmap_path)
-  if os.path.getmtime(depmap_path + ".sha1") < depmap_mtime:
-    logger.warning("depmap mtime is later than it's sha1")
+  depmap_mtime = memo.getmtime(depmap_path)
+  if memo.getmtime(depmap_path + digest_suffix) < depmap_mtime:
+    logger.warning("depmap mtime is later than it's digest")
     return False
 
-  with open(depmap_path, "r") as infile:
-    depmap_data = json.load(infile)
+  depmap_data = memo.read_depmap(depmap_path)
 
-  for item in depmap_data:
-    item = DependencyItem(**item)
+  for path, item_digest in zip(depmap_data.paths, depmap_data.digests):
+    if fingerprints.is_fingerprint(path):
+      if env.get(path) != item_digest:
+        logger.debug("%s has changed", path)
+        return False
+      continue
 
-    if item.path.startswith("/"):
-      if not os.path.exists(item.path):
-        logger.debug("%s disappeared", item.path)
+    if path.startswith("/"):
+      if not memo.exists(path):
+        logger.debug("%s disappeared", path)
         return False
 
       # The dependency is an absolute path, which means that it is outside
       # the source tree. We don't have a digest cache of this file so if
       # it's timestamp indictes it is newer we must act on taht.
-      if os.path.getmtime(item.path) > depmap_mtime:
-        logger.debug("%s is newer", item.path)
+      if memo.getmtime(path) > depmap_mtime:
+        logger.debug("%s is newer", path)
         return False
       continue
 
-    digest_path = os.path.join(target_tree, item.path + ".sha1")
-    if not os.path.exists(digest_path):
+    digest_path = os.path.join(target_tree, path + digest_suffix)
+    if not memo.exists(digest_path):
       # Digest file does not exist, but corresponding source file is in our
       # source tree... so it must have been excluded during scan
-      if not os.path.exists(item.path):
-        logger.debug("%s disappeared", item.path)
+      source_path = path
+      if source_tree is not None:
+        source_path = os.path.join(source_tree, path)
+      if not memo.exists(source_path):
+        logger.debug("%s disappeared", path)
         return False
 
-      if os.path.getmtime(item.path) > depmap_mtime:
-        logger.debug("%s is newer", item.path)
+      if memo.getmtime(source_path) > depmap_mtime:
+        logger.debug("%s is newer", path)
         return False
       continue
 
-    if os.path.getmtime(digest_path) < depmap_mtime:
+    if memo.getmtime(digest_path) < depmap_mtime:
       # The dependency map is newer than this particular file, so this
       # file does not invalidate it
       continue
 
-    with open(digest_path) as infile:
-      digest = infile.read().strip()
+    digest = memo.read_text(digest_path)
 
-    if digest == item.digest:
+    if digest == item_digest:
       # The timestamp on this file is newer than the digest, but the file
       # content is unchanged, so thsi file does not invalidate it
       continue
@@ -273,177 +782,36 @@ def depmap_is_uptodate(target_tree, relpath_file):
   return True
 
 
-def map_dependencies(source_tree, target_tree, source_relpath):
+def map_dependencies(source_tree, target_tree, source_relpath,
+                     digest_algorithm=DEFAULT_DIGEST_ALGORITHM):
   """
   Get a dependency list from the sourcefile. Writeout the dependency file
-  and it's sha1 digest.
+  and it's digest.
   """
+  digest_suffix = get_digest_suffix(digest_algorithm)
   targetpath = os.path.join(target_tree, source_relpath) + DEPENDENCY_SUFFIX
-  with open(targetpath, "w") as outfile:
+  with open(targetpath, "wb") as outfile:
     subprocess.check_call(
         [sys.executable, "-Bm", "makelint.get_dependencies",
          "--module-relpath", source_relpath,
          "--source-tree", source_tree,
-         "--target-tree", target_tree
+         "--target-tree", target_tree,
+         "--digest-suffix", digest_suffix,
          ], stdout=outfile, stderr=subprocess.DEVNULL)
-  digest_file(targetpath, targetpath + ".sha1")
-
-
-def map_sourcetree_dependencies(source_tree, target_tree, progress, njobs):
-  """
-  During this phase each tracked
-  source file is indexed to get a complete dependency footprint. Note that this
-  is done by importing each module file in a clean interpreter process, and
-  then inspecting the `__file__` attribute of all modules loaded by interpreter.
-  """
-  progress(tool_idx=2, tool="depmap")
-  pidset = set()
-  file_idx = 0
-  for target_cwd, dirnames, filenames in os.walk(target_tree):
-    dirnames[:] = sorted(dirnames)  # stable walk
-
-    relpath_cwd = os.path.relpath(target_cwd, target_tree)
-    if relpath_cwd == ".":
-      # NOTE(josh): os.path.join("", "foo") == "foo"
-      relpath_cwd = ""
-
-    manifest_path = os.path.join(target_cwd, MANIFEST_FILENAME)
-    with open(manifest_path) as infile:
-      filenames = list(line.strip() for line in infile)
-
-    for filename in sorted(filenames):
-      file_idx += 1
-      progress(file_idx=file_idx)
-      relpath_file = os.path.join(relpath_cwd, filename)
-      if not depmap_is_uptodate(target_tree, relpath_file):
-        logger.debug("Mapping dependencies: %s", relpath_file)
-        waitforsize(pidset, njobs - 1)
-        pid = os.fork()
-        if pid == 0:
-          map_dependencies(source_tree, target_tree, relpath_file)
-          os._exit(0)  # pylint: disable=protected-access
-        pidset.add(pid)
-  waitforsize(pidset, 0)
+  digest_file(targetpath, targetpath + digest_suffix, digest_algorithm)
 
 
-def toolstamp_is_uptodate(toolstamp_path, depmap_path):
+def write_dependencies(target_tree, source_relpath, content,
+                       digest_algorithm=DEFAULT_DIGEST_ALGORITHM):
   """
-  Return true if the toolstamp is up to date with respect to the dependency
-  map
+  Write out a dependency file with the given content (bytes, see
+  `makelint.depmap`), and it's digest.
   """
-  digest_path = depmap_path + ".sha1"
-  if not os.path.exists(toolstamp_path):
-    return False
-
-  if os.path.getmtime(toolstamp_path) > os.path.getmtime(depmap_path):
-    # The tool execution stamp is newer than the dependency map digest
-    # so we know that it is up to date
-    return True
-
-  with open(toolstamp_path) as infile:
-    toolstamp_digest = infile.read().strip()
-
-  with open(digest_path) as infile:
-    depmap_digest = infile.read().strip()
-
-  # If the current dependency map digest matches the dependency map digest
-  # when the tool was last executed, then the dependency footprint has not
-  # changed (nor the source file itself) so the tool stamp is up to date.
-  return toolstamp_digest == depmap_digest
-
-
-def cat_log(logfile_path, header, merged_log):
-  """
-  Copy the content from logfile_path into merged_log
-  """
-  if not merged_log:
-    return
-
-  merged_log.write(header)
-  merged_log.write("\n")
-  merged_log.write("=" * len(header))
-  merged_log.write("\n")
-  with open(logfile_path) as infile:
-    for line in infile:
-      merged_log.write(line)
-  merged_log.write("\n\n")
-
-
-def execute_tool_ontree(
-    source_tree, target_tree, tool, env, fail_fast, merged_log, progress,
-    njobs):
-  """
-  Execute the given tool
-  """
-  progress(tool_idx=progress.tool_idx + 1, tool=tool.name)
-  pidset = set()
-  file_idx = 0
-  output = 0
-  for target_cwd, dirnames, filenames in os.walk(target_tree):
-    dirnames[:] = sorted(dirnames)  # stable walk
-
-    relpath_cwd = os.path.relpath(target_cwd, target_tree)
-    if relpath_cwd == ".":
-      # NOTE(josh): os.path.join("", "foo") == "foo"
-      relpath_cwd = ""
-
-    manifest_path = os.path.join(target_cwd, MANIFEST_FILENAME)
-    with open(manifest_path) as infile:
-      filenames = list(line.strip() for line in infile)
-
-    for filename in sorted(filenames):
-      file_idx += 1
-      progress(file_idx=file_idx)
-      source_relpath = os.path.join(relpath_cwd, filename)
-      toolstamp_path = tool.get_stamp(target_cwd, filename)
-      depmap_path = os.path.join(target_cwd, filename + DEPENDENCY_SUFFIX)
-      logfile_path = toolstamp_path + ".log"
-
-      if toolstamp_is_uptodate(toolstamp_path, depmap_path):
-        with open(toolstamp_path) as infile:
-          content = infile.read().strip()
-        if content == "fail":
-          output |= 1
-          header = "{} (cached)".format(source_relpath)
-          cat_log(logfile_path, header, merged_log)
-          if fail_fast:
-            return output
-      else:
-        if os.path.exists(toolstamp_path):
-          os.remove(toolstamp_path)
-
-        output |= waitforsize(pidset, njobs - 1)
-        if fail_fast and output:
-          output |= waitforsize(pidset, 0)
-          return output
-
-        pid = os.fork()
-        if pid != 0:
-          pidset.add(pid)
-          continue
-
-        # Child process
-        with open(logfile_path, "w") as outfile:
-          result = tool.execute(source_tree, source_relpath, env, outfile)
-        if result == 0:
-          logger.debug("%s: okay!", toolstamp_path)
-          shutil.copyfile(depmap_path + ".sha1", toolstamp_path)
-          os.remove(logfile_path)
-        else:
-          with open(toolstamp_path, "w") as outfile:
-            outfile.write("fail")
-          logger.info("%s: failed :(", toolstamp_path)
-
-          # NOTE(josh): we have multiple processes catting to this file, so
-          # we need serialize the cat operation to prevent interleaving.
-          fcntl.flock(merged_log, fcntl.LOCK_EX)
-          cat_log(logfile_path, source_relpath, merged_log)
-          fcntl.flock(merged_log, fcntl.LOCK_UN)
-        merged_log.close()
-        os._exit(result)  # pylint: disable=protected-access
-
-  output |= waitforsize(pidset, 0)
-  return output
+  digest_suffix = get_digest_suffix(digest_algorithm)
+  targetpath = os.path.join(target_tree, source_relpath) + DEPENDENCY_SUFFIX
+  with open(targetpath, "wb") as outfile:
+    outfile.write(content)
+  digest_file(targetpath, targetpath + digest_suffix, digest_algorithm)
 
 
 def get_progress_bar(numchars, fraction=None, percent=None):
@@ -482,6 +850,11 @@ class ProgressReporter(object):
     self.lastprint = 0
     self.toolnames = [""] * 10
 
+    # Number of files done by each step before the current one, if they
+    # aren't all done (i.e. when the steps run concurrently, see
+    # `makelint.pipeline`)
+    self.counts = {}
+
   def __call__(self, **kwargs):
     rewind = kwargs.pop("rewind", True)
     force = kwargs.pop("force", False)
@@ -513,6 +886,9 @@ class ProgressReporter(object):
     """
     Return the index of our current step
     """
+    if self.counts:
+      return sum(self.counts.get(idx, self.nfiles)
+                 for idx in range(self.tool_idx)) + self.file_idx
     return (self.tool_idx * self.nfiles) + self.file_idx
 
   def get_progress(self):
@@ -547,10 +923,14 @@ class ProgressReporter(object):
     nlines += 1
 
     for idx in range(1, self.tool_idx):
+      count = self.counts.get(idx, self.nfiles)
+      progress = 100.0
+      if count != self.nfiles:
+        progress = 100.0 * count / self.nfiles
       sys.stdout.write(
-          "{0:>10s}: {1:5d}/{1:<5d} [{2}] {3:6.2f}%"
-          .format(self.toolnames[idx], self.nfiles,
-                  get_progress_bar(20, 1.0), 100.0))
+          "{:>10s}: {:5d}/{:<5d} [{}] {:6.2f}%"
+          .format(self.toolnames[idx], count, self.nfiles,
+                  get_progress_bar(20, percent=progress), progress))
       sys.stdout.write("\x1b[0K\n")
       nlines += 1
 
@@ -574,5 +954,7 @@ class NullProgressReport(object):
   No-op for quiet mode
   """
 
-  def __call__(self, *kwargs):
+  tool_idx = 0
+
+  def __call__(self, **kwargs):
     pass
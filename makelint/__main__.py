@@ -15,6 +15,13 @@ import textwrap
 
 import makelint
 from makelint import configuration
+from makelint import depmapper
+from makelint import fsmemo
+from makelint import jobserver
+from makelint import latch
+from makelint import pipeline
+from makelint import scheduler
+from makelint import watch
 
 logger = logging.getLogger()
 
@@ -115,7 +122,8 @@ def add_config_options(optgroup):
       if value:
         typearg = type(value[0])
       optgroup.add_argument('--' + key.replace('_', '-'), nargs='*',
-                            type=typearg, help=helptext)
+                            type=typearg, help=helptext,
+                            choices=configuration.VARCHOICES.get(key, None))
 
 
 def setup_argparser(parser):
@@ -134,6 +142,20 @@ def setup_argparser(parser):
   parser.add_argument(
       '-c', '--config-file',
       help='path to configuration file')
+  parser.add_argument(
+      "--files-from", metavar="PATH",
+      help="Read a list of files to check (one per line) from this file, or "
+           "from stdin if PATH is '-'. Skips discovery and checks only "
+           "those files.")
+  parser.add_argument(
+      "files", nargs="*", metavar="FILE",
+      help="Check only these files (relative to the source tree) instead "
+           "of discovering them. Use '--' to separate them from options "
+           "that take a list.")
+  parser.add_argument(
+      "--watch", action="store_true",
+      help="After the initial run, keep running and re-check files as they "
+           "are changed (Linux only)")
 
   optgroup = parser.add_argument_group(
       title='Configuration',
@@ -141,9 +163,49 @@ def setup_argparser(parser):
   add_config_options(optgroup)
 
 
+def get_file_list(args):
+  """
+  Return the list of files given on the command line or with --files-from,
+  or None if no files were given (i.e. they should be discovered).
+  """
+  if args.files_from is None and not args.files:
+    return None
+
+  paths = list(args.files)
+  if args.files_from == "-":
+    paths.extend(sys.stdin.read().splitlines())
+  elif args.files_from is not None:
+    with io.open(args.files_from, "r", encoding="utf-8") as infile:
+      paths.extend(infile.read().splitlines())
+  return [path.strip() for path in paths if path.strip()]
+
+
+def run_phases(cfg, progress, memo, relpaths, merged_log, result_cache,
+               remote_cache, client):
+  """
+  Run each phase over the whole tree (or the files at relpaths, if given)
+  before starting the next. Return the bitwise or of the exit status of the
+  tools.
+  """
+  index = None
+  if relpaths is None:
+    index = makelint.discover_sourcetree(
+        cfg.source_tree, cfg.target_tree, cfg.get_path_filter(), progress,
+        cfg.jobs, cfg.discovery)
+  makelint.digest_sourcetree_content(
+      cfg.source_tree, cfg.target_tree, progress, cfg.jobs, index, relpaths,
+      cfg.digest_algorithm, memo)
+  depmapper.map_sourcetree_dependencies(
+      cfg, progress, index, relpaths, memo=memo, jobserver=client)
+  return scheduler.execute_tools_ontree(
+      cfg, progress, index, relpaths, memo, merged_log, result_cache,
+      remote_cache, client)
+
+
 USAGE_STRING = """
 pymakelint [-h] [-v] [-l {debug,info,warning,error}] [--dump-config]
-           [-c CONFIG_FILE] [<config-overrides> [...]]
+           [-c CONFIG_FILE] [--watch] [--files-from PATH]
+           [<config-overrides> [...]] [-- FILE [FILE ...]]
 """
 
 
@@ -175,35 +237,61 @@ def main():
     sys.exit(0)
 
   cfg = configuration.Configuration(**config_dict)
+  if args.watch:
+    merged_log = sys.stdout
+    if cfg.merge_log:
+      merged_log = open(cfg.merge_log, "w", encoding="utf-8")
+    return watch.watch_sourcetree(cfg, merged_log)
+
   if cfg.quiet:
     progress = makelint.NullProgressReport()
   else:
     progress = makelint.ProgressReporter()
 
+  makelint.check_digest_algorithm(cfg.target_tree, cfg.digest_algorithm)
+  makelint.check_depmap_format(cfg.target_tree)
+  latch.check_configuration(cfg)
   progress(ntools=len(cfg.tools) + 2)
-  makelint.discover_sourcetree(
-      cfg.source_tree, cfg.target_tree,
-      cfg.exclude_patterns, cfg.include_patterns, progress)
-  makelint.digest_sourcetree_content(
-      cfg.source_tree, cfg.target_tree, progress, cfg.jobs)
-  makelint.map_sourcetree_dependencies(
-      cfg.source_tree, cfg.target_tree, progress, cfg.jobs)
+  relpaths = get_file_list(args)
+  if relpaths is not None:
+    relpaths = makelint.filter_file_list(
+        cfg.source_tree, cfg.target_tree, relpaths, cfg.get_path_filter())
 
+  memo = fsmemo.FileMemo()
   merged_log = None
   if cfg.merge_log:
     merged_log = open(cfg.merge_log, "w", encoding="utf-8")
-
-  retcode = 0
-  for tool in cfg.tools:
-    retcode |= makelint.execute_tool_ontree(
-        cfg.source_tree, cfg.target_tree, tool, cfg.env,
-        cfg.fail_fast, merged_log, progress, cfg.jobs)
+  result_cache = cfg.get_result_cache()
+  remote_cache = cfg.get_remote_cache()
+  client = None
+  if cfg.jobserver:
+    client = jobserver.JobServerClient.from_environ()
+
+  try:
+    if cfg.pipeline:
+      retcode = pipeline.run_pipeline(
+          cfg, progress, memo, relpaths, merged_log, result_cache,
+          remote_cache, client)
+    else:
+      retcode = run_phases(cfg, progress, memo, relpaths, merged_log,
+                           result_cache, remote_cache, client)
+  finally:
+    # NOTE(josh): make loses any token that we don't return, even if we are
+    # interrupted
+    if client is not None:
+      client.close()
+  if result_cache is not None:
+    result_cache.trim()
+  if remote_cache is not None:
+    remote_cache.close()
 
   if merged_log:
     merged_log.close()
 
   progress(force=True, rewind=False)
-  return retcode
+  # NOTE(josh): retcode is a bitwise-or of wait() statuses, which would be
+  # truncated to zero by the shell if returned directly
+  return 1 if retcode else 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+"""
+Micro-benchmarks for the hot paths of makelint. Execute with something like:
+
+python -Bm makelint.benchmarks patterns --npatterns 60
+python -Bm makelint.benchmarks digest --nfiles 5000 --jobs 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import functools
+import hashlib
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import makelint
+from makelint import configuration
+from makelint import statcache
+
+
+def make_patterns(npatterns, rng):
+  """
+  Return a list of ``npatterns`` exclusion patterns with a mix of shapes
+  similar to what we see in real configurations: literal directories,
+  filename suffixes, and general regular expressions.
+  """
+  shapes = [
+      "third_party/lib{}",
+      ".*/generated_{}\\.py",
+      ".*_pb{}\\.py$",
+      "build-{}/.*",
+      "tools/legacy/module_{}\\.py$",
+      "[a-z]+/vendored{}/.*",
+      ".*/test_data_\\d+_{}",
+  ]
+  patterns = [".build", ".git", ".*__pycache__", ".*/\\.[^/]+\\.py"]
+  while len(patterns) < npatterns:
+    shape = shapes[len(patterns) % len(shapes)]
+    patterns.append(shape.format(rng.randint(0, 10000)))
+  return patterns[:npatterns]
+
+
+def make_paths(npaths, rng):
+  """
+  Return a list of ``npaths`` synthetic relative file paths
+  """
+  dirnames = ["src", "lib", "tools", "util", "core", "io", "net", "ui",
+              "tests", "third_party", "build-12", "legacy"]
+  paths = []
+  for idx in range(npaths):
+    depth = rng.randint(1, 5)
+    parts = [rng.choice(dirnames) for _ in range(depth)]
+    parts.append("module_{}.py".format(idx))
+    paths.append("/".join(parts))
+  return paths
+
+
+def collect_paths(source_tree):
+  """
+  Return the relative paths of all files and directories under source_tree
+  """
+  paths = []
+  for cwd, dirnames, filenames in os.walk(source_tree):
+    relpath_cwd = os.path.relpath(cwd, source_tree)
+    if relpath_cwd == ".":
+      relpath_cwd = ""
+    for name in dirnames + filenames:
+      paths.append(os.path.join(relpath_cwd, name))
+  return paths
+
+
+def bench_patterns(args):
+  """
+  Compare the per-pattern ``any(pattern.match())`` loop against a compiled
+  `PatternMatcher`.
+  """
+  rng = random.Random(args.seed)
+  if args.config_file:
+    config_dict = {}
+    with open(args.config_file) as infile:
+      exec(infile.read(), config_dict)  # pylint: disable=exec-used
+    sources = config_dict.get("exclude_patterns", [])
+  else:
+    sources = make_patterns(args.npatterns, rng)
+
+  if args.source_tree:
+    paths = collect_paths(args.source_tree)
+  else:
+    paths = make_paths(args.npaths, rng)
+
+  patterns = [re.compile(source) for source in sources]
+  matcher = configuration.PatternMatcher(patterns)
+
+  def loop():
+    return [any(pattern.match(path) for pattern in patterns)
+            for path in paths]
+
+  def compiled():
+    return [matcher.match(path) for path in paths]
+
+  if loop() != compiled():
+    print("ERROR: matcher disagrees with the per-pattern loop",
+          file=sys.stderr)
+    return 1
+
+  print("{} patterns, {} paths: {} prefix, {} exact, {} suffix, "
+        "{} substring, {} regex"
+        .format(len(patterns), len(paths), len(matcher.prefixes),
+                len(matcher.exact), len(matcher.suffixes),
+                len(matcher.substrings), len(matcher.regexes)))
+
+  results = {}
+  for name, fun in (("loop", loop), ("matcher", compiled)):
+    best = min(timeit.repeat(fun, number=1, repeat=args.repeat))
+    results[name] = best
+    print("{:>10s}: {:8.3f} ms ({:6.3f} us/path)"
+          .format(name, 1e3 * best, 1e6 * best / max(len(paths), 1)))
+  print("{:>10s}: {:8.2f}x".format(
+      "speedup", results["loop"] / max(results["matcher"], 1e-9)))
+  return 0
+
+
+def make_sourcetree(source_tree, nfiles, rng):
+  """
+  Populate ``source_tree`` with ``nfiles`` python files in a few levels of
+  directories. Most files are a few KiB, with a tail of larger ones.
+  """
+  for idx in range(nfiles):
+    relpath_dir = os.path.join(
+        "pkg{}".format(idx % 7), "sub{}".format(idx % 13))
+    dirpath = os.path.join(source_tree, relpath_dir)
+    if not os.path.exists(dirpath):
+      os.makedirs(dirpath)
+    size = int(rng.lognormvariate(8.5, 1.2))
+    line = "x_{} = {!r}\n".format(idx, "y" * 60).encode("utf-8")
+    with open(os.path.join(dirpath, "mod_{}.py".format(idx)), "wb") as outfile:
+      outfile.write(line * (size // len(line) + 1))
+
+
+def digest_forked(source_tree, target_tree, njobs, index):
+  """
+  Reference implementation: fork one child per stale file, which hashes it
+  in 4 KiB chunks and writes the digest.
+  """
+  pidset = set()
+  for relpath_cwd, filename in index.iter_files():
+    source_path = os.path.join(source_tree, relpath_cwd, filename)
+    digest_path = os.path.join(target_tree, relpath_cwd, filename + ".sha1")
+    if (os.path.exists(digest_path) and
+        os.path.getmtime(digest_path) > os.path.getmtime(source_path)):
+      continue
+    makelint.waitforsize(pidset, njobs - 1)
+    pid = os.fork()
+    if pid == 0:
+      hasher = hashlib.sha1()
+      with open(source_path, "rb") as infile:
+        for chunk in iter(functools.partial(infile.read, 4096), b""):
+          hasher.update(chunk)
+      with open(digest_path, "w") as outfile:
+        outfile.write(hasher.hexdigest())
+        outfile.write("\n")
+      os._exit(0)  # pylint: disable=protected-access
+    pidset.add(pid)
+  makelint.waitforsize(pidset, 0)
+
+
+def digest_threaded(source_tree, target_tree, njobs, index,
+                    algorithm=makelint.DEFAULT_DIGEST_ALGORITHM):
+  makelint.digest_sourcetree_content(
+      source_tree, target_tree, makelint.NullProgressReport(), njobs, index,
+      digest_algorithm=algorithm)
+
+
+def touch_fraction(source_tree, index, fraction, rng):
+  """
+  Bump the modification time of a random ``fraction`` of the files so that
+  their digests are stale.
+  """
+  future = time.time() + 10
+  for relpath_cwd, filename in index.iter_files():
+    if rng.random() < fraction:
+      os.utime(os.path.join(source_tree, relpath_cwd, filename),
+               (future, future))
+
+
+def bench_digest(args):
+  """
+  Compare digesting with one forked child per file against the threaded
+  in-process engine, on a cold target tree and on a partially warm one.
+  The forked path always uses sha1.
+  """
+  rng = random.Random(args.seed)
+  scratch = tempfile.mkdtemp(prefix="makelint-bench-")
+  try:
+    source_tree = args.source_tree
+    if not source_tree:
+      source_tree = os.path.join(scratch, "src")
+      make_sourcetree(source_tree, args.nfiles, rng)
+    target_tree = os.path.join(scratch, "tgt")
+    path_filter = configuration.PathFilter([r".*\.py"], [], [])
+    index = makelint.discover_sourcetree(
+        source_tree, target_tree, path_filter, makelint.NullProgressReport())
+    print("{} files, {} jobs, {}"
+          .format(index.nfiles, args.jobs, args.algorithm))
+    suffix = makelint.get_digest_suffix(args.algorithm)
+
+    def clear_digests():
+      for relpath_cwd, filename in index.iter_files():
+        for digest_suffix in (".sha1", suffix):
+          digest_path = os.path.join(
+              target_tree, relpath_cwd, filename + digest_suffix)
+          if os.path.exists(digest_path):
+            os.unlink(digest_path)
+      cache_path = os.path.join(target_tree, statcache.STATCACHE_FILENAME)
+      if os.path.exists(cache_path):
+        os.unlink(cache_path)
+
+    def threaded(source_tree, target_tree, njobs, index):
+      digest_threaded(source_tree, target_tree, njobs, index, args.algorithm)
+
+    results = {}
+    for name, fun in (("fork", digest_forked), ("threaded", threaded)):
+      clear_digests()
+      tstart = time.time()
+      fun(source_tree, target_tree, args.jobs, index)
+      results[name, "cold"] = time.time() - tstart
+
+      touch_fraction(source_tree, index, args.warm_fraction, random.Random(0))
+      tstart = time.time()
+      fun(source_tree, target_tree, args.jobs, index)
+      results[name, "warm"] = time.time() - tstart
+
+    for state in ("cold", "warm"):
+      print("{}:".format(state))
+      for name in ("fork", "threaded"):
+        print("  {:>10s}: {:8.3f} ms".format(name, 1e3 * results[name, state]))
+      print("  {:>10s}: {:8.2f}x".format(
+          "speedup", results["fork", state] /
+          max(results["threaded", state], 1e-9)))
+  finally:
+    shutil.rmtree(scratch)
+  return 0
+
+
+def setup_argparser(parser):
+  subparsers = parser.add_subparsers(dest="command")
+
+  subparser = subparsers.add_parser(
+      "patterns", help=bench_patterns.__doc__.strip().split("\n")[0])
+  subparser.add_argument("--npatterns", type=int, default=60)
+  subparser.add_argument("--npaths", type=int, default=20000)
+  subparser.add_argument("--repeat", type=int, default=5)
+  subparser.add_argument("--seed", type=int, default=0)
+  subparser.add_argument(
+      "--config-file",
+      help="Use the exclude_patterns from this config file instead of "
+           "synthetic patterns")
+  subparser.add_argument(
+      "--source-tree",
+      help="Match the paths in this tree instead of synthetic paths")
+  subparser.set_defaults(func=bench_patterns)
+
+  subparser = subparsers.add_parser(
+      "digest", help=bench_digest.__doc__.strip().split("\n")[0])
+  subparser.add_argument("--nfiles", type=int, default=5000)
+  subparser.add_argument(
+      "--algorithm", default=makelint.DEFAULT_DIGEST_ALGORITHM,
+      choices=configuration.VARCHOICES["digest_algorithm"],
+      help="Digest algorithm for the threaded engine")
+  subparser.add_argument("--jobs", type=int, default=os.cpu_count())
+  subparser.add_argument("--seed", type=int, default=0)
+  subparser.add_argument(
+      "--warm-fraction", type=float, default=0.1,
+      help="Fraction of files to modify between the cold and warm runs")
+  subparser.add_argument(
+      "--source-tree",
+      help="Digest the python files in this tree instead of a synthetic "
+           "tree. Note that modification times of some files will be bumped.")
+  subparser.set_defaults(func=bench_digest)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  setup_argparser(parser)
+  args = parser.parse_args()
+  if not getattr(args, "func", None):
+    parser.print_help()
+    return 1
+  return args.func(args)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Reference implementation of the remote result cache protocol (see
+`makelint.remotecache`). It stores entries in a `resultcache.ResultCache`
+directory. This is intended for testing and for small deployments, e.g.::
+
+  python -Bm makelint.cache_server --port 8090 --cache-dir /tmp/lintcache
+
+and then configure ``remote_cache_url = "http://localhost:8090"``.
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+from makelint import resultcache
+
+logger = logging.getLogger()
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+# Minimum number of seconds between trims of the cache directory
+TRIM_INTERVAL = 60
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Serves GET, HEAD and PUT of entries, and POST of batched existence checks.
+  """
+
+  protocol_version = "HTTP/1.1"
+
+  def get_key(self):
+    """
+    Return the key addressed by the request path, or None if the path does
+    not address an entry.
+    """
+    prefix = self.server.prefix
+    if not self.path.startswith(prefix + "/"):
+      return None
+    key = self.path[len(prefix) + 1:]
+    if not KEY_PATTERN.match(key):
+      return None
+    return key
+
+  def send_body(self, status, body, content_type="application/octet-stream"):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(body)
+
+  def read_body(self):
+    length = int(self.headers.get("Content-Length", 0))
+    return self.rfile.read(length)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    key = self.get_key()
+    blob = None
+    if key is not None:
+      blob = self.server.cache.read_blob(key)
+    if blob is None:
+      self.send_body(404, b"")
+    else:
+      self.send_body(200, blob)
+
+  do_HEAD = do_GET
+
+  def do_PUT(self):  # pylint: disable=invalid-name
+    key = self.get_key()
+    blob = self.read_body()
+    if key is None:
+      self.send_body(404, b"")
+      return
+    try:
+      resultcache.unpack_entry(blob)
+    except ValueError:
+      self.send_body(400, b"")
+      return
+    self.server.cache.write_blob(key, blob)
+    self.server.maybe_trim()
+    self.send_body(204, b"")
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    body = self.read_body()
+    if self.path != self.server.prefix + "/exists":
+      self.send_body(404, b"")
+      return
+    try:
+      keys = json.loads(body.decode("utf-8"))
+    except ValueError:
+      self.send_body(400, b"")
+      return
+    found = [key for key in keys
+             if isinstance(key, str) and KEY_PATTERN.match(key)
+             and self.server.cache.contains(key)]
+    self.send_body(200, json.dumps(found).encode("utf-8"),
+                   "application/json")
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+  """
+  Serves the result cache stored in ``cache`` under the URL path ``prefix``.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, address, cache, prefix=""):
+    http.server.ThreadingHTTPServer.__init__(
+        self, address, CacheRequestHandler)
+    self.cache = cache
+    self.prefix = prefix.rstrip("/")
+    self.trim_lock = threading.Lock()
+    self.last_trim = 0
+
+  def maybe_trim(self):
+    """
+    Trim the cache if it hasn't been trimmed recently
+    """
+    if time.time() - self.last_trim < TRIM_INTERVAL:
+      return
+    if not self.trim_lock.acquire(False):
+      return
+    try:
+      self.last_trim = time.time()
+      self.cache.trim()
+    finally:
+      self.trim_lock.release()
+
+
+def setup_argparser(parser):
+  parser.add_argument("--host", default="localhost")
+  parser.add_argument("--port", type=int, default=8090)
+  parser.add_argument("--prefix", default="",
+                      help="URL path under which the cache is served")
+  parser.add_argument("--cache-dir", required=True)
+  parser.add_argument("--max-size", type=int, default=10240,
+                      help="Maximum size of the cache, in MiB")
+  parser.add_argument(
+      "-l", "--log-level", default="info",
+      choices=["debug", "info", "warning", "error"])
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  setup_argparser(parser)
+  args = parser.parse_args()
+  logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+  cache = resultcache.ResultCache(args.cache_dir, args.max_size * 1024 * 1024)
+  server = CacheServer((args.host, args.port), cache, args.prefix)
+  logger.info("Serving %s on %s:%d", args.cache_dir, args.host,
+              server.server_address[1])
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
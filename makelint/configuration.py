@@ -1,13 +1,18 @@
 from __future__ import unicode_literals
 
+import hashlib
 import inspect
 import logging
 import multiprocessing
 import os
 import re
+import shutil
 import subprocess
 import sys
 
+from makelint import remotecache
+from makelint import resultcache
+
 logger = logging.getLogger()
 
 REGEX_TYPE = type(re.compile(""))
@@ -89,6 +94,173 @@ def get_default(value, default):
   return value
 
 
+REGEX_METACHARS = frozenset(".^$*+?{}[]|()")
+BACKREF_PATTERN = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def get_literal(source):
+  """
+  If the regular expression ``source`` matches only a single literal string,
+  return that string (with escapes removed). Otherwise return None.
+  """
+  chars = []
+  idx = 0
+  while idx < len(source):
+    char = source[idx]
+    if char == "\\":
+      if idx + 1 >= len(source) or source[idx + 1].isalnum():
+        # e.g. \d, \w, \A, \1
+        return None
+      chars.append(source[idx + 1])
+      idx += 2
+      continue
+    if char in REGEX_METACHARS:
+      return None
+    chars.append(char)
+    idx += 1
+  return "".join(chars)
+
+
+class PatternMatcher(object):
+  """
+  Compiled form of a list of regular expressions. ``match(path)`` is
+  equivalent to ``any(pattern.match(path) for pattern in patterns)`` but
+  patterns are sorted into the cheapest test that implements them:
+
+  * ``L`` or ``L.*`` (for a literal ``L``) is a prefix test
+  * ``L$`` is an exact test (hash-set lookup)
+  * ``.*L$`` is a suffix test
+  * ``.*L`` or ``.*L.*`` is a substring test
+  * everything else is joined into a single alternation regex
+
+  Note that the patterns are matched against relative paths, which never
+  contain a newline, so the ``$`` and ``.`` corner cases for newlines don't
+  apply.
+  """
+
+  def __init__(self, patterns, exact_paths=None):
+    self.exact = set(get_default(exact_paths, []))
+    prefixes = []
+    suffixes = []
+    self.substrings = []
+
+    regex_patterns = []
+    for pattern in patterns:
+      if isinstance(pattern, REGEX_TYPE):
+        source = pattern.pattern
+        flags = pattern.flags
+      else:
+        source = pattern
+        flags = 0
+
+      if flags & (re.IGNORECASE | re.VERBOSE):
+        regex_patterns.append((source, flags))
+        continue
+
+      body = source
+      if body.startswith("^"):
+        body = body[1:]
+      anchored = False
+      if body.endswith("$") and not body.endswith("\\$"):
+        body = body[:-1]
+        anchored = True
+      elif body.endswith(".*") and not body.endswith("\\.*"):
+        body = body[:-2]
+
+      if body.startswith(".*"):
+        literal = get_literal(body[2:])
+        if literal is not None:
+          if anchored:
+            suffixes.append(literal)
+          else:
+            self.substrings.append(literal)
+          continue
+      else:
+        literal = get_literal(body)
+        if literal is not None:
+          if anchored:
+            self.exact.add(literal)
+          else:
+            prefixes.append(literal)
+          continue
+
+      regex_patterns.append((source, flags))
+
+    self.prefixes = tuple(prefixes)
+    self.suffixes = tuple(suffixes)
+    self.regexes = self.compile_alternations(regex_patterns)
+
+  @staticmethod
+  def compile_alternations(regex_patterns):
+    """
+    Join patterns with the same flags into a single alternation. Patterns
+    which can't be safely joined (backreferences, or a failure to compile
+    the joined expression) are kept on their own.
+    """
+    groups = {}
+    singles = []
+    for source, flags in regex_patterns:
+      if BACKREF_PATTERN.search(source):
+        singles.append(re.compile(source, flags))
+      else:
+        groups.setdefault(flags, []).append(source)
+
+    regexes = []
+    for flags, sources in sorted(groups.items()):
+      if len(sources) == 1:
+        regexes.append(re.compile(sources[0], flags))
+        continue
+      try:
+        regexes.append(re.compile(
+            "|".join("(?:{})".format(source) for source in sources), flags))
+      except re.error:
+        regexes.extend(re.compile(source, flags) for source in sources)
+    return regexes + singles
+
+  def match(self, path):
+    """
+    Return true if any of the patterns match the path
+    """
+    if path in self.exact:
+      return True
+    if self.prefixes and path.startswith(self.prefixes):
+      return True
+    if self.suffixes and path.endswith(self.suffixes):
+      return True
+    for substring in self.substrings:
+      if substring in path:
+        return True
+    for regex in self.regexes:
+      if regex.match(path):
+        return True
+    return False
+
+  __call__ = match
+
+
+class PathFilter(object):
+  """
+  Combines the inclusion and exclusion filters applied during discovery.
+  """
+
+  def __init__(self, include_patterns, exclude_patterns, whitelist=None):
+    self.include = PatternMatcher(include_patterns)
+    self.exclude = PatternMatcher(exclude_patterns, whitelist)
+
+  def excludes(self, relpath):
+    """
+    Return true if the file or directory at relpath is excluded
+    """
+    return self.exclude.match(relpath)
+
+  def includes_file(self, relpath):
+    """
+    Return true if the file at relpath should be tracked
+    """
+    return (not self.exclude.match(relpath)
+            and self.include.match(relpath))
+
+
 class SimpleTool(object):
   """
   Simple implementation of the tool API that works for commands which
@@ -104,12 +276,272 @@ class SimpleTool(object):
   def get_stamp(self, target_cwd, filename):
     return os.path.join(target_cwd, filename + "." + self.name)
 
-  def execute(self, source_tree, source_relpath, env, outfile):
-    cmd = [self.name, source_relpath]
+  def get_command(self, source_relpath):
     if self.name == "pylint":
-      cmd = [self.name, "--output-format=text", source_relpath]
+      return [self.name, "--output-format=text", source_relpath]
+    return [self.name, source_relpath]
+
+  def get_cache_key(self, source_tree, env):
+    """
+    Return a JSON-serializable description of this tool and it's
+    configuration, for use in the key of the shared result cache. This
+    includes the executable that would be run (and it's size and mtime) and
+    the content of any config files the tool would read from the source tree.
+    Tools that don't implement this method are not cached.
+    """
+    executable = shutil.which(self.name, path=env.get("PATH", None))
+    exe_stat = None
+    if executable is not None:
+      executable = os.path.realpath(executable)
+      stat = os.stat(executable)
+      exe_stat = [stat.st_size, stat.st_mtime_ns]
+
+    config_digests = {}
+    for filename in TOOL_CONFIG_FILES.get(self.name, []):
+      config_path = os.path.join(source_tree, filename)
+      if os.path.exists(config_path):
+        with open(config_path, "rb") as infile:
+          config_digests[filename] = hashlib.sha1(infile.read()).hexdigest()
+
+    return {
+        "command": self.get_command("{}"),
+        "executable": executable,
+        "executable_stat": exe_stat,
+        "config": config_digests,
+    }
+
+  def execute(self, source_tree, source_relpath, env, outfile):
     return subprocess.call(
-        cmd, cwd=source_tree, env=env, stdout=outfile)
+        self.get_command(source_relpath), cwd=source_tree, env=env,
+        stdout=outfile)
+
+
+# Commands for the tools which `BatchTool` knows how to run on several files
+# at once. Every line of output must start with the path of the file it
+# refers to, every problem with a file must be reported (a file with no
+# output passes), and the result for a file must not depend on which other
+# files share it's batch (it is stamped and cached per file). So pylint's
+# checks across modules are disabled: cyclic-import depends on the modules in
+# the batch and duplicate-code reports ranges of several files at once.
+BATCH_COMMANDS = {
+    "flake8": ["flake8"],
+    "pylint": ["pylint", "--output-format=text", "--score=n",
+               "--disable=cyclic-import,duplicate-code",
+               "--msg-template={path}:{line}:{column}: {msg_id}: {msg} "
+               "({symbol})"],
+}
+
+# Lines of tool output which don't refer to any file
+BATCH_IGNORE_PREFIXES = (b"************* Module ",)
+
+
+def split_batch_output(source_relpaths, returncode, output):
+  """
+  Split the output of a tool that was run on all of ``source_relpaths`` at
+  once into a dictionary mapping each relpath to ``(returncode, log)``. Each
+  line of output is assigned to the file that it starts with, and a file
+  fails if the tool failed and there is any output for it. Returns None if
+  any line can't be assigned to a file, or if the tool failed without
+  reporting anything about any file (e.g. it crashed).
+  """
+  lines = {relpath: [] for relpath in source_relpaths}
+  for line in output.splitlines(True):
+    if not line.strip() or line.startswith(BATCH_IGNORE_PREFIXES):
+      continue
+    path = line.split(b":", 1)[0].decode("utf-8", "surrogateescape")
+    relpath = os.path.normpath(path)
+    if relpath not in lines:
+      return None
+    lines[relpath].append(line)
+
+  if returncode != 0 and not any(lines.values()):
+    return None
+  return {relpath: (returncode if content else 0, b"".join(content))
+          for relpath, content in lines.items()}
+
+
+class BatchTool(SimpleTool):
+  """
+  Implementation of the tool API for commands which accept any number of
+  files, and which prefix each diagnostic with the path of the file it is
+  about (e.g. flake8, or pylint with a message template). Files are checked
+  ``batch_size`` at a time in a single process, so the cost of starting the
+  tool is paid once per batch rather than once per file. The output is split
+  back up into a result for each file. If it can't be (e.g. the tool crashed
+  or reported something that isn't about one file), each file of the batch is
+  checked on it's own instead.
+
+  The command for a tool in ``BATCH_COMMANDS`` is known. Any other tool must
+  be given it's ``command`` explicitly, which asserts that it's output has
+  that format. Otherwise a tool which only reads it's first argument would
+  appear to pass every other file of the batch, so it is checked one file at
+  a time.
+  """
+
+  def __init__(self, name, batch_size=32, command=None):
+    super(BatchTool, self).__init__(name)
+    if command is None:
+      command = BATCH_COMMANDS.get(name)
+    if command is None:
+      logger.warning(
+          "Output format of %s is unknown, it will not be batched", name)
+      command = [name]
+      batch_size = 1
+    self.command = list(command)
+    self.batch_size = batch_size
+
+  def get_command(self, source_relpath):
+    return self.get_batch_command([source_relpath])
+
+  def get_batch_command(self, source_relpaths):
+    return self.command + list(source_relpaths)
+
+  def execute_batch(self, source_tree, source_relpaths, env):
+    """
+    Execute the tool on all of the files at ``source_relpaths`` and return
+    a dictionary mapping each relpath to ``(returncode, log)``.
+    """
+    proc = subprocess.Popen(
+        self.get_batch_command(source_relpaths), cwd=source_tree, env=env,
+        stdout=subprocess.PIPE)
+    output, _ = proc.communicate()
+    results = split_batch_output(source_relpaths, proc.returncode, output)
+    if results is not None:
+      return results
+
+    logger.debug("Can't split output of %s, checking %d files one at a time",
+                 self.name, len(source_relpaths))
+    results = {}
+    for source_relpath in source_relpaths:
+      proc = subprocess.Popen(
+          self.get_command(source_relpath), cwd=source_tree, env=env,
+          stdout=subprocess.PIPE)
+      output, _ = proc.communicate()
+      results[source_relpath] = (proc.returncode, output)
+    return results
+
+
+# Tools which `WorkerTool` can load as a library, see `makelint.lint_worker`
+WORKER_TOOLS = ("flake8", "pylint")
+
+
+def get_script_interpreter(executable, env):
+  """
+  Return the path of the interpreter named by the ``#!`` line of the script
+  at ``executable``, or None if it isn't a script.
+  """
+  try:
+    with open(executable, "rb") as infile:
+      line = infile.readline()
+  except (IOError, OSError):
+    return None
+  if not line.startswith(b"#!"):
+    return None
+  parts = line[2:].decode("utf-8", "replace").split()
+  if not parts:
+    return None
+  if os.path.basename(parts[0]) == "env" and len(parts) > 1:
+    return shutil.which(parts[1], path=env.get("PATH", None))
+  return parts[0]
+
+
+def get_interpreter_prefix(interpreter, env):
+  """
+  Return ``sys.prefix`` of the interpreter at the given path (i.e. it's
+  virtualenv, if it is in one), or None if it can't be run.
+  """
+  try:
+    output = subprocess.check_output(
+        [interpreter, "-c", "import sys; print(sys.prefix)"], env=env,
+        stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return output.decode("utf-8").strip()
+
+
+class WorkerTool(SimpleTool):
+  """
+  Implementation of the tool API for pylint and flake8 which loads them as
+  libraries in a pool of long-lived worker processes (see
+  `makelint.tool_pool`), and sends them one file at a time. The output is the
+  same as that of the command. Workers are replaced after ``max_files`` files
+  or once they use more than ``max_memory`` MiB.
+
+  If the command that `SimpleTool` would run isn't a script for this
+  interpreter (e.g. ``env`` selects a different virtualenv), or the tool can't
+  be imported, files are checked by running the command as usual.
+  """
+
+  def __init__(self, name, max_files=256, max_memory=1024):
+    super(WorkerTool, self).__init__(name)
+    self.max_files = max_files
+    self.max_memory = max_memory
+    self.pool = None
+
+  def can_load(self, env):
+    """
+    Return true if the tool that would be executed in ``env`` is the one that
+    this interpreter would import.
+    """
+    executable = shutil.which(self.name, path=env.get("PATH", None))
+    if executable is None:
+      # NOTE(josh): the command would fail, so the workers must not succeed
+      return False
+    interpreter = get_script_interpreter(executable, env)
+    if interpreter is None:
+      return False
+    if os.path.abspath(interpreter) == os.path.abspath(sys.executable):
+      return True
+    # NOTE(josh): don't resolve symlinks, the python of a virtualenv is
+    # usually a link to the base interpreter, which imports other packages
+    return get_interpreter_prefix(interpreter, env) == sys.prefix
+
+  def start_workers(self, source_tree, env, njobs):
+    """
+    Start the worker pool. Returns false if files can't be checked
+    in-process, in which case `execute()` runs the command.
+    """
+    from makelint import tool_pool
+
+    if not self.can_load(env):
+      logger.info("%s on PATH doesn't run under %s, not using workers",
+                  self.name, sys.executable)
+      return False
+
+    pool = tool_pool.LintPool(self.name, source_tree, env, njobs,
+                              self.max_files, self.max_memory)
+    try:
+      pool.start()
+    except tool_pool.WorkerUnavailable as ex:
+      logger.info("Can't load %s in-process (%s), not using workers",
+                  self.name, ex)
+      return False
+    self.pool = pool
+    return True
+
+  def stop_workers(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool = None
+
+  def execute(self, source_tree, source_relpath, env, outfile):
+    result = None
+    if self.pool is not None:
+      result = self.pool.execute(source_relpath)
+    if result is None:
+      return super(WorkerTool, self).execute(
+          source_tree, source_relpath, env, outfile)
+    returncode, output = result
+    outfile.write(output)
+    return returncode
+
+
+# Config files (relative to the source tree) read by well known tools. Their
+# content is part of the result cache key.
+TOOL_CONFIG_FILES = {
+    "flake8": [".flake8", "setup.cfg", "tox.ini"],
+    "pylint": ["pylintrc", ".pylintrc", "pyproject.toml", "setup.cfg"],
+}
 
 
 class Configuration(ConfigObject):
@@ -117,19 +549,37 @@ class Configuration(ConfigObject):
   Encapsulates various configuration options/parameters
   """
 
-  # pylint: disable=R0913
+  # pylint: disable=too-many-instance-attributes
+
+  # pylint: disable=R0913,R0914
   def __init__(
       self,
       include_patterns=None,
       exclude_patterns=None,
+      whitelist=None,
       source_tree=None,
       target_tree=None,
+      discovery="walk",
+      digest_algorithm="sha1",
+      depmap_engine="pool",
+      depmap_preload=None,
+      external_dependencies="path",
       tools=None,
+      tool_batch_size=1,
+      tool_workers=False,
+      tool_worker_max_files=256,
+      tool_worker_max_memory=1024,
       env=None,
       fail_fast=False,
+      job_order=None,
       merge_log=None,
       quiet=False,
       jobs=None,
+      pipeline=False,
+      jobserver=True,
+      result_cache_dir=None,
+      result_cache_size=1024,
+      remote_cache_url=None,
       **extra):
 
     self.include_patterns = [
@@ -140,19 +590,40 @@ class Configuration(ConfigObject):
         re.compile(pattern) for pattern in
         get_default(exclude_patterns, [])
     ]
+    self.whitelist = get_default(whitelist, [])
     self.source_tree = source_tree
     self.target_tree = get_default(target_tree, os.getcwd())
+    self.discovery = discovery
+    self.digest_algorithm = digest_algorithm
+    self.depmap_engine = depmap_engine
+    self.depmap_preload = get_default(depmap_preload, [])
+    self.external_dependencies = external_dependencies
+    self.tool_batch_size = tool_batch_size
+    self.tool_workers = tool_workers
+    self.tool_worker_max_files = tool_worker_max_files
+    self.tool_worker_max_memory = tool_worker_max_memory
     self.tools = []
     for tool in get_default(tools, ["flake8", "pylint"]):
-      if isinstance(tool, str):
+      if tool_workers and tool in WORKER_TOOLS:
+        self.tools.append(WorkerTool(
+            tool, tool_worker_max_files, tool_worker_max_memory))
+      elif tool in BATCH_COMMANDS and tool_batch_size > 1:
+        self.tools.append(BatchTool(tool, tool_batch_size))
+      elif isinstance(tool, str):
         self.tools.append(SimpleTool(tool))
       else:
         self.tools.append(tool)
     self.env = get_default(env, os.environ.copy())
     self.fail_fast = fail_fast
+    self.job_order = get_default(job_order, ["failed", "longest"])
     self.merge_log = merge_log
     self.quiet = quiet
     self.jobs = get_default(jobs, multiprocessing.cpu_count())
+    self.pipeline = pipeline
+    self.jobserver = jobserver
+    self.result_cache_dir = result_cache_dir
+    self.result_cache_size = result_cache_size
+    self.remote_cache_url = remote_cache_url
 
     extra_keys = []
     for key in extra:
@@ -167,6 +638,32 @@ class Configuration(ConfigObject):
           "Unused config file options: %s", ", ".join(sorted(extra_keys))
       )
 
+  def get_path_filter(self):
+    """
+    Return a `PathFilter` for the configured patterns.
+    """
+    return PathFilter(
+        self.include_patterns, self.exclude_patterns, self.whitelist)
+
+  def get_result_cache(self):
+    """
+    Return a `ResultCache` for the configured cache directory, or None if
+    result caching is disabled.
+    """
+    if not self.result_cache_dir:
+      return None
+    return resultcache.ResultCache(
+        os.path.expanduser(self.result_cache_dir),
+        self.result_cache_size * 1024 * 1024)
+
+  def get_remote_cache(self):
+    """
+    Return a `RemoteCache` for the configured URL, or None if there isn't one.
+    """
+    if not self.remote_cache_url:
+      return None
+    return remotecache.RemoteCache(self.remote_cache_url)
+
   def clone(self):
     """
     Return a copy of self.
@@ -174,7 +671,13 @@ class Configuration(ConfigObject):
     return Configuration(**self.as_dict())
 
 
-VARCHOICES = {}
+VARCHOICES = {
+    "discovery": ["walk", "parallel", "git"],
+    "digest_algorithm": ["sha1", "blake2b", "xxh64", "xxh3_128"],
+    "depmap_engine": ["exec", "pool", "static"],
+    "external_dependencies": ["path", "fingerprint"],
+    "job_order": ["failed", "recent", "longest"],
+}
 
 VARDOCS = {
     "include_patterns": """
@@ -189,18 +692,90 @@ files during the directory walk. They are matched against relative
 paths of files (relative to the root of the search). If the pattern matches
 a directory the whole directory is skipped. If it matches an individual file
 then that file is skipped.
+""",
+    "whitelist": """
+A list of exact relative paths of files which are exempt from linting (e.g.
+legacy files that are not yet clean). This has the same effect as listing
+each file in exclude_patterns, but is checked with a single set lookup so it
+stays cheap for long lists.
 """,
     "source_tree": """
 The root of the search tree for inclusion.
 """,
     "target_tree": """
 The root of the tree where the outputs are written.
+""",
+    "discovery": """
+How to discover the files in the source tree. "walk" visits directories one
+at a time. "parallel" fans out the directory scans across a pool of `jobs`
+threads, which is much faster on network filesystems where each stat is a
+round trip. "git" reads the list of tracked files directly from the git
+index of the checkout, so the filesystem isn't walked at all. Untracked files
+are ignored in "git" mode.
+""",
+    "digest_algorithm": """
+The hash used to digest file content. Which of "sha1" and "blake2b" is
+cheaper depends on the machine (many recent CPUs accelerate sha1 in hardware).
+"xxh64" and "xxh3_128" are non-cryptographic hashes which are much cheaper
+than either, but they require the `xxhash` package. Changing the algorithm
+discards all of the digests and dependency maps in the target tree, so the
+next run is a clean rebuild.
+""",
+    "depmap_engine": """
+How to map the dependencies of each file. "exec" executes each file in a new
+interpreter. "pool" executes each file in a child forked from one of a pool
+of long-lived worker interpreters, which avoids paying for interpreter
+startup on every file. The output is the same either way. "static" parses
+each file and resolves it's imports without executing anything, which is
+faster still, but can't see dynamic imports outside of the source tree. Files
+which can't be resolved statically (e.g. they import something dynamically)
+are executed as with "exec".
+""",
+    "depmap_preload": """
+A list of modules for the "pool" depmap workers to import when they start
+(e.g. ["numpy", "scipy"]). Files which import them then don't pay for
+importing them again. This should only list modules outside of the source
+tree, since the workers are not restarted when the source tree changes.
+""",
+    "external_dependencies": """
+How to record dependencies outside of the source tree. "path" lists every
+file, and each one is checked for modification on every run. "fingerprint"
+replaces the files from the standard library and from installed distributions
+with a fingerprint of the interpreter and of each distribution (it's name,
+version and RECORD), so the dependency maps are much smaller and the check is
+a handful of comparisons per run.
 """,
     "tools": """
 A list of tools to execute. The default is ["pylint", "flake8"]. This can
 either be a string (a simple command which takes one argument), or it can
 be an object with a get_stamp() and an execute() method. See SimpleTool for
-ane example.
+ane example. Tools which also have an execute_batch() method are given groups
+of files at a time, see BatchTool.
+""",
+    "tool_batch_size": """
+If greater than one, the tools which are given by name and whose output
+format is known (flake8 and pylint) are executed on up to this many files at
+a time (see BatchTool), and their output is split back up into a result for
+each file. Other tools are still executed one file at a time. This saves the
+cost of starting the tool for every file, which for flake8 is most of the
+cost of checking a file. Pylint's checks across modules (cyclic-import and
+duplicate-code) are disabled, since their result would depend on which files
+share a batch.
+""",
+    "tool_workers": """
+If true, "pylint" and "flake8" are loaded as libraries in a pool of
+long-lived worker processes which check one file at a time (see WorkerTool),
+so imports, and pylint's inference of shared dependencies, are done once per
+worker rather than once per file. This takes precedence over tool_batch_size
+for those tools. If the tool on the PATH of `env` doesn't run under the same
+interpreter (or virtualenv) as makelint, or isn't on the PATH at all, the
+command is run as usual.
+""",
+    "tool_worker_max_files": """
+Each tool worker is replaced after checking this many files.
+""",
+    "tool_worker_max_memory": """
+Each tool worker is replaced once it's resident set size exceeds this many MiB.
 """,
     "env": """
 A dictionary specifying the environment to use for the tools. Add your
@@ -209,6 +784,17 @@ virtualenv configurations here.
     "fail_fast": """
 If true, exit on the first failure, don't keep going. Useful if you want a
 speedy CI gate.
+""",
+    "job_order": """
+The order in which stale tool jobs are launched, as a list of: "failed" (files
+whose last run of the tool failed go first), "recent" (the most recently
+modified files go first) and "longest" (the jobs which are expected to take
+the longest, according to the recorded history, go first). Later items only
+break ties of earlier ones, and remaining ties are launched in tree order.
+The default, ["failed", "longest"], finds an error that hasn't been fixed
+early (and, with fail_fast, stops there) and keeps a long job from starting
+last. Use ["failed", "recent"] to check what was just edited first, or []
+for tree order.
 """,
     "merge_log": """
 If specified, output logs for failed jobs will be merged into a single file
@@ -219,5 +805,40 @@ Don't print fancy progress bars to stdout.
 """,
     "jobs": """
 Number of parallel jobs to execute.
-"""
+""",
+    "pipeline": """
+If true, files flow through the phases one at a time rather than each phase
+finishing for the whole tree before the next one starts: each file is
+digested as soon as it is discovered, it's dependency map is checked as soon
+as the files it depends on are digested, and the tools are executed on it as
+soon as it's dependency map is up to date. This overlaps the filesystem walk
+and hashing with mapping and linting, which mostly helps cold runs of large
+trees. Tool jobs are executed one file at a time, on threads, in this mode.
+Ignored with --watch.
+""",
+    "jobserver": """
+If true, and makelint is run by a parallel GNU make (``make -jN``) which
+passes it's jobserver in MAKEFLAGS, then every job holds one of make's job
+slots, so that makelint and the rest of the build together run at most N
+jobs. ``jobs`` still caps the number of jobs of makelint. The recipe must be
+marked as recursive (e.g. prefixed with ``+``) for make to pass the jobserver.
+Ignored with --watch.
+""",
+    "result_cache_dir": """
+If specified, tool results are stored in (and retrieved from) a content
+addressed cache in this directory. The cache can be shared by any number of
+target trees, e.g. for different worktrees or checkouts of the same
+repository. A result is reused if the content of the file and all of it's
+dependencies, the tool, and the tool's config files are unchanged.
+""",
+    "result_cache_size": """
+Maximum size of the result cache, in MiB. Least recently used results are
+evicted once it grows beyond this.
+""",
+    "remote_cache_url": """
+If specified, tool results are also shared through the remote cache server at
+this URL (e.g. "http://lintcache.example.com:8090"). Any error talking to the
+server disables it for the rest of the run. See `makelint.cache_server` for a
+reference server.
+""",
 }
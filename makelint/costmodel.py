@@ -0,0 +1,274 @@
+"""
+Persistent history of how long each job took. For every (step, file) pair,
+where the step is "depmap" or the name of a tool, we record the wall time of
+the last execution and the size of the source file at that time. Stale jobs
+are then launched longest first, which keeps a long job (e.g. pylint on a
+5000 line module) from starting last and holding up the end of the run while
+every other slot is idle. Files without any history are estimated from their
+size, at the average rate (seconds per byte) of the step.
+
+Each phase also logs a report (at info level) of the critical path of the
+schedule it predicted from these estimates, and of the one it actually got.
+
+Layout (all integers little-endian)::
+
+  header: magic (8 bytes), format version (u32), number of records (u32)
+  record: seconds (f64), size (i64), step (string), relpath (string)
+  string: length (u16), utf-8 bytes
+"""
+
+import bisect
+import collections
+import heapq
+import logging
+import os
+import struct
+
+from makelint.manifest import pack_string, unpack_string, write_atomic
+
+logger = logging.getLogger()
+
+COSTMODEL_FILENAME = "costmodel.bin"
+
+MAGIC = b"MKLINTCM"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<8sII")
+RECORD_HEAD = struct.Struct("<dq")
+
+# Seconds per byte of source, for steps that have no history at all
+DEFAULT_RATE = 1e-5
+
+# Number of jobs of a critical path to list in the report
+REPORT_LENGTH = 5
+
+CostRecord = collections.namedtuple("CostRecord", ["seconds", "size"])
+
+
+class CostModel(object):
+  """
+  In-memory view of the job history for one target tree, keyed by
+  ``(step, relpath)``.
+  """
+
+  def __init__(self, target_tree):
+    self.target_tree = target_tree
+    self.records = {}
+    self.dirty = False
+
+    # Average seconds per byte of each step, computed on demand
+    self.rates = {}
+
+    # Size of each file as of the last estimate, for the next record
+    self.sizes = {}
+
+  @property
+  def filepath(self):
+    return os.path.join(self.target_tree, COSTMODEL_FILENAME)
+
+  @classmethod
+  def load(cls, target_tree):
+    """
+    Read the history for the given target tree. If it does not exist or
+    cannot be read, return an empty history.
+    """
+    model = cls(target_tree)
+    try:
+      with open(model.filepath, "rb") as infile:
+        content = infile.read()
+    except (IOError, OSError):
+      return model
+
+    try:
+      model.parse(content)
+    except (ValueError, struct.error, UnicodeDecodeError):
+      logger.warning("Discarding unreadable cost model %s", model.filepath)
+      model.records = {}
+    return model
+
+  def parse(self, content):
+    """
+    Parse the serialized history
+    """
+    buf = memoryview(content)
+    magic, version, nrecords = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise ValueError("Unrecognized cost model header")
+    offset = HEADER.size
+
+    records = {}
+    for _ in range(nrecords):
+      seconds, size = RECORD_HEAD.unpack_from(buf, offset)
+      offset += RECORD_HEAD.size
+      step, offset = unpack_string(buf, offset)
+      relpath, offset = unpack_string(buf, offset)
+      records[(step, relpath)] = CostRecord(seconds, size)
+    self.records = records
+
+  def get_rate(self, step):
+    """
+    Return the average seconds per byte of source over the history of
+    ``step``, or of every step if it has no history.
+    """
+    rate = self.rates.get(step)
+    if rate is not None:
+      return rate
+
+    totals = collections.defaultdict(lambda: [0.0, 0])
+    for (record_step, _), record in self.records.items():
+      for key in (record_step, None):
+        totals[key][0] += record.seconds
+        totals[key][1] += record.size
+    for key, (seconds, size) in totals.items():
+      if size:
+        self.rates[key] = seconds / size
+    rate = self.rates.get(step, self.rates.get(None, DEFAULT_RATE))
+    self.rates[step] = rate
+    return rate
+
+  def estimate(self, step, relpath, size):
+    """
+    Return the expected seconds for ``step`` on the file at relpath, which is
+    currently ``size`` bytes.
+    """
+    self.sizes[relpath] = size
+    record = self.records.get((step, relpath))
+    if record is not None:
+      return record.seconds
+    return size * self.get_rate(step)
+
+  def record(self, step, relpath, seconds, size=None):
+    """
+    Store the wall time of the last execution of ``step`` on the file at
+    relpath, which was ``size`` bytes (by default, the size given to the last
+    `estimate()`).
+    """
+    if size is None:
+      size = self.sizes.get(relpath, 0)
+    self.records[(step, relpath)] = CostRecord(seconds, size)
+    self.rates.clear()
+    self.dirty = True
+
+  def retain(self, relpaths):
+    """
+    Drop records for any files not in ``relpaths``
+    """
+    relpaths = set(relpaths)
+    removed = [key for key in self.records if key[1] not in relpaths]
+    for key in removed:
+      del self.records[key]
+    if removed:
+      self.rates.clear()
+      self.dirty = True
+
+  def save(self):
+    """
+    Write the history to disk, if it has changed. The new content is written
+    to a temporary file which then atomically replaces the old history.
+    """
+    if not self.dirty:
+      return
+
+    with write_atomic(self.filepath) as outfile:
+      outfile.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(self.records)))
+      for step, relpath in sorted(self.records):
+        record = self.records[(step, relpath)]
+        outfile.write(RECORD_HEAD.pack(record.seconds, record.size))
+        outfile.write(pack_string(step))
+        outfile.write(pack_string(relpath))
+    self.dirty = False
+
+
+def get_size(source_path, memo):
+  """
+  Return the size of the file at source_path, or 0 if it can't be stat'ed.
+  """
+  stat = memo.stat(source_path)
+  if stat is None:
+    return 0
+  return stat.st_size
+
+
+def get_critical_path(jobs, predecessors):
+  """
+  Return the jobs on the path which ends with the last job to finish, in
+  order, given the finish time (second element) of each job and the index of
+  the job which each one followed on it's slot (or None).
+  """
+  if not jobs:
+    return []
+  idx = max(range(len(jobs)), key=lambda idx: jobs[idx][1])
+  path = []
+  while idx is not None:
+    path.append(jobs[idx])
+    idx = predecessors[idx]
+  path.reverse()
+  return path
+
+
+class ScheduleTrace(object):
+  """
+  The predicted and actual durations of the jobs of one phase, in the order
+  that they were launched on ``njobs`` slots.
+  """
+
+  def __init__(self, njobs):
+    self.njobs = max(njobs, 1)
+    self.jobs = []
+
+  def add(self, label, predicted, start, end):
+    """
+    Add a job which ran from ``start`` to ``end`` (``time.time()``), and was
+    predicted to take ``predicted`` seconds.
+    """
+    self.jobs.append((label, predicted, start, end))
+
+  def get_predicted_path(self):
+    """
+    Simulate launching the jobs, in order, on the first free slot, with their
+    predicted durations. Return the critical path as a list of ``(label,
+    finish time, duration)``.
+    """
+    slots = [(0.0, idx, None) for idx in range(self.njobs)]
+    jobs = []
+    predecessors = []
+    for label, predicted, _, _ in self.jobs:
+      start, slot, previous = heapq.heappop(slots)
+      jobs.append((label, start + predicted, predicted))
+      predecessors.append(previous)
+      heapq.heappush(slots, (start + predicted, slot, len(jobs) - 1))
+    return get_critical_path(jobs, predecessors)
+
+  def get_actual_path(self):
+    """
+    Return the critical path of the schedule that actually ran. Each job is
+    assumed to have taken the slot of the latest job that finished before it
+    started. Return the critical path as for `get_predicted_path()`.
+    """
+    if not self.jobs:
+      return []
+    origin = min(start for _, _, start, _ in self.jobs)
+    jobs = [(label, end - origin, end - start)
+            for label, _, start, end in self.jobs]
+    order = sorted(range(len(jobs)), key=lambda idx: jobs[idx][1])
+    finishes = [jobs[idx][1] for idx in order]
+    predecessors = []
+    for _, _, start, _ in self.jobs:
+      count = bisect.bisect_right(finishes, start - origin)
+      predecessors.append(order[count - 1] if count else None)
+    return get_critical_path(jobs, predecessors)
+
+  def report(self, phase):
+    """
+    Log the predicted and the actual critical path, at info level.
+    """
+    if not self.jobs:
+      return
+    for kind, path in (("predicted", self.get_predicted_path()),
+                       ("actual", self.get_actual_path())):
+      labels = ["{} {:.2f}s".format(label, seconds)
+                for label, _, seconds in path[:REPORT_LENGTH]]
+      if len(path) > REPORT_LENGTH:
+        labels.append("... {} more".format(len(path) - REPORT_LENGTH))
+      logger.info("%s: %s critical path %.2fs over %d jobs: %s", phase, kind,
+                  path[-1][1], len(path), ", ".join(labels))
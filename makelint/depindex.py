@@ -0,0 +1,319 @@
+"""
+Persistent reverse dependency index. For every path listed in a dependency
+map it records the files whose dependency maps list it, along with the digest
+(for tracked files) or the modification time (for everything else) of that
+path when it was last checked. Finding the dependency maps that are out of
+date is then a matter of checking each distinct dependency once and looking
+up it's dependents, rather than reading every dependency map and checking
+every dependency of every file.
+
+Paths are interned: each distinct path is stored once and everything else
+refers to it by it's index in the path table.
+
+Layout (all integers little-endian)::
+
+  header: magic (8 bytes), format version (u32), number of paths (u32)
+  path:   flags (u32), mtime_ns (i64), number of dependencies (u32),
+          number of dependents (u32), path (string), digest (string),
+          dependencies (u32 path index each), dependents (u32 path index each)
+  string: length (u16), utf-8 bytes
+
+The dependencies of a path are only present if it is a source file with a
+dependency map (flag ``INDEXED``). A file whose dependency map is known to be
+out of date, but which was outside the scope of the run that found it, is
+flagged ``STALE``.
+"""
+
+import array
+import logging
+import os
+import struct
+
+from makelint.depmap import new_id_array, pack_id_array
+from makelint.fingerprints import is_fingerprint
+from makelint.manifest import pack_string, unpack_string, write_atomic
+
+logger = logging.getLogger()
+
+DEPINDEX_FILENAME = "depindex.bin"
+
+MAGIC = b"MKLINTDI"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<8sII")
+PATH_HEAD = struct.Struct("<IqII")
+
+FLAG_INDEXED = 0x01
+FLAG_STALE = 0x02
+
+# mtime recorded for a path which doesn't exist
+MISSING_MTIME = -1
+
+
+def get_mtime_ns(path, memo=None):
+  if memo is not None:
+    stat = memo.stat(path)
+    return MISSING_MTIME if stat is None else stat.st_mtime_ns
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return MISSING_MTIME
+
+
+class DependencyIndex(object):
+  """
+  In-memory view of the reverse dependency index for one target tree.
+  """
+
+  def __init__(self, target_tree):
+    self.target_tree = target_tree
+    self.paths = []
+    self.ids = {}
+    self.flags = []
+    self.digests = []
+    self.mtimes = []
+
+    # Dependencies and dependents of each path, as arrays of path ids. They
+    # are converted to sets when they are modified.
+    self.forward = []
+    self.reverse = []
+    self.dirty = False
+
+  @property
+  def filepath(self):
+    return os.path.join(self.target_tree, DEPINDEX_FILENAME)
+
+  @classmethod
+  def load(cls, target_tree):
+    """
+    Read the index for the given target tree. If it does not exist or cannot
+    be read, return an empty index.
+    """
+    index = cls(target_tree)
+    try:
+      with open(index.filepath, "rb") as infile:
+        content = infile.read()
+    except (IOError, OSError):
+      return index
+
+    try:
+      index.parse(content)
+    except (ValueError, struct.error, UnicodeDecodeError):
+      logger.warning("Discarding unreadable dependency index %s",
+                     index.filepath)
+      index = cls(target_tree)
+    return index
+
+  def parse(self, content):
+    """
+    Parse the serialized index
+    """
+    buf = memoryview(content)
+    magic, version, npaths = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise ValueError("Unrecognized dependency index header")
+    offset = HEADER.size
+
+    for path_id in range(npaths):
+      flags, mtime_ns, nforward, nreverse = PATH_HEAD.unpack_from(buf, offset)
+      offset += PATH_HEAD.size
+      path, offset = unpack_string(buf, offset)
+      digest, offset = unpack_string(buf, offset)
+      forward = new_id_array(buf[offset:offset + 4 * nforward])
+      offset += 4 * nforward
+      reverse = new_id_array(buf[offset:offset + 4 * nreverse])
+      offset += 4 * nreverse
+      if len(forward) != nforward or len(reverse) != nreverse:
+        raise ValueError("Truncated dependency index")
+
+      self.paths.append(path)
+      self.ids[path] = path_id
+      self.flags.append(flags)
+      self.digests.append(digest or None)
+      self.mtimes.append(mtime_ns)
+      self.forward.append(forward)
+      self.reverse.append(reverse)
+
+  def intern(self, path):
+    """
+    Return the id of path, adding it to the table if it isn't there.
+    """
+    path_id = self.ids.get(path)
+    if path_id is None:
+      path_id = len(self.paths)
+      self.paths.append(path)
+      self.ids[path] = path_id
+      self.flags.append(0)
+      self.digests.append(None)
+      self.mtimes.append(MISSING_MTIME)
+      self.forward.append(new_id_array())
+      self.reverse.append(new_id_array())
+    return path_id
+
+  def get_reverse_set(self, path_id):
+    reverse = self.reverse[path_id]
+    if not isinstance(reverse, set):
+      reverse = set(reverse)
+      self.reverse[path_id] = reverse
+    return reverse
+
+  def contains(self, relpath):
+    """
+    Return true if the dependency map of the file at relpath is indexed
+    """
+    path_id = self.ids.get(relpath)
+    return path_id is not None and bool(self.flags[path_id] & FLAG_INDEXED)
+
+  def is_stale(self, relpath):
+    path_id = self.ids.get(relpath)
+    return path_id is not None and bool(self.flags[path_id] & FLAG_STALE)
+
+  def remove(self, relpath):
+    """
+    Remove the dependency map of the file at relpath from the index
+    """
+    path_id = self.ids.get(relpath)
+    if path_id is None or not self.flags[path_id] & FLAG_INDEXED:
+      return
+    for dep_id in self.forward[path_id]:
+      self.get_reverse_set(dep_id).discard(path_id)
+    self.forward[path_id] = new_id_array()
+    self.flags[path_id] &= ~(FLAG_INDEXED | FLAG_STALE)
+    self.dirty = True
+
+  def update(self, relpath, depmap_data, source_tree, memo=None):
+    """
+    Replace the dependency map of the file at relpath with ``depmap_data``
+    (a `DependencyMap`). The digests in the map are
+    recorded as the current digests of the tracked dependencies, and the
+    modification times of the other dependencies are recorded from the
+    filesystem (through ``memo``, a `FileMemo`, if given).
+    """
+    self.remove(relpath)
+    path_id = self.intern(relpath)
+    forward = set()
+    for path, digest in zip(depmap_data.paths, depmap_data.digests):
+      dep_id = self.intern(path)
+      forward.add(dep_id)
+      self.get_reverse_set(dep_id).add(path_id)
+      self.digests[dep_id] = digest
+      if digest is None and not is_fingerprint(path):
+        self.mtimes[dep_id] = get_mtime_ns(
+            os.path.join(source_tree, path), memo)
+    self.forward[path_id] = array.array("I", sorted(forward))
+    self.flags[path_id] |= FLAG_INDEXED
+    self.flags[path_id] &= ~FLAG_STALE
+    self.dirty = True
+
+  def retain(self, relpaths):
+    """
+    Remove the dependency maps of any files not in ``relpaths``
+    """
+    relpaths = set(relpaths)
+    for path_id, path in enumerate(self.paths):
+      if self.flags[path_id] & FLAG_INDEXED and path not in relpaths:
+        self.remove(path)
+
+  def get_dependencies(self, relpath):
+    """
+    Return the list of paths in the indexed dependency map of the file at
+    relpath, along with the digest recorded for each (None for paths which
+    are checked by modification time).
+    """
+    path_id = self.ids.get(relpath)
+    if path_id is None or not self.flags[path_id] & FLAG_INDEXED:
+      return []
+    return [(self.paths[dep_id], self.digests[dep_id])
+            for dep_id in self.forward[path_id]]
+
+  def mark_changed(self, source_tree, get_digest, memo=None, relpaths=None):
+    """
+    Check every path which is listed in some dependency map against it's
+    recorded digest (using ``get_digest(relpath)`` for the current digest) or
+    modification time, and flag the dependents of those that changed as
+    stale. Then record the current state. Modification times are queried
+    through ``memo`` (a `FileMemo`) if given. If ``relpaths`` is given then
+    only those paths are checked.
+    """
+    if relpaths is None:
+      path_ids = range(len(self.paths))
+    else:
+      path_ids = [self.ids[path] for path in relpaths if path in self.ids]
+    for path_id in path_ids:
+      path = self.paths[path_id]
+      if not self.reverse[path_id]:
+        continue
+      if self.digests[path_id] is not None or is_fingerprint(path):
+        digest = get_digest(path)
+        if digest == self.digests[path_id]:
+          continue
+        logger.debug("%s has changed", path)
+        self.digests[path_id] = digest
+        if digest is None and not is_fingerprint(path):
+          self.mtimes[path_id] = get_mtime_ns(
+              os.path.join(source_tree, path), memo)
+      else:
+        mtime_ns = get_mtime_ns(os.path.join(source_tree, path), memo)
+        if mtime_ns == self.mtimes[path_id]:
+          continue
+        logger.debug("%s is newer", path)
+        self.mtimes[path_id] = mtime_ns
+      for dependent_id in self.reverse[path_id]:
+        self.flags[dependent_id] |= FLAG_STALE
+      self.dirty = True
+
+  def get_dependents(self, relpaths):
+    """
+    Return the set of files whose dependency maps list any of relpaths
+    """
+    dependents = set()
+    for relpath in relpaths:
+      path_id = self.ids.get(relpath)
+      if path_id is not None:
+        dependents.update(self.paths[dep_id]
+                          for dep_id in self.reverse[path_id])
+    return dependents
+
+  def compact(self):
+    """
+    Drop paths which are neither indexed nor listed in any dependency map,
+    and renumber the rest.
+    """
+    keep = [path_id for path_id in range(len(self.paths))
+            if self.flags[path_id] & FLAG_INDEXED or self.reverse[path_id]]
+    if len(keep) == len(self.paths):
+      return
+    renumber = {old_id: new_id for new_id, old_id in enumerate(keep)}
+    paths = [self.paths[old_id] for old_id in keep]
+    self.flags = [self.flags[old_id] for old_id in keep]
+    self.digests = [self.digests[old_id] for old_id in keep]
+    self.mtimes = [self.mtimes[old_id] for old_id in keep]
+    self.forward = [[renumber[dep_id] for dep_id in self.forward[old_id]]
+                    for old_id in keep]
+    self.reverse = [[renumber[dep_id] for dep_id in self.reverse[old_id]]
+                    for old_id in keep]
+    self.paths = paths
+    self.ids = {path: path_id for path_id, path in enumerate(paths)}
+
+  def save(self):
+    """
+    Write the index to disk, if it has changed. The new content is written to
+    a temporary file which then atomically replaces the old index.
+    """
+    if not self.dirty:
+      return
+    self.compact()
+
+    with write_atomic(self.filepath) as outfile:
+      outfile.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(self.paths)))
+      for path_id, path in enumerate(self.paths):
+        forward = self.forward[path_id]
+        reverse = sorted(self.reverse[path_id])
+        outfile.write(PATH_HEAD.pack(
+            self.flags[path_id], self.mtimes[path_id], len(forward),
+            len(reverse)))
+        outfile.write(pack_string(path))
+        outfile.write(pack_string(self.digests[path_id] or ""))
+        outfile.write(pack_id_array(forward))
+        outfile.write(pack_id_array(reverse))
+    self.dirty = False
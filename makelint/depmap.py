@@ -0,0 +1,160 @@
+"""
+Storage format of dependency maps. A dependency map lists, for one source
+file, the path, module name and digest (if it is tracked) of every file which
+it depends on. The maps of a tree repeat the same directories over and over,
+so each map stores each distinct directory once, and every dependency refers
+to it's directory by index. All of the strings are stored in a single table,
+which is decoded and split in one call, so loading a map doesn't parse
+anything per dependency.
+
+Layout (all integers little-endian)::
+
+  header:  magic (8 bytes), format version (u32), number of dependencies (u32),
+           number of directories (u32), size of the string table (u32)
+  dirs:    directory index of each dependency (u32 each)
+  strings: utf-8, NUL separated: each directory (including the trailing
+           separator), then the basename, module name and digest of each
+           dependency (an empty digest if it isn't tracked)
+
+Maps written by earlier versions are indented JSON (a list of objects with
+``path``, ``name`` and ``digest`` keys). These can still be read, and
+`makelint.check_depmap_format()` converts all of them once.
+"""
+
+import array
+import json
+import os
+import struct
+import sys
+
+MAGIC = b"MKLINTDP"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<8sIIII")
+
+
+def new_id_array(content=b""):
+  ids = array.array("I")
+  ids.frombytes(content)
+  if sys.byteorder != "little":
+    ids.byteswap()
+  return ids
+
+
+def pack_id_array(ids):
+  ids = array.array("I", ids)
+  if sys.byteorder != "little":
+    ids.byteswap()
+  return ids.tobytes()
+
+
+def split_path(path):
+  """
+  Return (directory, basename) such that ``directory + basename == path``
+  """
+  head, sep, tail = path.rpartition(os.sep)
+  return head + sep, tail
+
+
+class DependencyMap(object):
+  """
+  The dependencies of one source file, as three parallel lists.
+  """
+
+  __slots__ = ("paths", "digests", "names")
+
+  def __init__(self, paths, digests, names):
+    self.paths = paths
+    self.digests = digests
+    self.names = names
+
+  def __len__(self):
+    return len(self.paths)
+
+  @classmethod
+  def from_items(cls, items):
+    """
+    Construct from a list of dictionaries with ``path``, ``digest`` and
+    ``name`` keys (i.e. the output of `get_dependencies.get_dependency_list`
+    or the legacy JSON format).
+    """
+    return cls([item["path"] for item in items],
+               [item["digest"] for item in items],
+               [item.get("name") or "" for item in items])
+
+  @classmethod
+  def parse(cls, content):
+    """
+    Parse the content of a dependency map file, in either format. Raises
+    `ValueError` if it is malformed.
+    """
+    if not content.startswith(MAGIC):
+      return cls.from_items(json.loads(content.decode("utf-8")))
+
+    try:
+      _, version, nitems, ndirs, size = HEADER.unpack_from(content, 0)
+    except struct.error as ex:
+      raise ValueError("Truncated dependency map") from ex
+    if version != FORMAT_VERSION:
+      raise ValueError("Unrecognized dependency map version")
+    offset = HEADER.size
+    dir_ids = new_id_array(content[offset:offset + 4 * nitems])
+    offset += 4 * nitems
+    table = content[offset:offset + size]
+    if len(dir_ids) != nitems or len(table) != size:
+      raise ValueError("Truncated dependency map")
+
+    strings = []
+    if table:
+      strings = table.decode("utf-8", "surrogateescape").split("\0")
+    if len(strings) != ndirs + 3 * nitems:
+      raise ValueError("Malformed dependency map")
+    dirs = strings[:ndirs]
+    try:
+      paths = [dirs[dir_id] + basename for dir_id, basename
+               in zip(dir_ids, strings[ndirs::3])]
+    except IndexError as ex:
+      raise ValueError("Malformed dependency map") from ex
+    return cls(paths, [digest or None for digest in strings[ndirs + 2::3]],
+               strings[ndirs + 1::3])
+
+  @classmethod
+  def load(cls, filepath):
+    with open(filepath, "rb") as infile:
+      return cls.parse(infile.read())
+
+  def pack(self):
+    """
+    Return the serialized form of the map.
+    """
+    dir_ids = {}
+    dirs = []
+    ids = []
+    strings = []
+    for path, digest, name in zip(self.paths, self.digests, self.names):
+      dirname, basename = split_path(path)
+      dir_id = dir_ids.get(dirname)
+      if dir_id is None:
+        dir_id = dir_ids[dirname] = len(dirs)
+        dirs.append(dirname)
+      ids.append(dir_id)
+      strings.extend((basename, name or "", digest or ""))
+    table = "\0".join(dirs + strings).encode("utf-8", "surrogateescape")
+    return b"".join((
+        HEADER.pack(MAGIC, FORMAT_VERSION, len(ids), len(dirs), len(table)),
+        pack_id_array(ids), table))
+
+
+def pack_items(items):
+  """
+  Return the serialized form of a list of dependency dictionaries (see
+  `DependencyMap.from_items()`).
+  """
+  return DependencyMap.from_items(items).pack()
+
+
+def is_legacy(content):
+  """
+  Return true if content is a dependency map in the legacy JSON format
+  """
+  return not content.startswith(MAGIC)
@@ -0,0 +1,108 @@
+"""
+Pool of long-lived dependency mapping workers. Each worker is an interpreter
+running ``makelint.get_dependencies --serve`` which pre-imports a configurable
+set of (heavy) modules once, and then forks a child from that warm state for
+each file to be mapped. This avoids paying for interpreter startup and for
+re-importing shared third-party packages for every file.
+"""
+
+import json
+import logging
+import queue
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger()
+
+
+class DependencyWorker(object):
+  """
+  A single worker process.
+  """
+
+  def __init__(self, preload):
+    self.proc = subprocess.Popen(
+        [sys.executable, "-Bm", "makelint.get_dependencies", "--serve",
+         "--preload"] + list(preload),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+
+  def map(self, source_tree, target_tree, module_relpath, digest_suffix):
+    """
+    Return the dependency map of the given file (the content of the file
+    written by `get_dependencies.main`), or None if it failed. Raises
+    `IOError` if the worker has died.
+    """
+    request = {
+        "source_tree": source_tree,
+        "target_tree": target_tree,
+        "module_relpath": module_relpath,
+        "digest_suffix": digest_suffix,
+    }
+    self.proc.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+    self.proc.stdin.flush()
+    line = self.proc.stdout.readline()
+    if not line:
+      raise IOError("Dependency worker {} exited".format(self.proc.pid))
+    size = int(line)
+    if size < 0:
+      return None
+    content = self.proc.stdout.read(size)
+    if len(content) != size:
+      raise IOError("Dependency worker {} exited".format(self.proc.pid))
+    return content
+
+  def close(self):
+    try:
+      self.proc.stdin.close()
+    except (IOError, OSError):
+      pass
+    self.proc.wait()
+
+
+class DependencyPool(object):
+  """
+  Up to ``njobs`` workers, started on demand. `map()` may be called
+  concurrently from up to ``njobs`` threads.
+  """
+
+  def __init__(self, njobs, preload):
+    self.njobs = max(njobs, 1)
+    self.preload = list(preload)
+    self.idle = queue.Queue()
+    self.workers = []
+    self.lock = threading.Lock()
+
+  def get_worker(self):
+    with self.lock:
+      if self.idle.empty() and len(self.workers) < self.njobs:
+        worker = DependencyWorker(self.preload)
+        self.workers.append(worker)
+        return worker
+    return self.idle.get()
+
+  def map(self, source_tree, target_tree, module_relpath, digest_suffix):
+    """
+    Return the dependency map of the given file, or None if it could not be
+    mapped by a worker.
+    """
+    worker = self.get_worker()
+    try:
+      content = worker.map(
+          source_tree, target_tree, module_relpath, digest_suffix)
+    except (IOError, OSError, ValueError) as ex:
+      logger.warning("Dependency worker failed: %s", ex)
+      with self.lock:
+        self.workers.remove(worker)
+      worker.close()
+      return None
+    self.idle.put(worker)
+    return content
+
+  def close(self):
+    with self.lock:
+      workers = self.workers
+      self.workers = []
+    for worker in workers:
+      worker.close()
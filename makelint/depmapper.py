@@ -0,0 +1,358 @@
+"""
+The dependency inference phase of a (phased) run. The dependency map of each
+stale file is computed again, with one of the engines, and then the reverse
+dependency index (see `makelint.depindex`) is brought up to date with the new
+maps.
+"""
+
+import logging
+import os
+import time
+from concurrent import futures
+
+import makelint
+from makelint import costmodel
+from makelint import depindex
+from makelint import depmap_pool
+from makelint import fingerprints
+from makelint import fsmemo
+from makelint import jobrunner
+from makelint import statcache
+from makelint import static_dependencies
+
+logger = logging.getLogger()
+
+
+def map_sourcetree_dependencies(cfg, progress, index=None, relpaths=None,
+                                pool=None, memo=None, jobserver=None):
+  """
+  During this phase each tracked
+  source file is indexed to get a complete dependency footprint. Note that this
+  is done by importing each module file in a clean interpreter process, and
+  then inspecting the `__file__` attribute of all modules loaded by interpreter.
+
+  With the "exec" ``depmap_engine`` each file is mapped by a new interpreter.
+  With the "pool" engine files are mapped by a `DependencyPool` of warm
+  workers which pre-import the modules listed in ``depmap_preload``. If
+  ``pool`` is given it is used (and left running), otherwise a pool is started
+  for this call. With the "static" engine the imports of each file are
+  resolved without executing it (see `makelint.static_dependencies`), and
+  files which can't be resolved statically are mapped as with the "exec"
+  engine.
+
+  If ``external_dependencies`` is "fingerprint" then the dependencies from
+  the standard library and from installed distributions are replaced by
+  environment fingerprints (see `makelint.fingerprints`).
+
+  Options are read from ``cfg`` (a `Configuration`). Filesystem queries go
+  through ``memo`` (a `FileMemo`) if given. If ``jobserver`` (a
+  `JobServerClient`) is given, each file is mapped while holding a token
+  from it.
+  """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  env = fingerprints.EnvironmentFingerprints()
+  files = makelint.get_file_list(cfg.target_tree, index, relpaths)
+  progress(tool_idx=2, tool="depmap")
+  revindex = depindex.DependencyIndex.load(cfg.target_tree)
+  stale = get_stale_depmaps(
+      cfg.source_tree, cfg.target_tree, revindex, files, relpaths is None,
+      cfg.digest_algorithm, memo, env)
+  progress(file_idx=len(files) - len(stale))
+  costs = costmodel.CostModel.load(cfg.target_tree)
+  if relpaths is None:
+    costs.retain(os.path.join(relpath_cwd, filename)
+                 for relpath_cwd, filename in files)
+  mapper = DependencyMapper(cfg, progress, costs, memo, jobserver)
+  mapper.file_idx = len(files) - len(stale)
+  try:
+    mapper.map_files(stale, pool)
+  finally:
+    costs.save()
+    # NOTE(josh): the dependency maps may have been written by another
+    # process
+    for relpath_file in stale:
+      depmap_path = mapper.get_depmap_path(relpath_file)
+      memo.invalidate(depmap_path)
+      memo.invalidate(depmap_path + mapper.digest_suffix)
+    # NOTE(josh): if mapping was interrupted, the files which weren't mapped
+    # are left flagged stale in the index, so that they're mapped next time
+    if cfg.external_dependencies == "fingerprint":
+      collapse_dependencies(cfg.target_tree, mapper.mapped, env,
+                            cfg.digest_algorithm, memo)
+    update_depindex(cfg.source_tree, cfg.target_tree, revindex,
+                    mapper.mapped, memo)
+    revindex.save()
+  memo.log_counts("depmap")
+
+
+def get_stale_depmaps(source_tree, target_tree, revindex, files, full,
+                      digest_algorithm=makelint.DEFAULT_DIGEST_ALGORITHM,
+                      memo=None, env=None):
+  """
+  Return the list of relpaths of the files (a list of (relpath_cwd,
+  filename)) whose dependency maps are out of date. The dependents of each
+  path whose digest (or modification time) has changed are found by looking
+  them up in the reverse dependency index, so the cost is proportional to the
+  number of distinct dependencies, not to the total size of the dependency
+  maps. Files which aren't in the index yet are checked with
+  `depmap_is_uptodate()` and added to it. If ``full`` is true then ``files``
+  is the whole tree and any other files are dropped from the index.
+  """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  if env is None:
+    env = fingerprints.EnvironmentFingerprints()
+  digest_suffix = makelint.get_digest_suffix(digest_algorithm)
+  cache = statcache.StatCache.load(target_tree)
+
+  def get_digest(relpath):
+    if fingerprints.is_fingerprint(relpath):
+      return env.get(relpath)
+    record = cache.get(relpath)
+    if record is not None:
+      return record.digest
+    return memo.read_text(os.path.join(target_tree, relpath + digest_suffix))
+
+  if full:
+    revindex.retain(os.path.join(relpath_cwd, filename)
+                    for relpath_cwd, filename in files)
+  revindex.mark_changed(source_tree, get_digest, memo)
+
+  stale = []
+  for relpath_cwd, filename in files:
+    relpath_file = os.path.join(relpath_cwd, filename)
+    depmap_path = os.path.join(
+        target_tree, relpath_file + makelint.DEPENDENCY_SUFFIX)
+    if revindex.contains(relpath_file):
+      if (revindex.is_stale(relpath_file)
+          or not memo.exists(depmap_path + digest_suffix)):
+        stale.append(relpath_file)
+      continue
+    if not makelint.depmap_is_uptodate(target_tree, relpath_file, source_tree,
+                                       digest_algorithm, memo, env):
+      stale.append(relpath_file)
+      continue
+    # NOTE(josh): the dependency map predates the index
+    revindex.update(relpath_file, memo.read_depmap(depmap_path), source_tree,
+                    memo)
+  return stale
+
+
+def collapse_dependencies(target_tree, relpaths, env,
+                          digest_algorithm=makelint.DEFAULT_DIGEST_ALGORITHM,
+                          memo=None):
+  """
+  Rewrite the dependency maps of the files at relpaths, replacing
+  dependencies which are covered by an environment fingerprint with that
+  fingerprint.
+  """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  digest_suffix = makelint.get_digest_suffix(digest_algorithm)
+  for relpath_file in relpaths:
+    depmap_path = os.path.join(
+        target_tree, relpath_file + makelint.DEPENDENCY_SUFFIX)
+    try:
+      depmap_data = memo.read_depmap(depmap_path)
+    except (IOError, OSError, ValueError):
+      continue
+    collapsed = env.collapse(depmap_data)
+    if len(collapsed) == len(depmap_data):
+      continue
+    makelint.write_dependencies(target_tree, relpath_file, collapsed.pack(),
+                                digest_algorithm)
+    memo.invalidate(depmap_path)
+    memo.invalidate(depmap_path + digest_suffix)
+
+
+def update_depindex(source_tree, target_tree, revindex, relpaths, memo=None):
+  """
+  Update the reverse dependency index with the (new) dependency maps of the
+  files at relpaths.
+  """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  for relpath_file in relpaths:
+    depmap_path = os.path.join(
+        target_tree, relpath_file + makelint.DEPENDENCY_SUFFIX)
+    try:
+      depmap_data = memo.read_depmap(depmap_path)
+    except (IOError, OSError, ValueError):
+      # NOTE(josh): leave it flagged stale so that it's mapped again
+      continue
+    revindex.update(relpath_file, depmap_data, source_tree, memo)
+
+
+class DependencyMapper(object):
+  """
+  Maps the dependencies of stale files with the ``depmap_engine`` of ``cfg``
+  (see `map_sourcetree_dependencies()`), holding a token from ``jobserver``
+  (a `JobServerClient`), if given, for each file.
+
+  The files are mapped longest first, according to the estimates of
+  ``costs`` (a `CostModel`), and the time taken to map each file is recorded
+  in it. The sizes of the files are queried through ``memo`` (a `FileMemo`).
+  """
+
+  def __init__(self, cfg, progress, costs, memo, jobserver=None):
+    self.cfg = cfg
+    self.progress = progress
+    self.costs = costs
+    self.memo = memo
+    self.jobserver = jobserver
+    self.digest_suffix = makelint.get_digest_suffix(cfg.digest_algorithm)
+
+    # Expected seconds to map each file, and the schedule that we got
+    self.predicted = {}
+    self.trace = costmodel.ScheduleTrace(cfg.jobs)
+
+    # Number of files done, for the progress report, and the relpaths of the
+    # files which have been mapped, so that the caller knows which were if
+    # mapping is interrupted.
+    self.file_idx = 0
+    self.mapped = []
+
+  def get_depmap_path(self, relpath_file):
+    return os.path.join(
+        self.cfg.target_tree, relpath_file + makelint.DEPENDENCY_SUFFIX)
+
+  def record(self, relpath_file, start, end):
+    self.mapped.append(relpath_file)
+    self.costs.record("depmap", relpath_file, end - start)
+    self.trace.add(relpath_file, self.predicted[relpath_file], start, end)
+
+  def advance(self):
+    self.file_idx += 1
+    self.progress(file_idx=self.file_idx)
+
+  def map_files(self, stale, pool=None):
+    """
+    Map the dependencies of the files at the relpaths in ``stale``, with
+    ``pool`` (a `DependencyPool`) if given and the engine is "pool".
+    """
+    for relpath_file in stale:
+      self.predicted[relpath_file] = self.costs.estimate(
+          "depmap", relpath_file, costmodel.get_size(
+              os.path.join(self.cfg.source_tree, relpath_file), self.memo))
+    stale = sorted(stale, key=self.predicted.get, reverse=True)
+
+    engine = self.cfg.depmap_engine
+    if engine == "static" and stale:
+      stale = self.map_static(stale)
+      engine = "exec"
+
+    if engine == "pool":
+      if stale:
+        self.map_pooled(stale, pool)
+        self.trace.report("depmap")
+      return
+
+    self.map_forked(stale)
+    self.trace.report("depmap")
+
+  def map_static(self, stale):
+    """
+    Map the files at the relpaths in ``stale`` without executing them (see
+    `makelint.static_dependencies`), and return the list of those which
+    can't be.
+    """
+    resolver = static_dependencies.ImportResolver(self.cfg.source_tree)
+    fallback = []
+    for relpath_file in stale:
+      logger.debug("Mapping dependencies: %s", relpath_file)
+      start = time.time()
+      content = resolver.map(
+          self.cfg.target_tree, relpath_file, self.digest_suffix)
+      if content is None:
+        logger.debug("Falling back to exec for %s", relpath_file)
+        fallback.append(relpath_file)
+        continue
+      makelint.write_dependencies(self.cfg.target_tree, relpath_file, content,
+                                  self.cfg.digest_algorithm)
+      self.mapped.append(relpath_file)
+      self.costs.record("depmap", relpath_file, time.time() - start)
+      self.advance()
+    return fallback
+
+  def map_job(self, pool, relpath_file):
+    """
+    Map one file with ``pool`` (on a thread), falling back to a new
+    interpreter if the pool can't. Return the relpath and the start and end
+    time.
+    """
+    token = None
+    if self.jobserver is not None:
+      token = self.jobserver.acquire()
+    try:
+      logger.debug("Mapping dependencies: %s", relpath_file)
+      start = time.time()
+      content = pool.map(self.cfg.source_tree, self.cfg.target_tree,
+                         relpath_file, self.digest_suffix)
+      if content is None:
+        makelint.map_dependencies(self.cfg.source_tree, self.cfg.target_tree,
+                                  relpath_file, self.cfg.digest_algorithm)
+      else:
+        makelint.write_dependencies(self.cfg.target_tree, relpath_file,
+                                    content, self.cfg.digest_algorithm)
+      return relpath_file, start, time.time()
+    finally:
+      if token is not None:
+        self.jobserver.release(token)
+
+  def map_pooled(self, stale, pool=None):
+    """
+    Map the files at the relpaths in ``stale`` with ``pool`` (a
+    `DependencyPool`), or with one started for this call.
+    """
+    owned_pool = None
+    if pool is None:
+      owned_pool = pool = depmap_pool.DependencyPool(
+          self.cfg.jobs, self.cfg.depmap_preload or [])
+    try:
+      with futures.ThreadPoolExecutor(
+          max_workers=max(self.cfg.jobs, 1)) as executor:
+        for result in executor.map(
+            lambda relpath_file: self.map_job(pool, relpath_file), stale):
+          self.record(*result)
+          self.advance()
+    finally:
+      if owned_pool is not None:
+        owned_pool.close()
+
+  def map_forked(self, stale):
+    """
+    Map the files at the relpaths in ``stale``, each in a new interpreter
+    started from a forked child.
+    """
+    pidset = set()
+    started = {}
+
+    def on_exit(pid):
+      relpath_file, start, token = started.pop(pid)
+      if token is not None:
+        self.jobserver.release(token)
+      self.record(relpath_file, start, time.time())
+
+    for relpath_file in stale:
+      self.advance()
+      logger.debug("Mapping dependencies: %s", relpath_file)
+      makelint.waitforsize(pidset, self.cfg.jobs - 1, on_exit)
+      token = None
+      if self.jobserver is not None:
+        token, _ = jobrunner.waitfortoken(pidset, self.jobserver, on_exit)
+      pid = os.fork()
+      if pid == 0:
+        # NOTE(josh): the child must not unwind into the caller's cleanup
+        # (e.g. returning the parent's jobserver tokens) if mapping fails
+        status = 1
+        try:
+          makelint.map_dependencies(
+              self.cfg.source_tree, self.cfg.target_tree, relpath_file,
+              self.cfg.digest_algorithm)
+          status = 0
+        finally:
+          os._exit(status)  # pylint: disable=protected-access
+      started[pid] = (relpath_file, time.time(), token)
+      pidset.add(pid)
+    makelint.waitforsize(pidset, 0, on_exit)
@@ -0,0 +1,166 @@
+"""
+Fingerprints of the python environment, which stand in for the (many)
+dependencies of a file that are outside of the source tree. Rather than listing
+every module from the standard library and from site-packages, a dependency
+map can list:
+
+* ``env:python``, whose digest identifies the interpreter (and so it's
+  standard library)
+* ``env:dist/<name>`` for each installed distribution, whose digest is made
+  from it's name, version and ``RECORD`` (the list of installed files and
+  their hashes)
+
+Out-of-tree files which belong to neither (e.g. a directory on
+``PYTHONPATH``, or an editable install) are still listed by path.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import sysconfig
+
+from makelint import depmap
+
+logger = logging.getLogger()
+
+ENV_PREFIX = "env:"
+PYTHON_PATH = ENV_PREFIX + "python"
+DIST_PREFIX = ENV_PREFIX + "dist/"
+
+
+def is_fingerprint(path):
+  """
+  Return true if path (from a dependency map) is an environment fingerprint
+  rather than a file.
+  """
+  return path.startswith(ENV_PREFIX)
+
+
+def get_digest(material):
+  return hashlib.sha1(json.dumps(material).encode("utf-8")).hexdigest()
+
+
+def get_importlib_metadata():
+  """
+  Return the ``importlib.metadata`` module, or None if it isn't available.
+  NOTE(josh): it is imported on demand because it pulls in a good part of the
+  standard library (email, zipfile, csv, ...), which would otherwise be loaded
+  by (and listed in the dependencies mapped by) every interpreter that imports
+  makelint.
+  """
+  try:
+    import importlib.metadata as importlib_metadata
+  except ImportError:
+    return None
+  return importlib_metadata
+
+
+def is_under(path, dirpath):
+  return path.startswith(dirpath + os.sep)
+
+
+class EnvironmentFingerprints(object):
+  """
+  Computes fingerprints of the current environment. Everything is computed
+  lazily and then remembered, so an instance should only live for one run.
+  """
+
+  def __init__(self):
+    paths = sysconfig.get_paths()
+    self.stdlib_dirs = set(
+        os.path.realpath(paths[key]) for key in ("stdlib", "platstdlib"))
+    self.site_dirs = set(
+        os.path.realpath(paths[key]) for key in ("purelib", "platlib"))
+
+    # Maps the realpath of each installed file to the fingerprint path of the
+    # distribution which installed it
+    self.owners = None
+
+    # Maps fingerprint path to it's digest (or None if it no longer exists)
+    self.digests = {}
+
+  def get_owners(self):
+    if self.owners is not None:
+      return self.owners
+    owners = {}
+    importlib_metadata = get_importlib_metadata()
+    if importlib_metadata is not None:
+      for dist in importlib_metadata.distributions():
+        name = dist.metadata["Name"]
+        files = dist.files
+        if not name or files is None:
+          continue
+        fingerprint_path = DIST_PREFIX + name
+        base = os.path.realpath(str(dist.locate_file("")))
+        for item in files:
+          path = os.path.normpath(os.path.join(base, str(item)))
+          owners.setdefault(path, fingerprint_path)
+    self.owners = owners
+    return owners
+
+  def get_owner(self, filepath):
+    """
+    Return the fingerprint path which covers the file at (absolute, real)
+    filepath, or None if it isn't part of the python installation or of an
+    installed distribution.
+    """
+    owner = self.get_owners().get(filepath)
+    if owner is not None:
+      return owner
+    if any(is_under(filepath, dirpath) for dirpath in self.site_dirs):
+      return None
+    if any(is_under(filepath, dirpath) for dirpath in self.stdlib_dirs):
+      return PYTHON_PATH
+    return None
+
+  def get(self, path):
+    """
+    Return the current digest of the fingerprint at path, or None if it
+    doesn't exist (e.g. the distribution has been uninstalled).
+    """
+    if path in self.digests:
+      return self.digests[path]
+    digest = None
+    importlib_metadata = get_importlib_metadata()
+    if path == PYTHON_PATH:
+      digest = get_digest([
+          sys.version, sys.implementation.cache_tag,
+          os.path.realpath(sys.executable), sys.prefix])
+    elif path.startswith(DIST_PREFIX) and importlib_metadata is not None:
+      name = path[len(DIST_PREFIX):]
+      try:
+        dist = importlib_metadata.distribution(name)
+      except importlib_metadata.PackageNotFoundError:
+        dist = None
+      if dist is not None:
+        record = (dist.read_text("RECORD")
+                  or dist.read_text("installed-files.txt") or "")
+        digest = get_digest([name, dist.version, record])
+    self.digests[path] = digest
+    return digest
+
+  def collapse(self, depmap_data):
+    """
+    Return a copy of the dependency map ``depmap_data`` (a `DependencyMap`)
+    in which the dependencies that are covered by a fingerprint are replaced
+    by that fingerprint.
+    """
+    out = depmap.DependencyMap([], [], [])
+    seen = set()
+    for path, digest, name in zip(
+        depmap_data.paths, depmap_data.digests, depmap_data.names):
+      if path.startswith("/"):
+        owner = self.get_owner(path)
+        if owner is not None:
+          if owner not in seen:
+            seen.add(owner)
+            out.paths.append(owner)
+            out.digests.append(self.get(owner))
+            out.names.append(owner[len(ENV_PREFIX):])
+          continue
+      out.paths.append(path)
+      out.digests.append(digest)
+      out.names.append(name)
+    return out
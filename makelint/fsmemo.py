@@ -0,0 +1,139 @@
+"""
+Run-scoped memo of filesystem queries. The same facts are needed many times
+in one run: e.g. the digest of a common in-tree module is compared once for
+every file that depends on it, and the digest of a dependency map is read once
+for each tool. A `FileMemo` remembers the result of each ``stat()`` and the
+content of each small file (digests, tool stamps and dependency maps) that is
+read through it.
+
+A phase which writes one of these files must tell the memo about it with
+`FileMemo.put_text()` or `FileMemo.invalidate()`. The memo is not meant to
+outlive a run: files written by child processes, or by anything else, are not
+noticed.
+"""
+
+import collections
+import errno
+import logging
+import os
+
+from makelint import depmap
+
+logger = logging.getLogger()
+
+
+class FileMemo(object):
+  """
+  Memo of ``stat()`` results and file contents, keyed by path. Counts the
+  syscalls which it makes and those which it saves.
+  """
+
+  def __init__(self):
+    self.stats = {}
+    self.texts = {}
+    self.data = {}
+    self.counts = collections.Counter()
+
+  def stat(self, path):
+    """
+    Return the `os.stat_result` for path, or None if it doesn't exist.
+    """
+    try:
+      result = self.stats[path]
+      self.counts["stat_memo"] += 1
+      return result
+    except KeyError:
+      pass
+
+    self.counts["stat"] += 1
+    try:
+      result = os.stat(path)
+    except OSError:
+      result = None
+    self.stats[path] = result
+    return result
+
+  def exists(self, path):
+    return self.stat(path) is not None
+
+  def getmtime(self, path):
+    """
+    Same as `os.path.getmtime()`
+    """
+    result = self.stat(path)
+    if result is None:
+      raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return result.st_mtime
+
+  def put_stat(self, path, stat):
+    """
+    Record a stat result for path which was obtained some other way.
+    """
+    self.stats[path] = stat
+
+  def read_text(self, path):
+    """
+    Return the content of the file at path, stripped of whitespace, or None
+    if it can't be read.
+    """
+    try:
+      content = self.texts[path]
+      self.counts["read_memo"] += 1
+      return content
+    except KeyError:
+      pass
+
+    self.counts["read"] += 1
+    try:
+      with open(path) as infile:
+        content = infile.read().strip()
+    except (IOError, OSError):
+      content = None
+    self.texts[path] = content
+    return content
+
+  def read_depmap(self, path):
+    """
+    Return the `DependencyMap` loaded from the file at path. The result is
+    shared by all callers and must not be modified.
+    """
+    try:
+      content = self.data[path]
+      self.counts["read_memo"] += 1
+      return content
+    except KeyError:
+      pass
+
+    self.counts["read"] += 1
+    content = depmap.DependencyMap.load(path)
+    self.data[path] = content
+    return content
+
+  def put_text(self, path, content):
+    """
+    Record that content (without surrounding whitespace) was just written to
+    the file at path.
+    """
+    self.invalidate(path)
+    self.texts[path] = content
+
+  def invalidate(self, path):
+    """
+    Forget everything about the file at path (e.g. because it was written or
+    removed).
+    """
+    self.stats.pop(path, None)
+    self.texts.pop(path, None)
+    self.data.pop(path, None)
+
+  def log_counts(self, phase):
+    """
+    Log the number of syscalls made and saved since the last call, at debug
+    level.
+    """
+    counts = self.counts
+    logger.debug(
+        "%s: %d stat, %d read (memo saved %d stat, %d read)", phase,
+        counts["stat"], counts["read"], counts["stat_memo"],
+        counts["read_memo"])
+    counts.clear()
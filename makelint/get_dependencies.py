@@ -1,6 +1,23 @@
 """
 Helper module to get dependencies. exec() a python file and then inspect
 ``sys.modules`` and record everything that was read in.
+
+With ``--serve`` this runs as a long-lived worker instead (see
+`makelint.depmap_pool`). The worker optionally pre-imports a set of heavy
+modules, and then reads requests (one JSON object per line) from stdin. For
+each request it forks a child which maps the dependencies of one file, and
+writes the size of the dependency map on a line of it's own (-1 on failure),
+followed by the dependency map, back to stdout.
+
+The worker must produce exactly the same output as a fresh interpreter would.
+Modules which were not loaded in a fresh interpreter (i.e. the preloaded
+modules and everything they imported) are hidden from the child before it
+executes the file. If the file imports one of the preloaded modules then it
+is put back, along with everything that importing it in a fresh interpreter
+loads (this is measured once, in a forked child, when the worker starts).
+Any other hidden module is imported again from scratch, unless it is an
+extension module (which can't be re-initialized), in which case the worker
+gives up on that file and it is mapped in a fresh interpreter instead.
 """
 
 import argparse
@@ -8,30 +25,30 @@ import os
 import sys
 
 
-def main():
-  parser = argparse.ArgumentParser(description=__doc__)
-  parser.add_argument("-m", "--module-relpath", required=True)
-  parser.add_argument("-s", "--source-tree", required=True)
-  parser.add_argument("-t", "--target-tree", required=True)
-  args = parser.parse_args()
-
-  source_tree = os.path.realpath(args.source_tree)
-  target_tree = os.path.realpath(args.target_tree)
-  module_path = os.path.join(source_tree, args.module_relpath)
-  target_path = os.path.join(target_tree, args.module_relpath)
-
+def exec_module(module_path):
+  """
+  Execute the module file at module_path, ignoring any errors, and return the
+  globals it was executed in.
+  """
+  # NOTE(josh): if we allow __name__ to pass through, the module will
+  # think it is __main__ and it will execute itself if it is a main
+  # module.
+  _globals = dict(globals())
+  _globals["__name__"] = os.path.basename(module_path)
   try:
     with open(module_path) as infile:
-      # NOTE(josh): if we allow __name__ to pass through, the module will
-      # think it is __main__ and it will execute itself if it is a main
-      # module.
-      _globals = dict(globals())
-      _globals["__name__"] = os.path.basename(module_path)
       exec(infile.read(), _globals)  # pylint: disable=exec-used
   except:  # pylint: disable=bare-except
     # TODO(josh): should we log exceptions into the dependency file?
     pass
+  return _globals
 
+
+def get_module_files():
+  """
+  Return a sorted list of ``(name, filepath)`` for each module in
+  ``sys.modules`` which was loaded from a file.
+  """
   outlist = []
   for name, value in sorted(sys.modules.items()):
     # skip ourselves
@@ -47,7 +64,40 @@ def main():
     # e.g. <gi.repository.Atk>
     if not os.path.exists(filepath):
       continue
+    outlist.append((name, filepath))
+  return outlist
+
 
+def get_dependency_list(source_tree, target_tree, module_relpath, module_name,
+                        digest_suffix, module_files=None):
+  """
+  Return the list of dependencies (as dictionaries) of the module at
+  module_relpath. ``module_files`` is a list of ``(name, filepath)`` of the
+  modules it loaded, which defaults to `get_module_files()` (i.e. the module
+  has just been executed in this interpreter).
+  """
+  module_path = os.path.join(source_tree, module_relpath)
+  if module_files is None:
+    module_files = get_module_files()
+
+  def read_digest(relpath):
+    digest_path = os.path.join(target_tree, relpath + digest_suffix)
+    if not os.path.exists(digest_path):
+      # NOTE(josh): the file is in the source tree but isn't tracked
+      return None
+    with open(digest_path) as infile:
+      return infile.read().strip()
+
+  # NOTE(josh): the module itself is not in sys.modules (it was exec'ed, not
+  # imported), but it is the first dependency of it's own dependency map. This
+  # ensures that the map (and the tool stamps that depend on it) is
+  # invalidated when the content of the module changes.
+  outlist = [{
+      "digest": read_digest(module_relpath),
+      "name": module_name,
+      "path": module_relpath,
+  }]
+  for name, filepath in module_files:
     # skip our module, unless the file is in our module
     if name.startswith("makelint"):
       if "makelint" not in module_path:
@@ -55,9 +105,9 @@ def main():
 
     if filepath.startswith(source_tree):
       filepath = os.path.relpath(filepath, source_tree)
-      digest_path = target_path + ".sha1"
-      with open(digest_path) as infile:
-        digest = infile.read().strip()
+      if filepath == module_relpath:
+        continue
+      digest = read_digest(filepath)
     else:
       digest = None
     outlist.append({
@@ -65,11 +115,268 @@ def main():
         "name": name,
         "path": filepath,
     })
+  return outlist
+
+
+def dump_dependency_list(outlist, outfile):
+  """
+  Write the dependency list to the binary file ``outfile`` in the format of
+  `makelint.depmap`.
+  """
+  from makelint import depmap
+  outfile.write(depmap.pack_items(outlist))
+
+
+def get_argv(source_tree, target_tree, module_relpath, digest_suffix):
+  """
+  Return the command line used to map a single file
+  """
+  return ["--module-relpath", module_relpath,
+          "--source-tree", source_tree,
+          "--target-tree", target_tree,
+          "--digest-suffix", digest_suffix]
+
+
+def get_import_closure(name):
+  """
+  Return the set of modules that are loaded by importing the module ``name``
+  from the current state, without actually importing it in this process.
+  """
+  result_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(result_fd)
+    try:
+      before = set(sys.modules)
+      try:
+        __import__(name)
+      except Exception:  # pylint: disable=broad-except
+        pass
+      with os.fdopen(write_fd, "w") as outfile:
+        outfile.write("\n".join(sorted(set(sys.modules) - before)))
+    finally:
+      os._exit(0)  # pylint: disable=protected-access
+
+  os.close(write_fd)
+  with os.fdopen(result_fd, "r") as infile:
+    content = infile.read()
+  os.waitpid(pid, 0)
+  return set(content.split())
+
+
+def strip_submodules(module):
+  """
+  Remove attributes of a package which refer to submodules that aren't in
+  ``sys.modules``. Otherwise ``from package import submodule`` would find the
+  attribute and never import the submodule.
+  """
+  prefix = getattr(module, "__name__", None)
+  try:
+    items = list(vars(module).items())
+  except TypeError:
+    return
+  for attr, value in items:
+    if not isinstance(value, type(sys)):
+      continue
+    name = "{}.{}".format(prefix, attr)
+    if getattr(value, "__name__", None) == name \
+        and sys.modules.get(name) is not value:
+      delattr(module, attr)
+
+
+def is_extension(module):
+  """
+  Return true if the module is implemented in C. These can't (in general) be
+  imported again from scratch, because the interpreter caches them.
+  """
+  import importlib.machinery
+  loader = getattr(getattr(module, "__spec__", None), "loader", None)
+  return loader is importlib.machinery.BuiltinImporter or isinstance(
+      loader, importlib.machinery.ExtensionFileLoader)
+
+
+def hide_modules(baseline, closures, state):
+  """
+  Remove all modules not in ``baseline`` from ``sys.modules`` and install an
+  import hook which puts back a preloaded module, along with everything it
+  imported, when it is imported again. Other hidden modules are imported
+  from scratch, just as they would be in a fresh interpreter, except for
+  extension modules: if one of those is imported then ``state["inexact"]`` is
+  set, and the result can't be trusted.
+  """
+  import importlib.machinery
+
+  hidden = {}
+  for name in list(sys.modules):
+    if name not in baseline:
+      hidden[name] = sys.modules.pop(name)
+  for module in list(sys.modules.values()):
+    strip_submodules(module)
 
+  class HiddenModuleLoader(object):
+    """
+    Loader which "loads" a module by returning the existing module object.
+    """
+
+    def __init__(self, module):
+      self.module = module
+
+    def create_module(self, _spec):
+      return self.module
+
+    def exec_module(self, _module):
+      pass
+
+  class HiddenModuleFinder(object):
+    """
+    Finds preloaded modules which were hidden by `hide_modules()`.
+    """
+
+    @staticmethod
+    def find_spec(fullname, _path=None, _target=None):
+      if fullname not in hidden:
+        return None
+      if fullname not in closures:
+        if is_extension(hidden[fullname]):
+          state["inexact"] = True
+        return None
+
+      restored = []
+      for name in sorted(closures[fullname]):
+        if name != fullname and name in hidden and name not in sys.modules:
+          sys.modules[name] = hidden[name]
+          restored.append(name)
+      for name in restored:
+        strip_submodules(sys.modules[name])
+        parent, _, child = name.rpartition(".")
+        if parent in sys.modules:
+          setattr(sys.modules[parent], child, sys.modules[name])
+
+      module = hidden[fullname]
+      strip_submodules(module)
+      origin = getattr(getattr(module, "__spec__", None), "origin", None)
+      return importlib.machinery.ModuleSpec(
+          fullname, HiddenModuleLoader(module), origin=origin)
+
+  sys.meta_path.insert(0, HiddenModuleFinder)
+
+
+def serve_one(request, baseline, closures, result_fd):
+  """
+  Map the dependencies of the file in request in the current (forked)
+  process and write the output to result_fd.
+  """
+  source_tree = os.path.realpath(request["source_tree"])
+  target_tree = os.path.realpath(request["target_tree"])
+  module_relpath = request["module_relpath"]
+  digest_suffix = request["digest_suffix"]
+
+  state = {"inexact": False}
+  hide_modules(baseline, closures, state)
+  sys.argv = [sys.argv[0]] + get_argv(
+      request["source_tree"], request["target_tree"], module_relpath,
+      digest_suffix)
+  _globals = exec_module(os.path.join(source_tree, module_relpath))
+  outlist = get_dependency_list(
+      source_tree, target_tree, module_relpath, _globals["__name__"],
+      digest_suffix)
+  if state["inexact"]:
+    # NOTE(josh): an empty response makes the caller fall back to mapping
+    # this file in a fresh interpreter
+    os.close(result_fd)
+    return
+  with os.fdopen(result_fd, "wb") as outfile:
+    dump_dependency_list(outlist, outfile)
+
+
+def serve(preload):
+  """
+  Pre-import the modules in ``preload``, and then serve requests from stdin
+  until it is closed.
+  """
   import json
-  json.dump(outlist, sys.stdout, indent=2, sort_keys=True)
-  sys.stdout.write("\n")
+
+  baseline = set(sys.modules)
+  closures = {}
+  for name in preload:
+    closures[name] = get_import_closure(name)
+  for name in preload:
+    try:
+      __import__(name)
+    except Exception as ex:  # pylint: disable=broad-except
+      sys.stderr.write("Failed to preload {}: {}\n".format(name, ex))
+
+  # NOTE(josh): the file being mapped may read from stdin or write to stdout
+  # when it is executed, so we move the request and response streams out of
+  # the way.
+  requests = os.fdopen(os.dup(0), "r")
+  responses = os.fdopen(os.dup(1), "wb")
+  devnull = os.open(os.devnull, os.O_RDWR)
+  os.dup2(devnull, 0)
+  os.dup2(devnull, 1)
+
+  for line in requests:
+    request = json.loads(line)
+    result_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(result_fd)
+      try:
+        serve_one(request, baseline, closures, write_fd)
+      finally:
+        os._exit(0)  # pylint: disable=protected-access
+
+    os.close(write_fd)
+    with os.fdopen(result_fd, "rb") as infile:
+      content = infile.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0 or not content:
+      responses.write(b"-1\n")
+    else:
+      responses.write("{}\n".format(len(content)).encode("ascii"))
+      responses.write(content)
+    responses.flush()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("-m", "--module-relpath")
+  parser.add_argument("-s", "--source-tree")
+  parser.add_argument("-t", "--target-tree")
+  parser.add_argument("-d", "--digest-suffix", default=".sha1")
+  parser.add_argument("--serve", action="store_true",
+                      help="Run as a worker, reading requests from stdin")
+  parser.add_argument("--preload", nargs="*", default=[],
+                      help="Modules to import before serving requests")
+  parser.add_argument("--baseline", action="store_true",
+                      help="Instead of mapping a file, print the search path "
+                      "and the modules loaded by a clean interpreter")
+  args = parser.parse_args()
+
+  if args.serve:
+    return serve(args.preload)
+
+  if args.baseline:
+    import json
+    json.dump({"path": sys.path, "modules": get_module_files()}, sys.stdout)
+    sys.stdout.write("\n")
+    return 0
+
+  for name in ("module_relpath", "source_tree", "target_tree"):
+    if getattr(args, name) is None:
+      parser.error("--{} is required".format(name.replace("_", "-")))
+
+  source_tree = os.path.realpath(args.source_tree)
+  target_tree = os.path.realpath(args.target_tree)
+  module_path = os.path.join(source_tree, args.module_relpath)
+  _globals = exec_module(module_path)
+  outlist = get_dependency_list(
+      source_tree, target_tree, args.module_relpath, _globals["__name__"],
+      args.digest_suffix)
+  dump_dependency_list(outlist, sys.stdout.buffer)
+  sys.stdout.flush()
+  return 0
 
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
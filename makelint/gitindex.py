@@ -0,0 +1,164 @@
+"""
+Minimal reader for the git index (``.git/index``) file format. See
+``Documentation/technical/index-format.txt`` in the git sources. This lets us
+enumerate the tracked files of a checkout with a single sequential read,
+without walking the filesystem and without running a ``git`` subprocess.
+
+Versions 2, 3 and 4 of the format are supported. Split indexes and sparse
+indexes are not: `read_index()` raises `UnsupportedIndex` for those and the
+caller should fall back to a filesystem walk.
+"""
+
+import collections
+import os
+import struct
+
+ENTRY_HEAD = struct.Struct(">10I20sH")
+EXTENDED_FLAGS = struct.Struct(">H")
+EXTENSION_HEAD = struct.Struct(">4sI")
+HEADER = struct.Struct(">4sII")
+
+# Extensions which change the meaning of the entry list
+UNSUPPORTED_EXTENSIONS = {
+    b"link": "split index",
+    b"sdir": "sparse index",
+}
+
+# Object types stored in the upper bits of the mode
+MODE_TYPE_MASK = 0o170000
+MODE_REGULAR = 0o100000
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+
+HASH_SIZE = 20  # sha1 object format
+
+IndexEntry = collections.namedtuple(
+    "IndexEntry",
+    ["path", "mode", "ctime_ns", "mtime_ns", "dev", "ino", "size", "stage"])
+
+
+class UnsupportedIndex(Exception):
+  """
+  Raised when the index cannot be read by this module.
+  """
+
+
+def find_index(source_tree):
+  """
+  Find the index file of the git checkout containing ``source_tree``. Return
+  a tuple of the path to the index and the relative path of ``source_tree``
+  within the checkout (an empty string if it is the root). Return
+  ``(None, None)`` if ``source_tree`` is not inside a git checkout.
+  """
+  source_tree = os.path.realpath(source_tree)
+  toplevel = source_tree
+  while True:
+    dotgit = os.path.join(toplevel, ".git")
+    if os.path.isdir(dotgit):
+      gitdir = dotgit
+      break
+    if os.path.isfile(dotgit):
+      # NOTE(josh): worktrees and submodules have a .git file pointing to the
+      # actual git directory
+      with open(dotgit) as infile:
+        content = infile.read().strip()
+      if not content.startswith("gitdir:"):
+        return None, None
+      gitdir = os.path.join(toplevel, content[len("gitdir:"):].strip())
+      break
+    parent = os.path.dirname(toplevel)
+    if parent == toplevel:
+      return None, None
+    toplevel = parent
+
+  prefix = os.path.relpath(source_tree, toplevel)
+  if prefix == ".":
+    prefix = ""
+  return os.path.join(gitdir, "index"), prefix
+
+
+def read_varint(buf, offset):
+  """
+  Decode the variable-width integer used for path prefix compression in
+  version 4 indexes. Return the value and the offset following it.
+  """
+  byte = buf[offset]
+  offset += 1
+  value = byte & 0x7f
+  while byte & 0x80:
+    byte = buf[offset]
+    offset += 1
+    value = ((value + 1) << 7) | (byte & 0x7f)
+  return value, offset
+
+
+def parse_index(content):
+  """
+  Parse the content of an index file and return a list of `IndexEntry`.
+  """
+  buf = memoryview(content)
+  signature, version, nentries = HEADER.unpack_from(buf, 0)
+  if signature != b"DIRC":
+    raise UnsupportedIndex("Not a git index")
+  if version not in (2, 3, 4):
+    raise UnsupportedIndex("Unsupported index version {}".format(version))
+
+  entries = []
+  offset = HEADER.size
+  prevpath = b""
+  for _ in range(nentries):
+    entry_start = offset
+    (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, _, _, size, _,
+     flags) = ENTRY_HEAD.unpack_from(buf, offset)
+    offset += ENTRY_HEAD.size
+    if version >= 3 and flags & 0x4000:
+      offset += EXTENDED_FLAGS.size
+
+    if version == 4:
+      strip, offset = read_varint(buf, offset)
+      end = content.index(b"\0", offset)
+      path = prevpath[:len(prevpath) - strip] + bytes(buf[offset:end])
+      offset = end + 1
+    else:
+      end = content.index(b"\0", offset)
+      path = bytes(buf[offset:end])
+      # NOTE(josh): entries are padded with 1-8 nul bytes to a multiple of
+      # eight bytes
+      offset = entry_start + ((end - entry_start) // 8 + 1) * 8
+    prevpath = path
+
+    entries.append(IndexEntry(
+        path=path.decode("utf-8", "surrogateescape"),
+        mode=mode,
+        ctime_ns=ctime_s * 1000000000 + ctime_ns,
+        mtime_ns=mtime_s * 1000000000 + mtime_ns,
+        dev=dev,
+        ino=ino,
+        size=size,
+        stage=(flags >> 12) & 0x3))
+
+  # NOTE(josh): the index ends with a checksum of the preceding content
+  end_of_extensions = len(buf) - HASH_SIZE
+  while offset + EXTENSION_HEAD.size <= end_of_extensions:
+    signature, extsize = EXTENSION_HEAD.unpack_from(buf, offset)
+    if signature in UNSUPPORTED_EXTENSIONS:
+      raise UnsupportedIndex(
+          "{} is not supported".format(UNSUPPORTED_EXTENSIONS[signature]))
+    offset += EXTENSION_HEAD.size + extsize
+
+  return entries
+
+
+def read_index(index_path):
+  """
+  Read the index file at ``index_path`` and return a tuple of its
+  `os.stat_result` and the list of `IndexEntry` it contains.
+  """
+  with open(index_path, "rb") as infile:
+    stat = os.fstat(infile.fileno())
+    content = infile.read()
+  try:
+    return stat, parse_index(content)
+  except (struct.error, IndexError, ValueError) as ex:
+    raise UnsupportedIndex(
+        "Failed to parse {}: {}".format(index_path, ex)) from ex
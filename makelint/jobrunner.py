@@ -0,0 +1,235 @@
+"""
+Job slots shared by the forked children and threads which execute the jobs of
+a run, and the tokens of the make jobserver (see `makelint.jobserver`) which
+they hold while they run.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent import futures
+
+logger = logging.getLogger()
+
+# Serializes writes to the merged log between threads of one process (flock
+# only serializes between processes)
+MERGED_LOG_LOCK = threading.Lock()
+
+
+def reset_merged_log_lock():
+  """
+  Give a forked child a lock of it's own, since the one it inherited may be
+  held by a thread which doesn't exist in the child.
+  """
+  global MERGED_LOG_LOCK  # pylint: disable=global-statement
+  MERGED_LOG_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_merged_log_lock)
+
+# Interval at which to poll children while waiting for a jobserver token
+JOBSERVER_POLL_INTERVAL = 0.01
+
+
+def waitfortoken(pidset, client, on_exit=None):
+  """
+  Wait for a token from ``client`` (a `JobServerClient`) for a new child. The
+  children in the set() of pids are reaped as they exit (which should return
+  their tokens), and ``on_exit(pid)`` is called for each, if given. Return the
+  token and the bitwise or of the exit status of the children that were
+  reaped.
+  """
+  output = 0
+  while True:
+    token = client.try_acquire(JOBSERVER_POLL_INTERVAL)
+    if token is not None:
+      return token, output
+    for pid in list(pidset):
+      wpid, status = os.waitpid(pid, os.WNOHANG)
+      if wpid == pid:
+        pidset.remove(pid)
+        output |= status
+        if on_exit is not None:
+          on_exit(pid)
+
+
+def call_tool_jobs(tool, fun, *args):
+  """
+  Call ``fun(*args)`` and return it's result, or 1 if it raised.
+  """
+  try:
+    return fun(*args)
+  except Exception:  # pylint: disable=broad-except
+    logger.exception("Failed to execute %s", tool.name)
+    return 1
+
+
+class JobRunner(object):
+  """
+  Runs groups of tool jobs, for any number of tools, sharing one limit on the
+  number that run at once. Most tools run in a forked child process, but tools
+  which do their work in (shared) worker processes of their own are run on a
+  thread instead. If a ``jobserver`` (a `JobServerClient`) is given, each job
+  also holds a token from it while it runs.
+  """
+
+  # Interval at which to poll children, while there are also threads running
+  POLL_INTERVAL = 0.01
+
+  def __init__(self, njobs, merged_log, jobserver=None):
+    self.njobs = max(njobs, 1)
+    self.merged_log = merged_log
+    self.jobserver = jobserver
+    self.pidset = set()
+    self.pending = set()
+    self.executor = None
+
+    # Jobserver token held by each running job, by job index, and the exit
+    # status of jobs reaped while waiting for a token
+    self.tokens = {}
+    self.status = 0
+
+    # Start and end time (``time.time()``) of each job, by the index returned
+    # from `start()` or `submit()`. The end is None while the job is running.
+    self.times = []
+    self.job_ids = {}
+
+  def __len__(self):
+    return len(self.pidset) + len(self.pending)
+
+  def add_job(self, handle, token):
+    job_id = self.job_ids[handle] = len(self.times)
+    self.times.append([time.time(), None])
+    if token is not None:
+      self.tokens[job_id] = token
+    return job_id
+
+  def finish_job(self, handle):
+    job_id = self.job_ids.pop(handle, None)
+    if job_id is None:
+      return
+    self.times[job_id][1] = time.time()
+    token = self.tokens.pop(job_id, None)
+    if token is not None:
+      self.jobserver.release(token)
+
+  def acquire_token(self):
+    """
+    Wait for a jobserver token for the next job, if there is a jobserver.
+    Jobs that finish in the meantime are reaped (which returns their tokens),
+    and their exit status is returned by the next `wait()`.
+    """
+    if self.jobserver is None:
+      return None
+    while True:
+      token = self.jobserver.try_acquire(self.POLL_INTERVAL)
+      if token is not None:
+        return token
+      self.status |= self.poll()
+
+  def start(self, tool, fun, *args):
+    """
+    Call ``fun(*args)`` in a forked child. Return the index of the job.
+    """
+    token = self.acquire_token()
+    # NOTE(josh): job threads write to the merged log while holding the lock,
+    # so holding it here means that no thread is half way through a write
+    # when we flush (so that the child doesn't inherit, and then write out a
+    # second copy of, our buffer) and fork.
+    with MERGED_LOG_LOCK:
+      if self.merged_log:
+        self.merged_log.flush()
+      pid = os.fork()
+      if pid == 0:
+        os._exit(  # pylint: disable=protected-access
+            call_tool_jobs(tool, fun, *args))
+    self.pidset.add(pid)
+    return self.add_job(pid, token)
+
+  def submit(self, tool, fun, *args):
+    """
+    Call ``fun(*args)`` on a thread. Return the index of the job.
+    """
+    if self.executor is None:
+      self.executor = futures.ThreadPoolExecutor(max_workers=self.njobs)
+    token = self.acquire_token()
+    future = self.executor.submit(call_tool_jobs, tool, fun, *args)
+    self.pending.add(future)
+    job_id = self.add_job(future, token)
+    # NOTE(josh): the job may finish while we aren't waiting for it
+    future.add_done_callback(self.finish_job)
+    return job_id
+
+  def reap(self, done):
+    output = 0
+    for future in done:
+      self.pending.discard(future)
+      # NOTE(josh): done callbacks may not have run yet
+      self.finish_job(future)
+      output |= future.result()
+    return output
+
+  def poll(self):
+    """
+    Reap the jobs which have finished, without waiting, and return the
+    bitwise or of their exit status.
+    """
+    output = self.reap([future for future in self.pending if future.done()])
+    for pid in list(self.pidset):
+      wpid, status = os.waitpid(pid, os.WNOHANG)
+      if wpid == pid:
+        self.pidset.remove(pid)
+        self.finish_job(pid)
+        output |= status
+    return output
+
+  def wait_child(self):
+    """
+    Wait for at least one forked job to exit, and return the bitwise or of
+    the exit status of those that did. Tool workers are also our children,
+    and one of them may exit while it's idle, so only the pids of our jobs are
+    reaped (the workers are reaped by their pool).
+    """
+    njobs = len(self.pidset)
+    while True:
+      output = self.poll()
+      if len(self.pidset) < njobs:
+        return output
+      if hasattr(os, "waitid"):
+        # NOTE(josh): wait until any child has exited, without reaping it
+        info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+        if info is not None and info.si_pid in self.pidset:
+          continue
+      time.sleep(self.POLL_INTERVAL)
+
+  def wait(self, njobs):
+    """
+    Wait until at most njobs are running, and return the bitwise or of the
+    exit status of those that finished.
+    """
+    output = self.status
+    self.status = 0
+    while len(self) > njobs:
+      if not self.pending:
+        output |= self.wait_child()
+      elif not self.pidset:
+        done, _ = futures.wait(
+            self.pending, return_when=futures.FIRST_COMPLETED)
+        output |= self.reap(done)
+      else:
+        futures.wait(self.pending, timeout=self.POLL_INTERVAL,
+                     return_when=futures.FIRST_COMPLETED)
+        output |= self.poll()
+    return output
+
+  def close(self):
+    if self.executor is not None:
+      self.executor.shutdown()
+      self.executor = None
+    # NOTE(josh): if we were interrupted there may still be jobs running, but
+    # the tokens have to go back either way
+    tokens = list(self.tokens.values())
+    self.tokens.clear()
+    for token in tokens:
+      self.jobserver.release(token)
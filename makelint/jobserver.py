@@ -0,0 +1,185 @@
+"""
+Client for the GNU make jobserver, so that when makelint is run from a
+recipe of a parallel make (e.g. ``make -j32``) it's jobs share make's job
+slots instead of adding ``jobs`` more on top of them.
+
+Make passes the jobserver in ``MAKEFLAGS``, either as
+``--jobserver-auth=R,W`` (``--jobserver-fds=R,W`` before make 4.2), where
+``R`` and ``W`` are the file descriptors of the read and write ends of a
+pipe, or as ``--jobserver-auth=fifo:PATH`` (make 4.4), a named pipe. The pipe
+holds one byte (a token) for each free job slot. Every client gets one
+implicit slot for free, and must read a token before running each job beyond
+that one, and write the same byte back once the job is done. Tokens must be
+returned even when we are interrupted, otherwise make loses the slot for the
+rest of the build. Make only passes the file descriptors to recipes that it
+knows to be recursive (e.g. prefixed with ``+``).
+
+See https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+"""
+
+import fcntl
+import logging
+import os
+import select
+import threading
+
+logger = logging.getLogger()
+
+# Stands in for the implicit slot, which isn't a byte from the pipe
+IMPLICIT_TOKEN = b""
+
+# Interval at which `JobServerClient.acquire()` checks whether the implicit
+# slot has been returned, while it waits for a token from the pipe
+ACQUIRE_INTERVAL = 0.1
+
+
+class JobServerError(Exception):
+  """
+  Raised when the jobserver pipe is closed under us.
+  """
+
+
+def parse_makeflags(makeflags):
+  """
+  Return the value of the (last) jobserver option in ``makeflags``, or None
+  if there isn't one.
+  """
+  auth = None
+  for word in makeflags.split():
+    for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+      if word.startswith(prefix):
+        auth = word[len(prefix):]
+  return auth
+
+
+def is_open(file_descriptor):
+  try:
+    fcntl.fcntl(file_descriptor, fcntl.F_GETFD)
+  except (IOError, OSError):
+    return False
+  return True
+
+
+class JobServerClient(object):
+  """
+  Acquires and returns job slots. Tokens may be acquired and returned from
+  any thread.
+  """
+
+  def __init__(self, read_fd, write_fd, owned_fds=()):
+    self.read_fd = read_fd
+    self.write_fd = write_fd
+    self.owned_fds = owned_fds
+    self.lock = threading.Lock()
+    self.implicit_free = True
+
+    # NOTE(josh): a forked child which unwinds (rather than calling _exit())
+    # must not return the tokens of it's parent
+    self.pid = os.getpid()
+
+    # Tokens read from the pipe that haven't been written back yet
+    self.held = []
+
+  @classmethod
+  def from_environ(cls, environ=None):
+    """
+    Return a client for the jobserver given in ``MAKEFLAGS`` of ``environ``
+    (default `os.environ`), or None if there isn't one (or it isn't usable).
+    """
+    if environ is None:
+      environ = os.environ
+    auth = parse_makeflags(environ.get("MAKEFLAGS", ""))
+    if auth is None:
+      return None
+
+    if auth.startswith("fifo:"):
+      try:
+        fifo_fd = os.open(auth[len("fifo:"):], os.O_RDWR | os.O_NONBLOCK)
+      except (IOError, OSError) as ex:
+        logger.warning("Failed to open jobserver fifo %s: %s", auth, ex)
+        return None
+      return cls(fifo_fd, fifo_fd, (fifo_fd,))
+
+    try:
+      read_fd, write_fd = (int(field) for field in auth.split(","))
+    except ValueError:
+      logger.warning("Unrecognized jobserver %s", auth)
+      return None
+    if read_fd < 0 or not (is_open(read_fd) and is_open(write_fd)):
+      # NOTE(josh): make didn't pass the pipe to this recipe
+      logger.warning(
+          "The jobserver isn't available (is the recipe marked with '+'?)")
+      return None
+
+    # NOTE(josh): another client may take the token between select() and
+    # read(), so the read must not block. Rather than change the flags of the
+    # pipe that we share with make, we open it again (on Linux, this gets us a
+    # file description of our own).
+    try:
+      nonblocking_fd = os.open("/proc/self/fd/{}".format(read_fd),
+                               os.O_RDONLY | os.O_NONBLOCK)
+    except (IOError, OSError):
+      return cls(read_fd, write_fd)
+    return cls(nonblocking_fd, write_fd, (nonblocking_fd,))
+
+  def try_acquire(self, timeout=None):
+    """
+    Return a token, or None if there isn't one within ``timeout`` seconds
+    (forever, if None).
+    """
+    with self.lock:
+      if self.implicit_free:
+        self.implicit_free = False
+        return IMPLICIT_TOKEN
+
+    readable, _, _ = select.select([self.read_fd], [], [], timeout)
+    if not readable:
+      return None
+    try:
+      token = os.read(self.read_fd, 1)
+    except (BlockingIOError, InterruptedError):
+      # NOTE(josh): another client of the server got there first
+      return None
+    if not token:
+      raise JobServerError("The jobserver pipe was closed")
+    with self.lock:
+      self.held.append(token)
+    return token
+
+  def acquire(self):
+    """
+    Wait for a token, and return it.
+    """
+    while True:
+      token = self.try_acquire(ACQUIRE_INTERVAL)
+      if token is not None:
+        return token
+
+  def release(self, token):
+    """
+    Return a token from `try_acquire()`.
+    """
+    with self.lock:
+      if token == IMPLICIT_TOKEN:
+        self.implicit_free = True
+        return
+      self.held.remove(token)
+    os.write(self.write_fd, token)
+
+  def close(self):
+    """
+    Return any tokens which are still held (e.g. because we were interrupted
+    while jobs were running).
+    """
+    if os.getpid() != self.pid:
+      return
+    with self.lock:
+      held = self.held
+      self.held = []
+      self.implicit_free = True
+    if held:
+      logger.debug("Returning %d jobserver tokens", len(held))
+      os.write(self.write_fd, b"".join(held))
+    for owned_fd in self.owned_fds:
+      os.close(owned_fd)
+    self.owned_fds = ()
@@ -0,0 +1,160 @@
+"""
+Record of the configuration that the state of a target tree was built with.
+Each part of the configuration that affects a phase is fingerprinted
+separately, so that a change invalidates only the outputs of the phase which
+depends on it:
+
+* ``discovery``: the source tree and the include/exclude patterns. A change
+  marks every record of the manifest index for rescan.
+* ``depmap``: the interpreter, the python-specific variables of ``env`` (e.g.
+  ``PYTHONPATH``) and the options which change the content of dependency maps.
+  A change removes all of the dependency maps.
+* ``tool:<name>``: the cache key of each tool (it's command, executable and
+  config files), or just it's serialized form if it doesn't have one. A change
+  removes that tool's stamps and logs.
+
+A target tree which predates the latch (or a tool which was not configured
+before) has nothing to compare against, so the current configuration is
+just recorded.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import makelint
+from makelint import configuration
+from makelint import manifest
+
+logger = logging.getLogger()
+
+LATCH_FILENAME = "config_latch.json"
+
+# Variables of the configured environment which can change the dependency
+# footprint of a file
+DEPMAP_ENV_PREFIXES = ("PYTHON", "VIRTUAL_ENV")
+
+
+def get_digest(material):
+  """
+  Return the digest of a JSON-serializable description of (part of) the
+  configuration.
+  """
+  content = json.dumps(configuration.serialize(material), sort_keys=True)
+  return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def get_discovery_material(cfg):
+  return {
+      "source_tree": os.path.realpath(cfg.source_tree),
+      "include_patterns": cfg.include_patterns,
+      "exclude_patterns": cfg.exclude_patterns,
+      "whitelist": sorted(cfg.whitelist),
+  }
+
+
+def get_depmap_material(cfg):
+  return {
+      "env": {key: value for key, value in cfg.env.items()
+              if key.startswith(DEPMAP_ENV_PREFIXES)},
+      "executable": os.path.realpath(sys.executable),
+      "version": sys.version,
+      # NOTE(josh): the "exec" and "pool" engines produce the same maps
+      "engine": "static" if cfg.depmap_engine == "static" else "exec",
+      "external_dependencies": cfg.external_dependencies,
+  }
+
+
+def get_tool_material(cfg, tool):
+  if hasattr(tool, "get_cache_key"):
+    return tool.get_cache_key(cfg.source_tree, cfg.env)
+  return tool
+
+
+class ConfigLatch(object):
+  """
+  Digests of each part of the configuration, as recorded in the target tree.
+  """
+
+  def __init__(self, target_tree):
+    self.target_tree = target_tree
+    self.digests = {}
+    self.dirty = False
+
+  @property
+  def filepath(self):
+    return os.path.join(self.target_tree, LATCH_FILENAME)
+
+  @classmethod
+  def load(cls, target_tree):
+    """
+    Read the latch for the given target tree. If it does not exist or cannot
+    be read, return an empty latch.
+    """
+    latch = cls(target_tree)
+    try:
+      with open(latch.filepath) as infile:
+        digests = json.load(infile)
+    except (IOError, OSError):
+      return latch
+    except ValueError:
+      logger.warning("Discarding unreadable config latch %s", latch.filepath)
+      return latch
+    if isinstance(digests, dict):
+      latch.digests = digests
+    return latch
+
+  def update(self, key, material):
+    """
+    Record the digest of ``material`` for ``key``. Return true if a
+    different digest was recorded for it before.
+    """
+    digest = get_digest(material)
+    previous = self.digests.get(key)
+    if previous == digest:
+      return False
+    self.digests[key] = digest
+    self.dirty = True
+    return previous is not None
+
+  def save(self):
+    """
+    Write the latch to disk, if it has changed.
+    """
+    if not self.dirty:
+      return
+    with manifest.write_atomic(self.filepath, "w") as outfile:
+      json.dump(self.digests, outfile, indent=2, sort_keys=True)
+      outfile.write("\n")
+    self.dirty = False
+
+
+def check_configuration(cfg):
+  """
+  Compare the configuration against the latch in the target tree, invalidate
+  the outputs of each phase whose configuration has changed, and then record
+  the new configuration. Outputs are invalidated before the latch is saved, so
+  an interrupted run can't leave them behind.
+  """
+  if not os.path.exists(cfg.target_tree):
+    os.makedirs(cfg.target_tree)
+  latch = ConfigLatch.load(cfg.target_tree)
+
+  if latch.update("discovery", get_discovery_material(cfg)):
+    logger.info("Discovery configuration changed, rescanning")
+    index = manifest.ManifestIndex.load(cfg.target_tree)
+    index.invalidate()
+    index.save()
+
+  if latch.update("depmap", get_depmap_material(cfg)):
+    logger.info("Environment changed, remapping dependencies")
+    makelint.remove_dependency_maps(cfg.target_tree, cfg.digest_algorithm)
+
+  for tool in cfg.tools:
+    if latch.update("tool:" + tool.name, get_tool_material(cfg, tool)):
+      logger.info("%s configuration changed, re-running it", tool.name)
+      makelint.remove_tool_stamps(cfg.target_tree, tool)
+
+  latch.save()
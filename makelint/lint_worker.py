@@ -0,0 +1,147 @@
+"""
+Long-lived worker which runs a linter (pylint or flake8) as a library, so
+that the cost of importing it (and, for pylint, the astroid cache of modules
+which are shared by many files) is paid once rather than once per file. See
+`makelint.tool_pool`.
+
+The worker is started as a script (rather than with ``-m``) so that it
+doesn't depend on how makelint is installed, and it only uses the standard
+library. It writes a line to stdout when it is ready (``ready``, or ``error
+<message>`` if the linter can't be imported), and then reads requests (one
+JSON object per line) from stdin. For each request it checks one file and
+writes a line with the exit status, the size of the output, and a flag which
+is 1 if the worker is about to exit (because it has checked ``--max-files``
+files or grown past ``--max-memory``), followed by the output.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+
+
+def run_pylint(source_relpath):
+  from pylint import lint
+  from pylint.reporters.text import TextReporter
+
+  outfile = io.StringIO()
+  args = [source_relpath]
+  try:
+    try:
+      run = lint.Run(args, reporter=TextReporter(outfile), exit=False)
+    except TypeError:
+      # NOTE(josh): pylint < 2.5
+      run = lint.Run(  # pylint: disable=unexpected-keyword-arg
+          args, reporter=TextReporter(outfile), do_exit=False)
+    returncode = run.linter.msg_status
+  except SystemExit as ex:
+    returncode = ex.code
+  return returncode, outfile.getvalue()
+
+
+def run_flake8(source_relpath):
+  from flake8.main import application
+
+  # NOTE(josh): flake8 writes to sys.stdout.buffer
+  outbuffer = io.BytesIO()
+  outfile = io.TextIOWrapper(outbuffer, encoding="utf-8")
+  app = application.Application()
+  try:
+    with contextlib.redirect_stdout(outfile):
+      app.run([source_relpath])
+    returncode = app.exit_code()
+  except SystemExit as ex:
+    returncode = ex.code
+  outfile.flush()
+  return returncode, outbuffer.getvalue().decode("utf-8")
+
+
+RUNNERS = {
+    "pylint": (("pylint.lint",), run_pylint),
+    "flake8": (("flake8.main.application",), run_flake8),
+}
+
+
+def get_memory_usage():
+  """
+  Return the resident set size of this process in bytes
+  """
+  try:
+    with open("/proc/self/statm") as infile:
+      return int(infile.read().split()[1]) * resource.getpagesize()
+  except (IOError, OSError, IndexError, ValueError):
+    # NOTE(josh): the peak, in KiB on Linux and bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+      return usage
+    return usage * 1024
+
+
+def serve(name, max_files, max_memory):
+  """
+  Import the linter, and then serve requests from stdin until it is closed,
+  or until the worker should be recycled.
+  """
+  # NOTE(josh): the linter may write to stdout or read from stdin, so we move
+  # the request and response streams out of the way.
+  requests = os.fdopen(os.dup(0), "r")
+  responses = os.fdopen(os.dup(1), "wb")
+  devnull = os.open(os.devnull, os.O_RDWR)
+  os.dup2(devnull, 0)
+  os.dup2(devnull, 1)
+
+  modules, runner = RUNNERS[name]
+  try:
+    for module in modules:
+      __import__(module)
+  except Exception as ex:  # pylint: disable=broad-except
+    responses.write("error {}\n".format(ex).encode("utf-8"))
+    responses.flush()
+    return 1
+  responses.write(b"ready\n")
+  responses.flush()
+
+  nfiles = 0
+  for line in requests:
+    request = json.loads(line)
+    try:
+      returncode, output = runner(request["source_relpath"])
+    except Exception as ex:  # pylint: disable=broad-except
+      returncode, output = 1, "{} crashed: {}\n".format(name, ex)
+    if not isinstance(returncode, int):
+      returncode = 1
+    nfiles += 1
+    retire = (nfiles >= max_files
+              or get_memory_usage() >= max_memory * 1024 * 1024)
+    content = output.encode("utf-8", "surrogateescape")
+    responses.write("{} {} {}\n".format(
+        returncode, len(content), int(retire)).encode("ascii"))
+    responses.write(content)
+    responses.flush()
+    if retire:
+      break
+  return 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--tool", required=True, choices=sorted(RUNNERS))
+  parser.add_argument("--max-files", type=int, default=256,
+                      help="Exit after checking this many files")
+  parser.add_argument("--max-memory", type=int, default=1024,
+                      help="Exit after a file once the resident set size "
+                      "exceeds this many MiB")
+  args = parser.parse_args()
+
+  # NOTE(josh): the directory of this script would shadow modules of the
+  # source tree, which the linter resolves the same way that it would when
+  # run as a command
+  del sys.path[0]
+  return serve(args.tool, args.max_files, args.max_memory)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Single-file index of the files tracked in the source tree.
+
+The index is a compact binary file stored at the root of the target tree. It
+contains one record per tracked directory, in walk order (pre-order, with
+children sorted). Each record stores the relative path of the directory
+exactly once, followed by the sorted names of the tracked subdirectories and
+files it contains, so that the common directory prefix of every file is
+interned. Each record also stores the modification time of the directory
+at the time it was scanned. The header stores an opaque "source stamp" which
+discovery backends can use to validate the index as a whole.
+
+Layout (all integers little-endian)::
+
+  header: magic (8 bytes), format version (u32), number of records (u32),
+          source stamp (string)
+  record: payload size (u32), payload
+  payload: mtime_ns (i64), ndirs (u32), nfiles (u32),
+           relpath, dirname * ndirs, filename * nfiles
+  string: length (u16), utf-8 bytes
+"""
+
+import contextlib
+import logging
+import os
+import struct
+
+logger = logging.getLogger()
+
+MANIFEST_FILENAME = "manifest.bin"
+
+MAGIC = b"MKLINTMF"
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct("<8sII")
+RECORD_SIZE = struct.Struct("<I")
+RECORD_HEAD = struct.Struct("<qII")
+STRING_SIZE = struct.Struct("<H")
+
+
+def get_walk_key(relpath):
+  """
+  Return a sort key for directory relpaths which reproduces the order of a
+  top-down walk with sorted children.
+  """
+  if not relpath:
+    return ()
+  return tuple(relpath.split(os.sep))
+
+
+def pack_string(value):
+  data = value.encode("utf-8", "surrogateescape")
+  return STRING_SIZE.pack(len(data)) + data
+
+
+@contextlib.contextmanager
+def write_atomic(filepath, mode="wb", times_ns=None):
+  """
+  Open a temporary file next to ``filepath`` for writing, and atomically
+  replace ``filepath`` with it when the block exits. If ``times_ns`` is given,
+  the (atime, mtime) of the new file are set to it (see `os.utime()`) before
+  it is moved into place. If the block raises, the temporary file is removed
+  and ``filepath`` is left as it was.
+  """
+  tmp_path = "{}.{}.tmp".format(filepath, os.getpid())
+  try:
+    with open(tmp_path, mode) as outfile:
+      yield outfile
+    if times_ns is not None:
+      os.utime(tmp_path, ns=times_ns)
+    os.rename(tmp_path, filepath)
+  finally:
+    if os.path.lexists(tmp_path):
+      os.unlink(tmp_path)
+
+
+def unpack_string(buf, offset):
+  (size,) = STRING_SIZE.unpack_from(buf, offset)
+  offset += STRING_SIZE.size
+  value = bytes(buf[offset:offset + size]).decode("utf-8", "surrogateescape")
+  return value, offset + size
+
+
+class DirectoryRecord(object):
+  """
+  The tracked content of a single directory of the source tree.
+  """
+
+  __slots__ = ("relpath", "mtime_ns", "dirnames", "filenames", "blob")
+
+  def __init__(self, relpath, mtime_ns, dirnames, filenames, blob=None):
+    self.relpath = relpath
+    self.mtime_ns = mtime_ns
+    self.dirnames = dirnames
+    self.filenames = filenames
+
+    # The serialized form of this record, if it was loaded from disk. Records
+    # which are unchanged are written back out byte-for-byte.
+    self.blob = blob
+
+  def pack(self):
+    """
+    Return the serialized payload of this record
+    """
+    if self.blob is None:
+      parts = [RECORD_HEAD.pack(
+          self.mtime_ns, len(self.dirnames), len(self.filenames))]
+      parts.append(pack_string(self.relpath))
+      parts.extend(pack_string(name) for name in self.dirnames)
+      parts.extend(pack_string(name) for name in self.filenames)
+      self.blob = b"".join(parts)
+    return self.blob
+
+  @classmethod
+  def unpack(cls, blob):
+    """
+    Construct a record from its serialized payload
+    """
+    mtime_ns, ndirs, nfiles = RECORD_HEAD.unpack_from(blob, 0)
+    offset = RECORD_HEAD.size
+    relpath, offset = unpack_string(blob, offset)
+    dirnames = []
+    for _ in range(ndirs):
+      name, offset = unpack_string(blob, offset)
+      dirnames.append(name)
+    filenames = []
+    for _ in range(nfiles):
+      name, offset = unpack_string(blob, offset)
+      filenames.append(name)
+    return cls(relpath, mtime_ns, dirnames, filenames, blob)
+
+
+class ManifestIndex(object):
+  """
+  In-memory view of the manifest index for one target tree. Load it once per
+  run with `load()`, replace the records with the result of discovery, and
+  then `save()` it back out.
+  """
+
+  def __init__(self, target_tree):
+    self.target_tree = target_tree
+    self.records = []
+    self.record_map = {}
+
+    # Modification time of the index file when it was loaded. Any directory
+    # modified at or after this time may have changed again within the same
+    # timestamp tick after it was scanned, so its record cannot be trusted.
+    self.index_mtime_ns = None
+    self.dirty = False
+
+    # Opaque identifier of the source that the records were generated from
+    # (e.g. the state of the git index).
+    self.stamp = ""
+
+  @property
+  def filepath(self):
+    return os.path.join(self.target_tree, MANIFEST_FILENAME)
+
+  @property
+  def nfiles(self):
+    return sum(len(record.filenames) for record in self.records)
+
+  @classmethod
+  def load(cls, target_tree):
+    """
+    Read the index for the given target tree. If it does not exist or cannot
+    be read, return an empty index.
+    """
+    index = cls(target_tree)
+    try:
+      with open(index.filepath, "rb") as infile:
+        index.index_mtime_ns = os.fstat(infile.fileno()).st_mtime_ns
+        content = infile.read()
+    except (IOError, OSError):
+      return index
+
+    try:
+      index.parse(content)
+    except (ValueError, struct.error, UnicodeDecodeError):
+      logger.warning("Discarding unreadable manifest index %s", index.filepath)
+      index.records = []
+      index.record_map = {}
+      index.index_mtime_ns = None
+      index.stamp = ""
+    return index
+
+  def parse(self, content):
+    """
+    Parse the serialized index
+    """
+    buf = memoryview(content)
+    magic, version, nrecords = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise ValueError("Unrecognized manifest header")
+    offset = HEADER.size
+    stamp, offset = unpack_string(buf, offset)
+
+    records = []
+    for _ in range(nrecords):
+      (size,) = RECORD_SIZE.unpack_from(buf, offset)
+      offset += RECORD_SIZE.size
+      if offset + size > len(buf):
+        raise ValueError("Truncated manifest")
+      records.append(DirectoryRecord.unpack(bytes(buf[offset:offset + size])))
+      offset += size
+
+    self.records = records
+    self.record_map = {record.relpath: record for record in records}
+    self.stamp = stamp
+
+  def get(self, relpath):
+    """
+    Return the record for the directory at relpath, or None if it is not
+    tracked.
+    """
+    return self.record_map.get(relpath, None)
+
+  def is_fresh(self, record, mtime_ns):
+    """
+    Return true if the given record is still valid for a directory whose
+    current modification time is mtime_ns.
+    """
+    if record.mtime_ns != mtime_ns:
+      return False
+    if self.index_mtime_ns is None or mtime_ns >= self.index_mtime_ns:
+      # NOTE(josh): "racily clean", the directory might have been modified
+      # again in the same tick that we scanned it
+      return False
+    return True
+
+  def replace(self, records):
+    """
+    Replace the set of tracked directories with the given records. Records
+    which were loaded from disk and are passed back unmodified are retained
+    without being re-encoded. Return a sorted list of relpaths for
+    directories which are no longer tracked.
+    """
+    records = sorted(records, key=lambda record: get_walk_key(record.relpath))
+    new_map = {record.relpath: record for record in records}
+    removed = sorted(set(self.record_map).difference(new_map))
+
+    if removed or len(records) != len(self.records):
+      self.dirty = True
+    elif any(self.record_map.get(record.relpath) is not record
+             for record in records):
+      self.dirty = True
+
+    self.records = records
+    self.record_map = new_map
+    return removed
+
+  def set_stamp(self, stamp):
+    """
+    Set the source stamp stored in the index header.
+    """
+    if stamp != self.stamp:
+      self.stamp = stamp
+      self.dirty = True
+
+  def invalidate(self):
+    """
+    Mark every record as out of date, so that each directory is scanned again
+    by the next discovery. The records are kept, so that directories which
+    are no longer tracked are still purged.
+    """
+    self.records = [
+        DirectoryRecord(record.relpath, 0, record.dirnames, record.filenames)
+        for record in self.records]
+    self.record_map = {record.relpath: record for record in self.records}
+    self.set_stamp("")
+    self.dirty = True
+
+  def update(self, record):
+    """
+    Add or replace the record for a single directory.
+    """
+    if record.relpath in self.record_map:
+      old_record = self.record_map[record.relpath]
+      self.records[self.records.index(old_record)] = record
+    else:
+      self.records.append(record)
+      self.records.sort(key=lambda record: get_walk_key(record.relpath))
+    self.record_map[record.relpath] = record
+    self.dirty = True
+
+  def save(self):
+    """
+    Write the index to disk, if it has changed. The new content is written to
+    a temporary file which then atomically replaces the old index.
+    """
+    if not self.dirty:
+      return
+
+    with write_atomic(self.filepath) as outfile:
+      outfile.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(self.records)))
+      outfile.write(pack_string(self.stamp))
+      for record in self.records:
+        blob = record.pack()
+        outfile.write(RECORD_SIZE.pack(len(blob)))
+        outfile.write(blob)
+    self.index_mtime_ns = os.stat(self.filepath).st_mtime_ns
+    self.dirty = False
+
+  def iter_files(self):
+    """
+    Yield (relpath_cwd, filename) for each tracked file in walk order.
+    """
+    for record in self.records:
+      for filename in record.filenames:
+        yield record.relpath, filename
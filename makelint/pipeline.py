@@ -0,0 +1,796 @@
+"""
+Pipelined execution of a run. In the default (phased) execution each phase
+(discovery, digest, depmap, tools) finishes for the whole tree before the next
+one starts. With ``pipeline`` each file moves through the phases on it's own:
+
+* directory records flow from a discovery thread, over a bounded queue, into
+  a pool of digest threads
+* the dependency map of a file is checked (and, if it is out of date, mapped
+  again) as soon as the digests of the dependencies that it lists are final,
+  rather than once every file is digested
+* the tools are executed on a file as soon as it's dependency map is final
+
+Dependency mapping and tool jobs share the ``jobs`` slots (and the tokens of
+the make jobserver, if there is one), and tool jobs are preferred so that
+results come out as early as possible. All of the
+bookkeeping (the stat cache, the reverse dependency index and the `FileMemo`)
+is done on the thread that called `run()`. Tool jobs run on threads, not in
+forked children (the tools themselves are still separate processes, or
+`WorkerTool` workers). Of the tool jobs which are ready, the first in
+``job_order`` (see `makelint.scheduler.get_job_priority()`) is launched
+first, and the time that each one takes is added to the cost model (see
+`makelint.costmodel`).
+
+A new dependency map may list dependencies whose digest hasn't been computed
+yet. Once they have, any such digests in the map are filled in, so the maps
+are the same as those of a phased run.
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent import futures
+
+import makelint
+from makelint import costmodel
+from makelint import depindex
+from makelint import depmap
+from makelint import depmap_pool
+from makelint import fingerprints
+from makelint import jobrunner
+from makelint import jobserver as jobserver_client
+from makelint import resultcache
+from makelint import scheduler
+from makelint import statcache
+from makelint import static_dependencies
+
+logger = logging.getLogger()
+
+# Number of directory records that discovery may get ahead of digesting
+RECORD_QUEUE_SIZE = 64
+
+# Number of digests to keep in flight for each job slot
+DIGEST_DEPTH = 4
+
+# Progress index of the digest and depmap steps. The tools follow.
+DIGEST_STEP = 1
+DEPMAP_STEP = 2
+
+
+class DiscoveryStopped(Exception):
+  """
+  Raised on the discovery thread when the pipeline is stopped early.
+  """
+
+
+class Waiter(object):
+  """
+  A callback which is called once a number of digests are final.
+  """
+
+  __slots__ = ("count", "callback")
+
+  def __init__(self, callback):
+    self.count = 0
+    self.callback = callback
+
+
+def is_external(path):
+  return fingerprints.is_fingerprint(path) or os.path.isabs(path)
+
+
+class Pipeline(object):
+  """
+  State of one pipelined run. See the module documentation.
+  """
+
+  # pylint: disable=too-many-instance-attributes
+
+  def __init__(self, cfg, progress, memo, merged_log=None,
+               result_cache=None, remote_cache=None, jobserver=None):
+    self.cfg = cfg
+    self.source_tree = cfg.source_tree
+    self.target_tree = cfg.target_tree
+    self.digest_algorithm = cfg.digest_algorithm
+    self.digest_suffix = makelint.get_digest_suffix(cfg.digest_algorithm)
+    self.njobs = max(cfg.jobs, 1)
+    self.progress = progress
+    self.memo = memo
+    self.merged_log = merged_log
+    self.result_cache = result_cache
+    self.remote_cache = remote_cache
+
+    # Completion events from the other threads, which are handled in order
+    self.events = queue.Queue()
+    self.records = queue.Queue(maxsize=RECORD_QUEUE_SIZE)
+    self.stopped = threading.Event()
+    self.discovery_thread = None
+    self.output = 0
+
+    # Discovery: the tracked files in the order they were found, and whether
+    # all of them have been found.
+    self.files = []
+    self.tracked = set()
+    self.sizes = {}
+    self.ndirs = 0
+    self.discovered = False
+    self.full = True
+
+    # Digest: files waiting to be digested, the number in flight, and the
+    # digest of each file which is done (None if it couldn't be digested)
+    self.statcache = statcache.StatCache.load(self.target_tree)
+    self.costs = costmodel.CostModel.load(self.target_tree)
+    self.digest_queue = collections.deque()
+    self.ndigesting = 0
+    self.digests = {}
+    self.waiters = collections.defaultdict(list)
+
+    # Depmap
+    self.env = fingerprints.EnvironmentFingerprints()
+    self.revindex = depindex.DependencyIndex.load(self.target_tree)
+    self.depmap_queue = collections.deque()
+    self.resolver = None
+    self.resolver_lock = threading.Lock()
+    self.depmap_pool = None
+
+    # Tools: jobs waiting to be launched (a heap, in job order), jobs waiting
+    # for a running job with the same cache key, and results which aren't in
+    # the remote cache yet.
+    self.passes = [
+        scheduler.ToolPass(
+            tool, DEPMAP_STEP + idx + 1, self.get_tool_key(tool))
+        for idx, tool in enumerate(cfg.tools)]
+    self.tool_queue = []
+    self.tool_seq = itertools.count()
+    self.running = {}
+    self.cached = {}
+    self.unfetched = []
+    self.unstored = {}
+
+    # Number of depmap and tool jobs in flight, which share the job slots,
+    # and whether a job is waiting for a token from the jobserver (a
+    # `JobServerClient`)
+    self.nslots = 0
+    self.jobserver = jobserver
+    self.token_wait = False
+    self.counts = {DIGEST_STEP: 0, DEPMAP_STEP: 0}
+    for toolpass in self.passes:
+      self.counts[toolpass.tool_idx] = 0
+
+    self.digest_executor = futures.ThreadPoolExecutor(max_workers=self.njobs)
+    self.job_executor = futures.ThreadPoolExecutor(max_workers=self.njobs)
+
+  def get_tool_key(self, tool):
+    if ((self.result_cache is not None or self.remote_cache is not None)
+        and hasattr(tool, "get_cache_key")):
+      return tool.get_cache_key(self.source_tree, self.cfg.env)
+    return None
+
+  def run(self, relpaths=None):
+    """
+    Process every tracked file (or only those at ``relpaths``, if given) and
+    return the bitwise or of the exit status of the tools.
+    """
+    # NOTE(josh): registers the name of each tool with the progress report
+    for toolpass in self.passes:
+      self.progress(tool_idx=toolpass.tool_idx, tool=toolpass.tool.name)
+
+    if self.cfg.depmap_engine == "static":
+      self.resolver = static_dependencies.ImportResolver(self.source_tree)
+    elif self.cfg.depmap_engine == "pool":
+      self.depmap_pool = depmap_pool.DependencyPool(
+          self.njobs, self.cfg.depmap_preload)
+
+    if relpaths is None:
+      self.discovery_thread = threading.Thread(target=self.discover)
+      self.discovery_thread.start()
+    else:
+      self.full = False
+      for relpath_cwd, filename in makelint.get_file_list(
+          self.target_tree, relpaths=relpaths):
+        self.add_file(relpath_cwd, filename)
+      self.finish_discovery()
+
+    try:
+      while True:
+        self.launch()
+        self.report()
+        if self.is_done():
+          break
+        timeout = None
+        if self.token_wait:
+          timeout = jobserver_client.ACQUIRE_INTERVAL
+        try:
+          event = self.events.get(timeout=timeout)
+        except queue.Empty:
+          continue
+        self.handle(event)
+    finally:
+      self.stop()
+    self.save()
+    self.report()
+    self.memo.log_counts("pipeline")
+    return self.output
+
+  def is_stopping(self):
+    return self.cfg.fail_fast and self.output
+
+  def is_done(self):
+    if self.ndigesting or self.nslots:
+      return False
+    if self.is_stopping():
+      return True
+    return (self.discovered and not self.digest_queue
+            and not self.depmap_queue and not self.tool_queue)
+
+  def report(self):
+    kwargs = {"counts": self.counts, "nfiles": len(self.files),
+              "ndirs": self.ndirs, "dir_idx": self.ndirs}
+    step = DEPMAP_STEP
+    if self.passes:
+      step = self.passes[-1].tool_idx
+    self.progress(tool_idx=step, file_idx=self.counts[step], **kwargs)
+
+  def stop(self):
+    """
+    Stop the other threads and wait for them.
+    """
+    self.stopped.set()
+    if self.discovery_thread is not None:
+      while self.discovery_thread.is_alive():
+        try:
+          self.records.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      self.discovery_thread.join()
+    self.digest_executor.shutdown()
+    self.job_executor.shutdown()
+    while not self.events.empty():
+      event = self.events.get()
+      if event[0] in ("mapped", "tool"):
+        self.release_token(event[1])
+    if self.depmap_pool is not None:
+      self.depmap_pool.close()
+    for toolpass in self.passes:
+      if toolpass.workers:
+        toolpass.tool.stop_workers()
+
+  def save(self):
+    if self.full and self.discovered:
+      self.statcache.retain(self.tracked)
+      self.revindex.retain(self.tracked)
+      self.costs.retain(self.tracked)
+    self.statcache.save()
+    self.costs.save()
+    self.revindex.save()
+    self.store_results()
+
+  # -------------------------------------------------------------------------
+  # Discovery
+  # -------------------------------------------------------------------------
+
+  def discover(self):
+    """
+    Body of the discovery thread.
+    """
+    try:
+      index = makelint.discover_sourcetree(
+          self.source_tree, self.target_tree, self.cfg.get_path_filter(),
+          makelint.NullProgressReport(), self.njobs, self.cfg.discovery,
+          on_record=self.put_record)
+    except DiscoveryStopped:
+      return
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Discovery failed")
+      index = None
+    self.events.put(("discovered", index))
+
+  def put_record(self, record):
+    while not self.stopped.is_set():
+      try:
+        self.records.put(record, timeout=0.1)
+      except queue.Full:
+        continue
+      self.events.put(("record",))
+      return
+    raise DiscoveryStopped()
+
+  def pull_records(self, limit=None):
+    """
+    Add the files of directory records from the discovery thread, until
+    there are ``limit`` files waiting to be digested.
+    """
+    while limit is None or len(self.digest_queue) < limit:
+      try:
+        record = self.records.get_nowait()
+      except queue.Empty:
+        return
+      self.ndirs += 1
+      for filename in record.filenames:
+        self.add_file(record.relpath, filename)
+
+  def add_file(self, relpath_cwd, filename):
+    relpath_file = os.path.join(relpath_cwd, filename)
+    if relpath_file in self.tracked:
+      return
+    self.tracked.add(relpath_file)
+    self.files.append((relpath_cwd, filename))
+
+    source_path = os.path.join(self.source_tree, relpath_file)
+    stat = self.memo.stat(source_path)
+    if stat is None:
+      logger.warning("Failed to stat %s", source_path)
+      self.set_digest(relpath_file, None)
+      return
+    self.sizes[relpath_file] = stat.st_size
+    if self.statcache.is_clean(relpath_file, stat):
+      self.set_digest(relpath_file, self.statcache.get(relpath_file).digest)
+    else:
+      logger.debug("Digesting: %s", relpath_file)
+      self.digest_queue.append((relpath_file, source_path, stat))
+
+  def finish_discovery(self):
+    """
+    Called once every tracked file has been added. Files which list a
+    dependency which isn't tracked no longer wait for it.
+    """
+    self.discovered = True
+    for relpath in [relpath for relpath in self.waiters
+                    if relpath not in self.tracked]:
+      self.release(relpath)
+
+  # -------------------------------------------------------------------------
+  # Digest
+  # -------------------------------------------------------------------------
+
+  def digest_job(self, job):
+    self.events.put(("digest",) + makelint.digest_job(
+        job, self.digest_algorithm))
+
+  def finish_digest(self, job, hexdigest):
+    relpath_file, _, stat = job
+    if hexdigest is not None:
+      digest_path = os.path.join(
+          self.target_tree, relpath_file + self.digest_suffix)
+      record = self.statcache.get(relpath_file)
+      if record is None:
+        old_digest = self.memo.read_text(digest_path)
+      elif self.memo.exists(digest_path):
+        old_digest = record.digest
+      else:
+        old_digest = None
+      if hexdigest != old_digest:
+        makelint.write_digest(digest_path, hexdigest)
+        self.memo.put_text(digest_path, hexdigest)
+      self.statcache.update(relpath_file, stat, hexdigest)
+    self.set_digest(relpath_file, hexdigest)
+
+  def set_digest(self, relpath_file, hexdigest):
+    self.digests[relpath_file] = hexdigest
+    self.counts[DIGEST_STEP] += 1
+    self.release(relpath_file)
+    self.check_depmap(relpath_file)
+
+  def has_digest(self, relpath):
+    """
+    Return true if the digest of the file at relpath is final for this run
+    """
+    if relpath in self.digests:
+      return True
+    return self.discovered and relpath not in self.tracked
+
+  def get_digest(self, relpath):
+    if fingerprints.is_fingerprint(relpath):
+      return self.env.get(relpath)
+    record = self.statcache.get(relpath)
+    if record is not None:
+      return record.digest
+    return self.memo.read_text(
+        os.path.join(self.target_tree, relpath + self.digest_suffix))
+
+  def wait_for(self, relpaths, callback):
+    """
+    Call ``callback()`` once the digests of all of the files at relpaths are
+    final.
+    """
+    waiter = Waiter(callback)
+    for relpath in set(relpaths):
+      if not self.has_digest(relpath):
+        waiter.count += 1
+        self.waiters[relpath].append(waiter)
+    if not waiter.count:
+      callback()
+
+  def release(self, relpath):
+    for waiter in self.waiters.pop(relpath, []):
+      waiter.count -= 1
+      if not waiter.count:
+        waiter.callback()
+
+  # -------------------------------------------------------------------------
+  # Depmap
+  # -------------------------------------------------------------------------
+
+  def get_depmap_path(self, relpath_file):
+    return os.path.join(
+        self.target_tree, relpath_file + makelint.DEPENDENCY_SUFFIX)
+
+  def check_depmap(self, relpath_file):
+    """
+    Check the dependency map of a file which has just been digested, once the
+    digests of the dependencies that it lists are final.
+    """
+    if self.revindex.contains(relpath_file):
+      deps = self.revindex.get_dependencies(relpath_file)
+      self.wait_for(
+          [path for path, digest in deps
+           if digest is not None and not is_external(path)],
+          lambda: self.check_indexed(relpath_file,
+                                     [path for path, _ in deps]))
+      return
+
+    depmap_path = self.get_depmap_path(relpath_file)
+    if not self.memo.exists(depmap_path):
+      self.queue_depmap(relpath_file)
+      return
+    try:
+      depmap_data = self.memo.read_depmap(depmap_path)
+    except (IOError, OSError, ValueError):
+      self.queue_depmap(relpath_file)
+      return
+    self.wait_for(
+        [path for path, digest in zip(depmap_data.paths, depmap_data.digests)
+         if digest is not None and not is_external(path)],
+        lambda: self.check_unindexed(relpath_file))
+
+  def queue_depmap(self, relpath_file):
+    """
+    Queue a file to have it's dependencies mapped again. With "failed" in
+    ``job_order``, the files which failed a tool on their last run go to the
+    front, so that their tool jobs are ready early.
+    """
+    if "failed" in self.cfg.job_order and self.has_failed(relpath_file):
+      self.depmap_queue.appendleft(relpath_file)
+    else:
+      self.depmap_queue.append(relpath_file)
+
+  def has_failed(self, relpath_file):
+    relpath_cwd, filename = os.path.split(relpath_file)
+    target_cwd = os.path.join(self.target_tree, relpath_cwd)
+    return any(
+        self.memo.read_text(toolpass.tool.get_stamp(target_cwd, filename))
+        == "fail" for toolpass in self.passes)
+
+  def check_indexed(self, relpath_file, dependencies):
+    depmap_path = self.get_depmap_path(relpath_file)
+    self.revindex.mark_changed(self.source_tree, self.get_digest, self.memo,
+                               dependencies)
+    if (self.revindex.is_stale(relpath_file)
+        or not self.memo.exists(depmap_path + self.digest_suffix)):
+      self.queue_depmap(relpath_file)
+    else:
+      self.finish_depmap(relpath_file)
+
+  def check_unindexed(self, relpath_file):
+    if makelint.depmap_is_uptodate(
+        self.target_tree, relpath_file, self.source_tree,
+        self.digest_algorithm, self.memo, self.env):
+      # NOTE(josh): the dependency map predates the index
+      self.revindex.update(
+          relpath_file, self.memo.read_depmap(
+              self.get_depmap_path(relpath_file)),
+          self.source_tree, self.memo)
+      self.finish_depmap(relpath_file)
+    else:
+      self.queue_depmap(relpath_file)
+
+  def map_job(self, token, relpath_file):
+    start = time.time()
+    try:
+      self.map_dependencies(relpath_file)
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Failed to map dependencies of %s", relpath_file)
+    self.events.put(("mapped", token, relpath_file, time.time() - start))
+
+  def map_dependencies(self, relpath_file):
+    """
+    Map the dependencies of one file (on a job thread) with the configured
+    engine (see `makelint.depmapper.map_sourcetree_dependencies()`).
+    """
+    logger.debug("Mapping dependencies: %s", relpath_file)
+    content = None
+    if self.resolver is not None:
+      with self.resolver_lock:
+        content = self.resolver.map(
+            self.target_tree, relpath_file, self.digest_suffix)
+    elif self.depmap_pool is not None:
+      content = self.depmap_pool.map(
+          self.source_tree, self.target_tree, relpath_file,
+          self.digest_suffix)
+    if content is None:
+      makelint.map_dependencies(self.source_tree, self.target_tree,
+                                relpath_file, self.digest_algorithm)
+    else:
+      makelint.write_dependencies(self.target_tree, relpath_file, content,
+                                  self.digest_algorithm)
+
+  def finish_map(self, relpath_file):
+    """
+    Called when a file has been mapped. The map may have been made before
+    some of it's dependencies were digested, so it's completed once they
+    have been.
+    """
+    depmap_path = self.get_depmap_path(relpath_file)
+    self.memo.invalidate(depmap_path)
+    self.memo.invalidate(depmap_path + self.digest_suffix)
+    try:
+      depmap_data = self.memo.read_depmap(depmap_path)
+    except (IOError, OSError, ValueError):
+      self.finish_depmap(relpath_file)
+      return
+    self.wait_for(
+        [path for path in depmap_data.paths if not is_external(path)],
+        lambda: self.complete_map(relpath_file, depmap_data))
+
+  def complete_map(self, relpath_file, depmap_data):
+    digests = list(depmap_data.digests)
+    changed = False
+    for idx, path in enumerate(depmap_data.paths):
+      digest = self.digests.get(path)
+      if digest is not None and digest != digests[idx]:
+        digests[idx] = digest
+        changed = True
+    depmap_data = depmap.DependencyMap(
+        depmap_data.paths, digests, depmap_data.names)
+    if self.cfg.external_dependencies == "fingerprint":
+      collapsed = self.env.collapse(depmap_data)
+      if len(collapsed) != len(depmap_data):
+        depmap_data = collapsed
+        changed = True
+
+    if changed:
+      depmap_path = self.get_depmap_path(relpath_file)
+      makelint.write_dependencies(self.target_tree, relpath_file,
+                                  depmap_data.pack(), self.digest_algorithm)
+      self.memo.invalidate(depmap_path)
+      self.memo.invalidate(depmap_path + self.digest_suffix)
+    self.revindex.update(relpath_file, depmap_data, self.source_tree,
+                         self.memo)
+    self.finish_depmap(relpath_file)
+
+  def finish_depmap(self, relpath_file):
+    """
+    Called once the dependency map of a file is final. Queue the tool jobs
+    for it.
+    """
+    self.counts[DEPMAP_STEP] += 1
+    relpath_cwd, filename = os.path.split(relpath_file)
+    target_cwd = os.path.join(self.target_tree, relpath_cwd)
+    depmap_path = self.get_depmap_path(relpath_file)
+    for toolpass in self.passes:
+      toolstamp_path = toolpass.tool.get_stamp(target_cwd, filename)
+      if scheduler.toolstamp_is_uptodate(
+          toolstamp_path, depmap_path, self.digest_algorithm, self.memo):
+        self.counts[toolpass.tool_idx] += 1
+        if self.memo.read_text(toolstamp_path) == "fail":
+          self.output |= 1
+          with jobrunner.MERGED_LOG_LOCK:
+            scheduler.cat_log(toolstamp_path + ".log",
+                              "{} (cached)".format(relpath_file),
+                              self.merged_log)
+        continue
+
+      result_key = None
+      if toolpass.tool_key is not None:
+        result_key = resultcache.get_result_key(
+            toolpass.tool_key, self.digest_algorithm, relpath_file,
+            self.memo.read_depmap(depmap_path))
+        self.unfetched.append(result_key)
+      estimate = self.costs.estimate(toolpass.tool.name, relpath_file,
+                                     self.sizes.get(relpath_file, 0))
+      priority = scheduler.get_job_priority(
+          self.cfg.job_order, toolstamp_path,
+          os.path.join(self.source_tree, relpath_file), estimate, self.memo)
+      # NOTE(josh): heapq pops the smallest, and the sequence number keeps
+      # ties in the order that they became ready
+      heapq.heappush(self.tool_queue, (
+          tuple(-value for value in priority), next(self.tool_seq),
+          (toolpass, relpath_cwd, filename, result_key)))
+
+  # -------------------------------------------------------------------------
+  # Tools
+  # -------------------------------------------------------------------------
+
+  def fetch_results(self):
+    """
+    Query the remote cache, in one batch, for the jobs queued since the last
+    query.
+    """
+    keys = set(self.unfetched)
+    self.unfetched = []
+    if self.remote_cache is None or not keys:
+      return
+    if self.result_cache is not None:
+      keys = [key for key in keys if not self.result_cache.contains(key)]
+    fetched = self.remote_cache.fetch(keys)
+    self.cached.update(fetched)
+    if self.result_cache is not None:
+      for result_key, entry in fetched.items():
+        self.result_cache.put(result_key, entry)
+
+  def store_results(self):
+    if self.remote_cache is not None and self.unstored:
+      self.remote_cache.store(self.unstored)
+    self.unstored = {}
+
+  def launch_tool(self, token):
+    """
+    Take the next job from the tool queue and either restore it's result from
+    the caches, defer it behind a running job with the same cache key, or
+    launch it with the given jobserver token. Return true if it was launched.
+    """
+    queued = heapq.heappop(self.tool_queue)
+    toolpass, relpath_cwd, filename, result_key = queued[-1]
+    if result_key is not None and result_key in self.running:
+      self.running[result_key].append(queued)
+      return False
+
+    tool = toolpass.tool
+    target_cwd = os.path.join(self.target_tree, relpath_cwd)
+    source_relpath = os.path.join(relpath_cwd, filename)
+    toolstamp_path = tool.get_stamp(target_cwd, filename)
+    depmap_path = os.path.join(target_cwd,
+                               filename + makelint.DEPENDENCY_SUFFIX)
+
+    self.counts[toolpass.tool_idx] += 1
+    if self.memo.exists(toolstamp_path):
+      os.remove(toolstamp_path)
+    # NOTE(josh): the stamp is about to be rewritten, by a job thread
+    self.memo.invalidate(toolstamp_path)
+
+    if result_key is not None:
+      entry = self.cached.get(result_key)
+      if entry is None and self.result_cache is not None:
+        entry = self.result_cache.get(result_key)
+      if entry is not None:
+        with jobrunner.MERGED_LOG_LOCK:
+          self.output |= scheduler.restore_cached_result(
+              entry, toolstamp_path, depmap_path, source_relpath,
+              self.merged_log, self.digest_suffix)
+        return False
+      self.running[result_key] = []
+
+    if toolpass.workers is None:
+      toolpass.workers = False
+      if hasattr(tool, "start_workers"):
+        toolpass.workers = tool.start_workers(
+            self.source_tree, self.cfg.env, self.njobs)
+    self.nslots += 1
+    self.job_executor.submit(
+        self.tool_job, token, toolpass,
+        [(source_relpath, toolstamp_path, depmap_path, result_key)])
+    return True
+
+  def tool_job(self, token, toolpass, jobs):
+    start = time.time()
+    status = jobrunner.call_tool_jobs(
+        toolpass.tool, scheduler.execute_tool_jobs, self.source_tree,
+        toolpass.tool, self.cfg.env, jobs, self.merged_log,
+        self.digest_suffix)
+    self.events.put(
+        ("tool", token, toolpass, jobs, status, time.time() - start))
+
+  def finish_tool(self, toolpass, jobs, status, seconds):
+    self.output |= status
+    for source_relpath, toolstamp_path, _, result_key in jobs:
+      self.costs.record(toolpass.tool.name, source_relpath,
+                        seconds / len(jobs), self.sizes.get(source_relpath))
+      if result_key is None:
+        continue
+      entry = scheduler.read_tool_result(toolstamp_path, source_relpath)
+      if entry is not None:
+        self.cached[result_key] = entry
+        self.unstored[result_key] = entry
+        if self.result_cache is not None:
+          try:
+            self.result_cache.put(result_key, entry)
+          except (IOError, OSError) as ex:
+            logger.warning("Failed to store result in %s: %s",
+                           self.result_cache.cache_dir, ex)
+      # NOTE(josh): jobs with the same key are restored from the result
+      for queued in self.running.pop(result_key, []):
+        heapq.heappush(self.tool_queue, queued)
+
+  # -------------------------------------------------------------------------
+  # Scheduling
+  # -------------------------------------------------------------------------
+
+  def acquire_token(self):
+    """
+    Return a jobserver token for the next job, without waiting, or None if
+    there isn't one (in which case `run()` polls until there is).
+    """
+    if self.jobserver is None:
+      return jobserver_client.IMPLICIT_TOKEN
+    token = self.jobserver.try_acquire(0)
+    self.token_wait = token is None
+    return token
+
+  def release_token(self, token):
+    if self.jobserver is not None:
+      self.jobserver.release(token)
+
+  def launch(self):
+    """
+    Start as much work as there are slots for.
+    """
+    self.pull_records(self.njobs * DIGEST_DEPTH)
+    if self.is_stopping():
+      return
+
+    while (self.digest_queue
+           and self.ndigesting < self.njobs * DIGEST_DEPTH):
+      self.ndigesting += 1
+      self.digest_executor.submit(
+          self.digest_job, self.digest_queue.popleft())
+
+    self.fetch_results()
+    self.token_wait = False
+    while self.nslots < self.njobs and (self.tool_queue or self.depmap_queue):
+      token = self.acquire_token()
+      if token is None:
+        return
+      if self.tool_queue:
+        if not self.launch_tool(token):
+          self.release_token(token)
+        if self.is_stopping():
+          return
+      else:
+        self.nslots += 1
+        self.job_executor.submit(
+            self.map_job, token, self.depmap_queue.popleft())
+
+  def handle(self, event):
+    kind = event[0]
+    if kind == "record":
+      return
+    if kind == "discovered":
+      if event[1] is None:
+        self.output |= 1
+      self.pull_records()
+      self.finish_discovery()
+    elif kind == "digest":
+      self.ndigesting -= 1
+      self.finish_digest(event[1], event[2])
+    elif kind == "mapped":
+      self.nslots -= 1
+      self.release_token(event[1])
+      _, _, relpath_file, seconds = event
+      self.costs.record("depmap", relpath_file, seconds,
+                        self.sizes.get(relpath_file))
+      self.finish_map(relpath_file)
+    elif kind == "tool":
+      self.nslots -= 1
+      self.release_token(event[1])
+      self.finish_tool(*event[2:])
+
+
+def run_pipeline(cfg, progress, memo, relpaths=None, merged_log=None,
+                 result_cache=None, remote_cache=None, jobserver=None):
+  """
+  Run every phase for the source tree of ``cfg`` (or only for the files at
+  ``relpaths``) as a pipeline. Return the bitwise or of the exit status of
+  the tools. Each job holds a token from ``jobserver`` (a
+  `JobServerClient`), if given.
+  """
+  if not os.path.exists(cfg.target_tree):
+    os.makedirs(cfg.target_tree)
+  progress(tool_idx=DIGEST_STEP, tool=cfg.digest_algorithm)
+  progress(tool_idx=DEPMAP_STEP, tool="depmap")
+  return Pipeline(cfg, progress, memo, merged_log, result_cache,
+                  remote_cache, jobserver).run(relpaths)
@@ -0,0 +1,184 @@
+"""
+Client for a remote tool-result cache, so that a fleet of machines (e.g. CI
+agents) can share lint results. The protocol is plain HTTP on
+content-addressed keys (see `resultcache.get_result_key()`), relative to a
+base URL:
+
+* ``GET <base>/<key>`` returns the serialized entry, or 404
+* ``PUT <base>/<key>`` stores the serialized entry
+* ``POST <base>/exists`` with a JSON list of keys as the body returns the JSON
+  list of those keys which are present
+
+See `makelint.cache_server` for a reference implementation. Any error talking
+to the server disables the remote cache for the rest of the run, and the
+tools are executed locally as though it were a miss.
+"""
+
+import http.client
+import json
+import logging
+import threading
+from concurrent import futures
+from urllib.parse import urlsplit
+
+from makelint import resultcache
+
+logger = logging.getLogger()
+
+# Maximum number of keys in a single existence check
+EXISTS_BATCH_SIZE = 1000
+
+
+class RemoteCacheError(Exception):
+  """
+  Raised when the remote cache returns an unexpected response.
+  """
+
+
+class RemoteCache(object):
+  """
+  Talks to a remote cache at the given base URL over a pool of up to
+  ``max_connections`` keep-alive connections.
+  """
+
+  def __init__(self, url, timeout=10, max_connections=8):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+      raise ValueError("Unsupported remote cache url {}".format(url))
+    self.url = url
+    self.scheme = parts.scheme
+    self.netloc = parts.netloc
+    self.prefix = parts.path.rstrip("/")
+    self.timeout = timeout
+    self.max_connections = max_connections
+    self.local = threading.local()
+    self.pool = None
+    self.failed = False
+
+  def get_pool(self):
+    """
+    Return the thread pool used for transfers. Each thread keeps it's own
+    connection alive between calls.
+    """
+    if self.pool is None:
+      self.pool = futures.ThreadPoolExecutor(self.max_connections)
+    return self.pool
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.shutdown()
+      self.pool = None
+
+  def get_connection(self):
+    """
+    Return the keep-alive connection for the calling thread
+    """
+    conn = getattr(self.local, "conn", None)
+    if conn is None:
+      if self.scheme == "https":
+        conn = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+      else:
+        conn = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+      self.local.conn = conn
+    return conn
+
+  def request(self, method, name, body=None, headers=None):
+    """
+    Make a request on the calling thread's connection and return a tuple of
+    the response status and body.
+    """
+    path = "{}/{}".format(self.prefix, name)
+    headers = headers or {}
+    conn = self.get_connection()
+    try:
+      conn.request(method, path, body=body, headers=headers)
+      response = conn.getresponse()
+    except (http.client.RemoteDisconnected, BrokenPipeError,
+            ConnectionResetError):
+      # NOTE(josh): the server may have closed an idle keep-alive connection,
+      # so reconnect and try once more
+      conn.close()
+      conn.connect()
+      conn.request(method, path, body=body, headers=headers)
+      response = conn.getresponse()
+    return response.status, response.read()
+
+  def disable(self, ex):
+    if not self.failed:
+      logger.warning(
+          "Remote cache %s failed, disabling it for this run: %s",
+          self.url, ex)
+    self.failed = True
+
+  def find(self, keys):
+    """
+    Return the set of keys which are present in the remote cache
+    """
+    found = set()
+    keys = list(keys)
+    for idx in range(0, len(keys), EXISTS_BATCH_SIZE):
+      if self.failed:
+        break
+      batch = keys[idx:idx + EXISTS_BATCH_SIZE]
+      try:
+        status, body = self.request(
+            "POST", "exists", json.dumps(batch).encode("utf-8"),
+            {"Content-Type": "application/json"})
+        if status != 200:
+          raise RemoteCacheError("HTTP {} from exists".format(status))
+        found.update(json.loads(body.decode("utf-8")))
+      except (IOError, OSError, ValueError, http.client.HTTPException,
+              RemoteCacheError) as ex:
+        self.disable(ex)
+    return found.intersection(keys)
+
+  def fetch_one(self, key):
+    if self.failed:
+      return None
+    try:
+      status, body = self.request("GET", key)
+      if status == 404:
+        return None
+      if status != 200:
+        raise RemoteCacheError("HTTP {} from GET {}".format(status, key))
+      return resultcache.unpack_entry(body)
+    except (IOError, OSError, ValueError, http.client.HTTPException,
+            RemoteCacheError) as ex:
+      self.disable(ex)
+    return None
+
+  def store_one(self, item):
+    if self.failed:
+      return
+    key, entry = item
+    try:
+      status, _ = self.request(
+          "PUT", key, resultcache.pack_entry(entry),
+          {"Content-Type": "application/octet-stream"})
+      if status not in (200, 201, 204):
+        raise RemoteCacheError("HTTP {} from PUT {}".format(status, key))
+    except (IOError, OSError, http.client.HTTPException,
+            RemoteCacheError) as ex:
+      self.disable(ex)
+
+  def fetch(self, keys):
+    """
+    Return a dictionary mapping each key that could be retrieved from the
+    remote cache to it's `CacheEntry`.
+    """
+    keys = sorted(self.find(keys))
+    if not keys:
+      return {}
+    entries = {}
+    for key, entry in zip(keys, self.get_pool().map(self.fetch_one, keys)):
+      if entry is not None:
+        entries[key] = entry
+    return entries
+
+  def store(self, entries):
+    """
+    Upload a dictionary mapping keys to `CacheEntry` to the remote cache
+    """
+    if self.failed or not entries:
+      return
+    list(self.get_pool().map(self.store_one, sorted(entries.items())))
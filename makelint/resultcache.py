@@ -0,0 +1,207 @@
+"""
+Content-addressed cache of tool results which can be shared between target
+trees (e.g. several worktrees of the same repository, or many CI checkouts on
+the same machine).
+
+The key of a result is a digest of the tool identity and configuration, the
+digest of the source file, and the paths and digests of everything in it's
+dependency map. The path of the source file itself is not part of the key, so
+files with identical content and dependencies (e.g. empty ``__init__.py``
+files) share a result.
+
+Each entry is a single file in a two-level directory structure under the cache
+directory, named by the key. The first line of the file is a JSON header with
+the pass/fail status and the relative path of the file that produced the
+result, and the rest of the file is the tool log. Entries are written to a
+temporary file and then renamed into place, so concurrent writers (and readers)
+never see a partial entry. The modification time of an entry is bumped on
+each hit, and `ResultCache.trim()` evicts the least recently used entries
+once the cache grows beyond it's maximum size.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+CacheEntry = collections.namedtuple("CacheEntry", ["status", "relpath", "log"])
+
+# Temporary files older than this are left over from a killed writer
+STALE_TMP_SECONDS = 3600
+
+# When the cache is trimmed, evict down to this fraction of the maximum size
+# so that we don't have to trim again on the very next run
+TRIM_FRACTION = 0.9
+
+
+def pack_entry(entry):
+  """
+  Return the serialized form of a `CacheEntry`
+  """
+  header = json.dumps({"status": entry.status, "relpath": entry.relpath})
+  return header.encode("utf-8") + b"\n" + entry.log
+
+
+def unpack_entry(blob):
+  """
+  Construct a `CacheEntry` from it's serialized form. Raises ValueError if
+  the blob is malformed.
+  """
+  header, _, log = blob.partition(b"\n")
+  header = json.loads(header.decode("utf-8"))
+  if not isinstance(header, dict) or header.get("status") not in (
+      "pass", "fail"):
+    raise ValueError("Malformed result cache entry")
+  return CacheEntry(header["status"], header["relpath"], log)
+
+
+def get_result_key(tool_key, digest_algorithm, relpath_file, depmap_data):
+  """
+  Return the cache key for the result of a tool on the file at relpath_file
+  with the given dependency map (a `DependencyMap`).
+  """
+  deps = []
+  for path, digest in zip(depmap_data.paths, depmap_data.digests):
+    if path == relpath_file:
+      path = None
+    deps.append([path, digest])
+  material = {
+      "tool": tool_key,
+      "digest_algorithm": digest_algorithm,
+      "deps": sorted(deps, key=lambda dep: (dep[0] or "", dep[1] or "")),
+  }
+  return hashlib.sha1(
+      json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+  """
+  A directory of cached tool results, bounded to max_size bytes.
+  """
+
+  def __init__(self, cache_dir, max_size):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+
+    # Set when we have added entries to the cache, meaning that it may have
+    # grown beyond it's maximum size.
+    self.dirty = False
+
+  def get_path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key[2:])
+
+  def contains(self, key):
+    return os.path.exists(self.get_path(key))
+
+  def read_blob(self, key):
+    """
+    Return the serialized entry for key, or None if it isn't in the cache.
+    """
+    entry_path = self.get_path(key)
+    try:
+      with open(entry_path, "rb") as infile:
+        blob = infile.read()
+    except (IOError, OSError):
+      return None
+
+    try:
+      # NOTE(josh): atime is unreliable (noatime, relatime) so we use mtime
+      # as the LRU timestamp
+      os.utime(entry_path, None)
+    except OSError:
+      pass
+    return blob
+
+  def get(self, key):
+    """
+    Return the `CacheEntry` for key, or None if it isn't in the cache.
+    """
+    blob = self.read_blob(key)
+    if blob is None:
+      return None
+    try:
+      return unpack_entry(blob)
+    except ValueError:
+      return None
+
+  def write_blob(self, key, blob):
+    """
+    Store a serialized entry in the cache.
+    """
+    entry_path = self.get_path(key)
+    entry_dir = os.path.dirname(entry_path)
+    tmp_path = "{}.{}.{}.tmp".format(
+        entry_path, os.getpid(), threading.get_ident())
+    try:
+      if not os.path.isdir(entry_dir):
+        os.makedirs(entry_dir)
+    except OSError:
+      # NOTE(josh): another writer may have created it concurrently
+      if not os.path.isdir(entry_dir):
+        raise
+
+    with open(tmp_path, "wb") as outfile:
+      outfile.write(blob)
+    os.rename(tmp_path, entry_path)
+    self.dirty = True
+
+  def put(self, key, entry):
+    """
+    Store a `CacheEntry` in the cache.
+    """
+    self.write_blob(key, pack_entry(entry))
+
+  def trim(self):
+    """
+    If the cache is larger than it's maximum size, evict the least recently
+    used entries.
+    """
+    if not self.dirty or not os.path.isdir(self.cache_dir):
+      return
+    self.dirty = False
+
+    entries = []
+    total_size = 0
+    now = time.time()
+    for subdir in os.scandir(self.cache_dir):
+      if not subdir.is_dir(follow_symlinks=False):
+        continue
+      for entry in os.scandir(subdir.path):
+        try:
+          stat = entry.stat(follow_symlinks=False)
+        except OSError:
+          continue
+        if entry.name.endswith(".tmp"):
+          if stat.st_mtime < now - STALE_TMP_SECONDS:
+            remove_quietly(entry.path)
+          continue
+        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_size += stat.st_size
+
+    if total_size <= self.max_size:
+      return
+
+    target_size = self.max_size * TRIM_FRACTION
+    logger.info("Trimming result cache %s from %d bytes",
+                self.cache_dir, total_size)
+    entries.sort()
+    for _, size, entry_path in entries:
+      if total_size <= target_size:
+        break
+      remove_quietly(entry_path)
+      total_size -= size
+
+
+def remove_quietly(path):
+  """
+  Remove a file which another process may have already removed.
+  """
+  try:
+    os.remove(path)
+  except OSError:
+    pass
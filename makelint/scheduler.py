@@ -0,0 +1,635 @@
+"""
+The tool phase of a (phased) run. The target tree is scanned for the stale
+(file, tool) jobs of every tool, which are then launched in job order (see
+`get_job_priority()`), in batches for the tools which support them, by a
+`ToolScheduler`. The stamp and log of each job are written out as it
+finishes, and results are shared through the result caches (see
+`makelint.resultcache` and `makelint.remotecache`).
+"""
+
+import collections
+import fcntl
+import logging
+import os
+import shutil
+
+import makelint
+from makelint import costmodel
+from makelint import fsmemo
+from makelint import jobrunner
+from makelint import resultcache
+
+logger = logging.getLogger()
+
+# Order in which stale tool jobs are launched (see `get_job_priority()`)
+DEFAULT_JOB_ORDER = ("failed", "longest")
+
+
+def toolstamp_is_uptodate(toolstamp_path, depmap_path,
+                          digest_algorithm=makelint.DEFAULT_DIGEST_ALGORITHM,
+                          memo=None):
+  """
+  Return true if the toolstamp is up to date with respect to the dependency
+  map. Filesystem queries go through ``memo`` (a `FileMemo`) if given.
+  """
+  if memo is None:
+    memo = fsmemo.FileMemo()
+  digest_path = depmap_path + makelint.get_digest_suffix(digest_algorithm)
+  if not memo.exists(toolstamp_path):
+    return False
+
+  if memo.getmtime(toolstamp_path) > memo.getmtime(depmap_path):
+    # The tool execution stamp is newer than the dependency map digest
+    # so we know that it is up to date
+    return True
+
+  toolstamp_digest = memo.read_text(toolstamp_path)
+  depmap_digest = memo.read_text(digest_path)
+  if depmap_digest is None:
+    raise IOError("Failed to read {}".format(digest_path))
+
+  # If the current dependency map digest matches the dependency map digest
+  # when the tool was last executed, then the dependency footprint has not
+  # changed (nor the source file itself) so the tool stamp is up to date.
+  return toolstamp_digest == depmap_digest
+
+
+def cat_log(logfile_path, header, merged_log):
+  """
+  Copy the content from logfile_path into merged_log
+  """
+  if not merged_log:
+    return
+
+  merged_log.write(header)
+  merged_log.write("\n")
+  merged_log.write("=" * len(header))
+  merged_log.write("\n")
+  with open(logfile_path) as infile:
+    for line in infile:
+      merged_log.write(line)
+  merged_log.write("\n\n")
+
+
+def restore_cached_result(entry, toolstamp_path, depmap_path, source_relpath,
+                          merged_log, digest_suffix):
+  """
+  Write out the tool stamp (and log, on failure) for a result retrieved from
+  the result cache. Return the exit status of the tool.
+  """
+  logfile_path = toolstamp_path + ".log"
+  if entry.status == "pass":
+    logger.debug("%s: okay! (result cache)", toolstamp_path)
+    shutil.copyfile(depmap_path + digest_suffix, toolstamp_path)
+    return 0
+
+  log = entry.log
+  if entry.relpath != source_relpath:
+    # NOTE(josh): the result was produced by a different file with identical
+    # content, so the log refers to it by the wrong name
+    log = log.replace(entry.relpath.encode("utf-8"),
+                      source_relpath.encode("utf-8"))
+  with open(logfile_path, "wb") as outfile:
+    outfile.write(log)
+  with open(toolstamp_path, "w") as outfile:
+    outfile.write("fail")
+  logger.info("%s: failed :( (result cache)", toolstamp_path)
+  cat_log(logfile_path, "{} (cached)".format(source_relpath), merged_log)
+  return 1
+
+
+def read_tool_result(toolstamp_path, source_relpath):
+  """
+  Return a `CacheEntry` for the result of a tool job which has finished, or
+  None if it didn't produce a result.
+  """
+  try:
+    with open(toolstamp_path) as infile:
+      content = infile.read().strip()
+  except (IOError, OSError):
+    return None
+  if content != "fail":
+    return resultcache.CacheEntry("pass", source_relpath, b"")
+  try:
+    with open(toolstamp_path + ".log", "rb") as infile:
+      return resultcache.CacheEntry("fail", source_relpath, infile.read())
+  except (IOError, OSError):
+    return None
+
+
+def record_tool_result(toolstamp_path, depmap_path, source_relpath, result,
+                       merged_log, digest_suffix):
+  """
+  Write out the tool stamp for a tool job which has finished with exit status
+  ``result``, and remove (on success) or merge (on failure) it's log.
+  """
+  logfile_path = toolstamp_path + ".log"
+  if result == 0:
+    logger.debug("%s: okay!", toolstamp_path)
+    shutil.copyfile(depmap_path + digest_suffix, toolstamp_path)
+    os.remove(logfile_path)
+    return
+
+  with open(toolstamp_path, "w") as outfile:
+    outfile.write("fail")
+  logger.info("%s: failed :(", toolstamp_path)
+
+  if merged_log:
+    # NOTE(josh): we have multiple processes (or threads) catting to this
+    # file, so we need serialize the cat operation to prevent interleaving.
+    with jobrunner.MERGED_LOG_LOCK:
+      fcntl.flock(merged_log, fcntl.LOCK_EX)
+      cat_log(logfile_path, source_relpath, merged_log)
+      merged_log.flush()
+      fcntl.flock(merged_log, fcntl.LOCK_UN)
+
+
+def execute_tool_jobs(source_tree, tool, env, jobs, merged_log,
+                      digest_suffix):
+  """
+  Execute the tool (in a child process or thread) on the files of ``jobs``, a
+  list of ``(source_relpath, toolstamp_path, depmap_path, result_key)``, and
+  write out the stamp and log of each. If there is more than one file then
+  they are all given to the tool's ``execute_batch()`` at once. Return the
+  exit status for the job: nonzero if any of the files failed.
+  """
+  if len(jobs) == 1:
+    source_relpath, toolstamp_path, _, _ = jobs[0]
+    with open(toolstamp_path + ".log", "w") as outfile:
+      results = {
+          source_relpath: tool.execute(source_tree, source_relpath, env,
+                                       outfile)}
+  else:
+    results = {}
+    outputs = tool.execute_batch(
+        source_tree, [job[0] for job in jobs], env)
+    for source_relpath, toolstamp_path, _, _ in jobs:
+      result, log = outputs[source_relpath]
+      with open(toolstamp_path + ".log", "wb") as outfile:
+        outfile.write(log)
+      results[source_relpath] = result
+
+  status = 0
+  for source_relpath, toolstamp_path, depmap_path, _ in jobs:
+    result = results[source_relpath]
+    record_tool_result(toolstamp_path, depmap_path, source_relpath, result,
+                       merged_log, digest_suffix)
+    if result != 0:
+      status = 1
+  return status
+
+
+def get_job_priority(job_order, toolstamp_path, source_path, estimate,
+                     memo):
+  """
+  Return the key by which the tool job for the file at source_path is ordered
+  according to ``job_order``, a list of:
+
+  * "failed": jobs whose tool stamp says that the last run failed
+  * "recent": jobs for the files which were modified most recently
+  * "longest": jobs which are expected to take the longest (``estimate``)
+
+  Jobs with a greater key are launched first. The first item of job_order
+  takes precedence, and the rest only break ties.
+  """
+  priority = []
+  for order in job_order:
+    if order == "failed":
+      priority.append(memo.read_text(toolstamp_path) == "fail")
+    elif order == "recent":
+      stat = memo.stat(source_path)
+      priority.append(0 if stat is None else stat.st_mtime_ns)
+    elif order == "longest":
+      priority.append(estimate)
+    else:
+      raise ValueError("Unknown job order {}".format(order))
+  return tuple(priority)
+
+
+def get_batch_priority(job_order, priorities):
+  """
+  Return the key of a batch of jobs with the given keys (see
+  `get_job_priority()`). A batch has failed if any of it's files has, is as
+  recent as the newest of them, and takes as long as all of them together.
+  """
+  return tuple(
+      sum(column) if order == "longest" else max(column)
+      for order, column in zip(job_order, zip(*priorities)))
+
+
+class ToolPass(object):
+  """
+  The state of one tool during `execute_tools_ontree()`.
+  """
+
+  def __init__(self, tool, tool_idx, tool_key):
+    self.tool = tool
+    self.tool_idx = tool_idx
+    self.tool_key = tool_key
+
+    # Stale files, as (relpath_cwd, filename, result_key), and the number of
+    # files which have been checked or launched, for the progress report.
+    self.stale = []
+    self.file_idx = 0
+
+    # Expected seconds to check each stale file, by relpath (see
+    # `makelint.costmodel`), and the key by which it's job is ordered (see
+    # `get_job_priority()`)
+    self.estimates = {}
+    self.priorities = {}
+
+    # Files given to the tool in one job, if it supports batches
+    self.batch_size = 1
+
+    # Whether the tool is running it's own workers (see `WorkerTool`), or None
+    # if they haven't been started (yet)
+    self.workers = None
+
+
+def execute_tool_ontree(cfg, tool, progress, index=None, relpaths=None,
+                        memo=None, merged_log=None, result_cache=None,
+                        remote_cache=None, jobserver=None):
+  """
+  Execute the given tool. See `execute_tools_ontree()`.
+  """
+  return execute_tools_ontree(
+      cfg, progress, index, relpaths, memo, merged_log, result_cache,
+      remote_cache, jobserver, [tool])
+
+
+def execute_tools_ontree(cfg, progress, index=None, relpaths=None, memo=None,
+                         merged_log=None, result_cache=None, remote_cache=None,
+                         jobserver=None, tools=None):
+  """
+  Execute all of the ``tools`` of ``cfg`` (a `Configuration`), or the given
+  ``tools``. The target tree is scanned once for the stale (file, tool) jobs
+  of every tool, and then all of the jobs share the ``jobs`` slots, so the
+  next tool starts as soon as there is a free slot rather than once every job
+  of the previous tool has finished. Filesystem queries go through ``memo``
+  (a `FileMemo`) if given.
+
+  If ``result_cache`` (a local `ResultCache`) or ``remote_cache`` (a
+  `RemoteCache`) are given, and a tool implements ``get_cache_key()``, then
+  results are retrieved from the caches rather than executing the tool, and
+  the results of executing the tool are stored in the caches. The remote
+  cache is queried once, in a batch, for all the files which miss in the
+  local cache. A file with the same cache key as a job that is already
+  running (e.g. an identical ``__init__.py``) waits for that job and then
+  reuses it's result.
+
+  Tools which have a ``start_workers()`` method (see `WorkerTool`) check
+  files in worker processes of their own, which are started before the first
+  job of the tool and stopped at the end. Their jobs run on threads rather
+  than in forked children.
+
+  Jobs are launched in ``job_order`` (see `get_job_priority()`). By default
+  the files which failed on their last run go first, so that with
+  ``fail_fast`` an error that hasn't been fixed is found early, and then the
+  longest jobs, according to the history of how long each tool took on each
+  file (see `makelint.costmodel`). The time taken by each job is added to the
+  history.
+
+  If ``jobserver`` (a `JobServerClient`) is given, each job holds a token
+  from it while it runs, in addition to the limit of ``jobs``.
+  """
+  if tools is None:
+    tools = cfg.tools
+  scheduler = ToolScheduler(cfg, tools, progress, memo, merged_log,
+                            result_cache, remote_cache, jobserver)
+  try:
+    return scheduler.run(index, relpaths)
+  finally:
+    scheduler.close()
+
+
+class ToolScheduler(object):
+  """
+  Implementation of `execute_tools_ontree()`. Holds the queue of jobs which
+  are waiting to be launched, the batch that is being filled, the
+  `JobRunner` whose slots the jobs share, and the `CostModel` which
+  estimates them.
+  """
+
+  # pylint: disable=too-many-instance-attributes
+
+  def __init__(self, cfg, tools, progress, memo=None, merged_log=None,
+               result_cache=None, remote_cache=None, jobserver=None):
+    if memo is None:
+      memo = fsmemo.FileMemo()
+    self.cfg = cfg
+    self.progress = progress
+    self.memo = memo
+    self.merged_log = merged_log
+    self.result_cache = result_cache
+    self.remote_cache = remote_cache
+    self.digest_suffix = makelint.get_digest_suffix(cfg.digest_algorithm)
+    self.runner = jobrunner.JobRunner(cfg.jobs, merged_log, jobserver)
+    self.costs = costmodel.CostModel.load(cfg.target_tree)
+    self.output = 0
+
+    self.passes = []
+    for idx, tool in enumerate(tools):
+      tool_key = None
+      if ((result_cache is not None or remote_cache is not None)
+          and hasattr(tool, "get_cache_key")):
+        tool_key = tool.get_cache_key(cfg.source_tree, cfg.env)
+      self.passes.append(
+          ToolPass(tool, progress.tool_idx + idx + 1, tool_key))
+
+    # Results available without executing the tool, jobs whose results have
+    # not yet been stored in the caches, cache keys of jobs which are
+    # currently running, and jobs which are waiting for them to finish. Cache
+    # keys include the tool, so these are shared by all tools.
+    self.cached = {}
+    self.launched = {}
+    self.running = set()
+    self.deferred = []
+
+    # Jobs which are waiting to be launched, in job order, and the files of
+    # one tool to be given to the tool in one job
+    self.queue = collections.deque()
+    self.batch = []
+    self.batch_pass = None
+
+    # Jobs which have been launched, as (job index, toolpass, relpaths), for
+    # the cost model
+    self.jobs = []
+
+  def close(self):
+    self.runner.close()
+    self.costs.save()
+    for toolpass in self.passes:
+      if toolpass.workers:
+        toolpass.tool.stop_workers()
+
+  def is_stopped(self):
+    return self.cfg.fail_fast and self.output
+
+  def run(self, index=None, relpaths=None):
+    """
+    Execute the stale jobs for the files of ``index`` (or only those at
+    ``relpaths``, if given) and return the bitwise or of their exit status.
+    """
+    files = makelint.get_file_list(self.cfg.target_tree, index, relpaths)
+    if relpaths is None:
+      self.costs.retain(os.path.join(relpath_cwd, filename)
+                        for relpath_cwd, filename in files)
+    self.report_failed(self.find_stale(files))
+    if self.is_stopped():
+      self.memo.log_counts("tools")
+      return self.output
+
+    self.fetch_results()
+    self.fill_queue()
+    while self.queue or self.deferred or self.batch:
+      if not self.step():
+        break
+
+    self.output |= self.runner.wait(0)
+    self.store_results()
+    if self.passes:
+      self.report_progress()
+    self.report_costs()
+    self.memo.log_counts("tools")
+    return self.output
+
+  def find_stale(self, files):
+    """
+    Find the stale jobs of each tool for ``files`` (a list of (relpath_cwd,
+    filename)). Return, for each tool, a list of the logs of the files which
+    are up to date but failed on a previous run, as (logfile_path,
+    source_relpath).
+    """
+    target_tree = self.cfg.target_tree
+    failed = [[] for _ in self.passes]
+    for relpath_cwd, filename in files:
+      target_cwd = os.path.join(target_tree, relpath_cwd)
+      source_relpath = os.path.join(relpath_cwd, filename)
+      depmap_path = os.path.join(
+          target_cwd, filename + makelint.DEPENDENCY_SUFFIX)
+
+      for toolpass, tool_failed in zip(self.passes, failed):
+        toolstamp_path = toolpass.tool.get_stamp(target_cwd, filename)
+        if toolstamp_is_uptodate(toolstamp_path, depmap_path,
+                                 self.cfg.digest_algorithm, self.memo):
+          toolpass.file_idx += 1
+          if self.memo.read_text(toolstamp_path) == "fail":
+            tool_failed.append((toolstamp_path + ".log", source_relpath))
+          continue
+
+        result_key = None
+        if toolpass.tool_key is not None:
+          result_key = resultcache.get_result_key(
+              toolpass.tool_key, self.cfg.digest_algorithm, source_relpath,
+              self.memo.read_depmap(depmap_path))
+        toolpass.stale.append((relpath_cwd, filename, result_key))
+        source_path = os.path.join(self.cfg.source_tree, source_relpath)
+        estimate = toolpass.estimates[source_relpath] = self.costs.estimate(
+            toolpass.tool.name, source_relpath,
+            costmodel.get_size(source_path, self.memo))
+        toolpass.priorities[source_relpath] = get_job_priority(
+            self.cfg.job_order, toolstamp_path, source_path, estimate,
+            self.memo)
+    return failed
+
+  def report_progress(self):
+    """
+    Report the number of files done for each tool. The jobs of different
+    tools are interleaved, so each one is counted separately.
+    """
+    last = self.passes[-1]
+    self.progress(tool_idx=last.tool_idx, tool=last.tool.name,
+                  file_idx=last.file_idx,
+                  counts={toolpass.tool_idx: toolpass.file_idx
+                          for toolpass in self.passes})
+
+  def report_failed(self, failed):
+    """
+    Merge the logs of the files which failed on a previous run (see
+    `find_stale()`) and count them as failures.
+    """
+    for toolpass, tool_failed in zip(self.passes, failed):
+      # NOTE(josh): also registers the name of each tool with the progress
+      # report
+      self.progress(tool_idx=toolpass.tool_idx, tool=toolpass.tool.name,
+                    file_idx=toolpass.file_idx)
+      for logfile_path, source_relpath in tool_failed:
+        self.output |= 1
+        cat_log(logfile_path, "{} (cached)".format(source_relpath),
+                self.merged_log)
+        if self.is_stopped():
+          return
+    if self.passes:
+      self.report_progress()
+
+  def fetch_results(self):
+    """
+    Fetch the results of the stale jobs from the remote cache, in one batch,
+    for the files which miss in the local cache.
+    """
+    if self.remote_cache is None:
+      return
+    keys = set(result_key for toolpass in self.passes
+               for _, _, result_key in toolpass.stale if result_key)
+    if self.result_cache is not None:
+      keys = [key for key in keys if not self.result_cache.contains(key)]
+    self.cached = self.remote_cache.fetch(keys)
+    if self.result_cache is not None:
+      for result_key, entry in self.cached.items():
+        self.result_cache.put(result_key, entry)
+
+  def store_results(self):
+    """
+    Store the results of launched jobs (which must have finished) in the
+    caches.
+    """
+    entries = {}
+    for result_key, (toolstamp_path, source_relpath) in self.launched.items():
+      entry = read_tool_result(toolstamp_path, source_relpath)
+      if entry is not None:
+        entries[result_key] = entry
+    self.launched.clear()
+    self.cached.update(entries)
+    if self.result_cache is not None:
+      for result_key, entry in entries.items():
+        try:
+          self.result_cache.put(result_key, entry)
+        except (IOError, OSError) as ex:
+          logger.warning("Failed to store result in %s: %s",
+                         self.result_cache.cache_dir, ex)
+    if self.remote_cache is not None:
+      self.remote_cache.store(entries)
+
+  def fill_queue(self):
+    """
+    Queue the stale jobs of every tool. Batches are kept small enough that
+    every job gets some of the files. Files are grouped into batches in job
+    order, and then the batches (or single files) of all tools are queued in
+    job order, so that (by default) the files which failed last time are
+    checked first and the longest jobs don't start last. The sorts are
+    stable, so ties stay in tree order.
+    """
+    groups = []
+    for toolpass in self.passes:
+      if hasattr(toolpass.tool, "execute_batch"):
+        toolpass.batch_size = max(1, min(
+            getattr(toolpass.tool, "batch_size", 1),
+            -(-len(toolpass.stale) // max(self.cfg.jobs, 1))))
+      stale = sorted(
+          toolpass.stale, reverse=True,
+          key=lambda job, toolpass=toolpass: toolpass.priorities[
+              os.path.join(job[0], job[1])])
+      for idx in range(0, len(stale), toolpass.batch_size):
+        group = stale[idx:idx + toolpass.batch_size]
+        groups.append((get_batch_priority(
+            self.cfg.job_order,
+            [toolpass.priorities[os.path.join(job[0], job[1])]
+             for job in group]), [(toolpass,) + job for job in group]))
+    groups.sort(key=lambda group: group[0], reverse=True)
+    self.queue.extend(job for _, group in groups for job in group)
+
+  def step(self):
+    """
+    Launch the batch that is being filled, if it is complete, or otherwise
+    take the next job from the queue. Return false if the run should stop
+    (see ``fail_fast``).
+    """
+    batch_pass = self.batch_pass
+    if self.batch and (len(self.batch) >= batch_pass.batch_size
+                       or not self.queue or self.queue[0][0] is not batch_pass):
+      self.output |= self.runner.wait(self.cfg.jobs - 1)
+      if self.is_stopped():
+        return False
+      self.launch(batch_pass, self.batch)
+      self.batch = []
+      return True
+
+    if not self.queue:
+      self.output |= self.runner.wait(0)
+      if self.is_stopped():
+        return False
+      self.store_results()
+      self.running.clear()
+      self.queue.extend(self.deferred)
+      self.deferred = []
+
+    job = self.queue.popleft()
+    if job[3] in self.running:
+      self.deferred.append(job)
+      return True
+    self.add_job(*job)
+    return not self.is_stopped()
+
+  def add_job(self, toolpass, relpath_cwd, filename, result_key):
+    """
+    Restore the result of a job from the caches, if it is there, or add it to
+    the batch.
+    """
+    target_cwd = os.path.join(self.cfg.target_tree, relpath_cwd)
+    source_relpath = os.path.join(relpath_cwd, filename)
+    toolstamp_path = toolpass.tool.get_stamp(target_cwd, filename)
+    depmap_path = os.path.join(
+        target_cwd, filename + makelint.DEPENDENCY_SUFFIX)
+
+    toolpass.file_idx += 1
+    self.report_progress()
+    if self.memo.exists(toolstamp_path):
+      os.remove(toolstamp_path)
+    # NOTE(josh): the stamp is about to be rewritten, possibly by a child
+    # process
+    self.memo.invalidate(toolstamp_path)
+
+    if result_key is not None:
+      entry = self.cached.get(result_key)
+      if entry is None and self.result_cache is not None:
+        entry = self.result_cache.get(result_key)
+      if entry is not None:
+        self.output |= restore_cached_result(
+            entry, toolstamp_path, depmap_path, source_relpath,
+            self.merged_log, self.digest_suffix)
+        return
+      self.running.add(result_key)
+
+    self.batch.append(
+        (source_relpath, toolstamp_path, depmap_path, result_key))
+    self.batch_pass = toolpass
+
+  def launch(self, toolpass, batch):
+    """
+    Launch a job for the files of ``batch``.
+    """
+    tool = toolpass.tool
+    if toolpass.workers is None:
+      toolpass.workers = False
+      if hasattr(tool, "start_workers"):
+        toolpass.workers = tool.start_workers(
+            self.cfg.source_tree, self.cfg.env, self.cfg.jobs)
+    if toolpass.workers:
+      launch_job = self.runner.submit
+    else:
+      launch_job = self.runner.start
+    job_id = launch_job(tool, execute_tool_jobs, self.cfg.source_tree, tool,
+                        self.cfg.env, batch, self.merged_log,
+                        self.digest_suffix)
+    self.jobs.append((job_id, toolpass, [job[0] for job in batch]))
+    for source_relpath, toolstamp_path, _, result_key in batch:
+      if result_key is not None:
+        self.launched[result_key] = (toolstamp_path, source_relpath)
+
+  def report_costs(self):
+    """
+    Add the time taken by each job to the cost model, and log the schedule
+    that we got.
+    """
+    trace = costmodel.ScheduleTrace(self.cfg.jobs)
+    for job_id, toolpass, batch in self.jobs:
+      start, end = self.runner.times[job_id]
+      seconds = (end - start) / len(batch)
+      for source_relpath in batch:
+        self.costs.record(toolpass.tool.name, source_relpath, seconds)
+      label = "{} {}".format(toolpass.tool.name, batch[0])
+      if len(batch) > 1:
+        label += " (+{})".format(len(batch) - 1)
+      trace.add(label, sum(toolpass.estimates[source_relpath]
+                           for source_relpath in batch), start, end)
+    trace.report("tools")
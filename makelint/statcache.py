@@ -0,0 +1,164 @@
+"""
+Persistent cache of file stat data and content digests, modelled on the git
+index. Before hashing a source file we compare its inode, size and
+modification time against the cached record. If they match then the content
+is assumed unchanged and the cached digest is used, so that a no-op run does
+only one ``stat()`` per file and does not open any of the digest sidecars.
+
+As with the git index, a record is "racily clean" if the file was modified
+at or after the time the cache itself was written (i.e. within the same
+timestamp tick that it was scanned). Such records are not trusted and the file
+is hashed again.
+
+Layout (all integers little-endian)::
+
+  header: magic (8 bytes), format version (u32), number of records (u32)
+  record: ino (u64), size (i64), mtime_ns (i64), ctime_ns (i64),
+          relpath (string), digest (string)
+  string: length (u16), utf-8 bytes
+"""
+
+import collections
+import logging
+import os
+import struct
+
+from makelint.manifest import pack_string, unpack_string, write_atomic
+
+logger = logging.getLogger()
+
+STATCACHE_FILENAME = "statcache.bin"
+
+MAGIC = b"MKLINTSC"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<8sII")
+RECORD_HEAD = struct.Struct("<Qqqq")
+
+StatRecord = collections.namedtuple(
+    "StatRecord", ["ino", "size", "mtime_ns", "ctime_ns", "digest"])
+
+
+class StatCache(object):
+  """
+  In-memory view of the stat cache for one target tree, keyed by the
+  relative path of each source file.
+  """
+
+  def __init__(self, target_tree):
+    self.target_tree = target_tree
+    self.records = {}
+
+    # Modification time of the cache file when it was loaded, used to detect
+    # racily clean records.
+    self.cache_mtime_ns = None
+    self.dirty = False
+
+  @property
+  def filepath(self):
+    return os.path.join(self.target_tree, STATCACHE_FILENAME)
+
+  @classmethod
+  def load(cls, target_tree):
+    """
+    Read the cache for the given target tree. If it does not exist or cannot
+    be read, return an empty cache.
+    """
+    cache = cls(target_tree)
+    try:
+      with open(cache.filepath, "rb") as infile:
+        cache.cache_mtime_ns = os.fstat(infile.fileno()).st_mtime_ns
+        content = infile.read()
+    except (IOError, OSError):
+      return cache
+
+    try:
+      cache.parse(content)
+    except (ValueError, struct.error, UnicodeDecodeError):
+      logger.warning("Discarding unreadable stat cache %s", cache.filepath)
+      cache.records = {}
+      cache.cache_mtime_ns = None
+    return cache
+
+  def parse(self, content):
+    """
+    Parse the serialized cache
+    """
+    buf = memoryview(content)
+    magic, version, nrecords = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise ValueError("Unrecognized stat cache header")
+    offset = HEADER.size
+
+    records = {}
+    for _ in range(nrecords):
+      ino, size, mtime_ns, ctime_ns = RECORD_HEAD.unpack_from(buf, offset)
+      offset += RECORD_HEAD.size
+      relpath, offset = unpack_string(buf, offset)
+      digest, offset = unpack_string(buf, offset)
+      records[relpath] = StatRecord(ino, size, mtime_ns, ctime_ns, digest)
+    self.records = records
+
+  def get(self, relpath):
+    """
+    Return the record for the file at relpath, or None if there isn't one.
+    """
+    return self.records.get(relpath, None)
+
+  def is_clean(self, relpath, stat):
+    """
+    Return true if the cached digest for the file at relpath can be trusted,
+    given its current `os.stat_result`.
+    """
+    record = self.records.get(relpath, None)
+    if record is None:
+      return False
+    if (record.ino != stat.st_ino or record.size != stat.st_size or
+        record.mtime_ns != stat.st_mtime_ns):
+      return False
+    if (self.cache_mtime_ns is None or
+        max(record.mtime_ns, record.ctime_ns) >= self.cache_mtime_ns):
+      # NOTE(josh): "racily clean", the file might have been modified again
+      # in the same tick that we hashed it. Once it has been verified the
+      # record is written out again with a later cache mtime.
+      self.dirty = True
+      return False
+    return True
+
+  def update(self, relpath, stat, digest):
+    """
+    Store the stat data and digest for the file at relpath
+    """
+    self.records[relpath] = StatRecord(
+        stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, digest)
+    self.dirty = True
+
+  def retain(self, relpaths):
+    """
+    Drop records for any files not in ``relpaths``
+    """
+    relpaths = set(relpaths)
+    removed = [relpath for relpath in self.records if relpath not in relpaths]
+    for relpath in removed:
+      del self.records[relpath]
+    if removed:
+      self.dirty = True
+
+  def save(self):
+    """
+    Write the cache to disk, if it has changed. The new content is written to
+    a temporary file which then atomically replaces the old cache.
+    """
+    if not self.dirty:
+      return
+
+    with write_atomic(self.filepath) as outfile:
+      outfile.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(self.records)))
+      for relpath in sorted(self.records):
+        record = self.records[relpath]
+        outfile.write(RECORD_HEAD.pack(
+            record.ino, record.size, record.mtime_ns, record.ctime_ns))
+        outfile.write(pack_string(relpath))
+        outfile.write(pack_string(record.digest))
+    self.cache_mtime_ns = os.stat(self.filepath).st_mtime_ns
+    self.dirty = False
@@ -0,0 +1,489 @@
+"""
+Map dependencies without executing anything. Each file is parsed with `ast`,
+it's ``import`` and ``from ... import`` statements are resolved against the
+module search path of a clean interpreter (and the source tree), and the
+modules they resolve to are parsed in turn, until the transitive closure is
+known. The result has the same format as the output of
+`makelint.get_dependencies`.
+
+Imports are assumed to execute if they are at module scope, including inside
+``if``, ``try`` and ``class`` blocks, but not inside functions, ``if
+TYPE_CHECKING`` or ``if __name__ == "__main__"``. Imports inside a ``try``
+block which handles ``ImportError`` may fail to resolve.
+
+Static resolution of a file is incomplete (and `ImportResolver.map()` returns
+None, so that the file can be mapped by executing it instead) if the file, or
+any module in the source tree that it imports:
+
+* can't be parsed
+* has an (unguarded) import which can't be resolved
+* imports a module dynamically (``__import__``, ``importlib.import_module``,
+  ``exec`` or ``eval``) or modifies ``sys.path``
+* uses a relative import, in the file itself (which is executed as a script,
+  not imported)
+
+Modules outside the source tree are not held to this standard: their dynamic
+imports, and the imports made by extension modules, are not seen.
+"""
+
+import ast
+import collections
+import importlib.machinery
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger()
+
+ModuleInfo = collections.namedtuple(
+    "ModuleInfo", ["name", "path", "search_locations"])
+
+# An import statement found in a module. ``optional`` is true if it's ok for
+# the import to fail (e.g. it's guarded by ``except ImportError``, or it's a
+# name in a ``from`` import which might be an attribute rather than a
+# submodule). ``unless`` is a tuple of module names: if they can all be
+# imported then this import doesn't happen (it is in the ``except
+# ImportError`` handler of a try block which imports them).
+ImportEdge = collections.namedtuple(
+    "ImportEdge", ["name", "optional", "unless"])
+
+# Exception types which, if handled, make the imports in a try block optional
+IMPORT_ERROR_NAMES = (
+    "ImportError", "ModuleNotFoundError", "Exception", "BaseException")
+
+# Calls which import, or execute, code that we can't see
+DYNAMIC_CALL_NAMES = ("__import__", "import_module", "exec", "eval")
+
+
+class ParsedModule(object):
+  """
+  The import edges of a module, and whether it does anything which defeats
+  static analysis.
+  """
+
+  def __init__(self, edges, dynamic, relative):
+    self.edges = edges
+    self.dynamic = dynamic
+    self.relative = relative
+
+
+def handles_import_error(handler):
+  """
+  Return true if the except handler catches ImportError
+  """
+  if handler.type is None:
+    return True
+  if isinstance(handler.type, ast.Tuple):
+    types = handler.type.elts
+  else:
+    types = [handler.type]
+  for node in types:
+    if isinstance(node, ast.Name) and node.id in IMPORT_ERROR_NAMES:
+      return True
+    if isinstance(node, ast.Attribute) and node.attr in IMPORT_ERROR_NAMES:
+      return True
+  return False
+
+
+def is_type_checking(test):
+  """
+  Return true if the test expression is ``TYPE_CHECKING`` or
+  ``typing.TYPE_CHECKING``.
+  """
+  if isinstance(test, ast.Name):
+    return test.id == "TYPE_CHECKING"
+  if isinstance(test, ast.Attribute):
+    return test.attr == "TYPE_CHECKING"
+  return False
+
+
+def evaluate_test(test):
+  """
+  Return the value of a test expression which only depends on the platform
+  or the version of the interpreter (e.g. ``sys.platform == "win32"`` or
+  ``sys.version_info >= (3, 8)``), or None if it isn't such an expression.
+  """
+  # pylint: disable=too-many-return-statements
+  if isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not):
+    value = evaluate_test(test.operand)
+    return None if value is None else not value
+  if isinstance(test, ast.BoolOp):
+    values = [evaluate_test(node) for node in test.values]
+    if None in values:
+      return None
+    if isinstance(test.op, ast.And):
+      return all(values)
+    return any(values)
+  if isinstance(test, ast.Call) and isinstance(test.func, ast.Attribute) \
+      and test.func.attr == "startswith" and len(test.args) == 1 \
+      and isinstance(test.args[0], ast.Constant):
+    value = get_platform_value(test.func.value)
+    if isinstance(value, str):
+      return value.startswith(test.args[0].value)
+    return None
+  if not isinstance(test, ast.Compare) or len(test.comparators) != 1:
+    return None
+  left = get_platform_value(test.left)
+  try:
+    right = ast.literal_eval(test.comparators[0])
+  except ValueError:
+    return None
+  if left is None:
+    return None
+  operators = {
+      ast.Eq: lambda lhs, rhs: lhs == rhs,
+      ast.NotEq: lambda lhs, rhs: lhs != rhs,
+      ast.Lt: lambda lhs, rhs: lhs < rhs,
+      ast.LtE: lambda lhs, rhs: lhs <= rhs,
+      ast.Gt: lambda lhs, rhs: lhs > rhs,
+      ast.GtE: lambda lhs, rhs: lhs >= rhs,
+      ast.In: lambda lhs, rhs: lhs in rhs,
+      ast.NotIn: lambda lhs, rhs: lhs not in rhs,
+  }
+  operator = operators.get(type(test.ops[0]))
+  if operator is None:
+    return None
+  try:
+    return operator(left, right)
+  except TypeError:
+    return None
+
+
+def get_platform_value(node):
+  """
+  Return the value of ``sys.platform``, ``os.name`` or ``sys.version_info``
+  if node is one of those expressions, otherwise None.
+  """
+  if not isinstance(node, ast.Attribute) \
+      or not isinstance(node.value, ast.Name):
+    return None
+  if (node.value.id, node.attr) == ("sys", "platform"):
+    return sys.platform
+  if (node.value.id, node.attr) == ("os", "name"):
+    return os.name
+  if (node.value.id, node.attr) == ("sys", "version_info"):
+    return tuple(sys.version_info)
+  return None
+
+
+def is_main_check(test):
+  """
+  Return true if the test expression is ``__name__ == "__main__"``
+  """
+  if not isinstance(test, ast.Compare) or len(test.comparators) != 1:
+    return False
+  operands = [test.left, test.comparators[0]]
+  names = [node.id for node in operands if isinstance(node, ast.Name)]
+  consts = [node.value for node in operands if isinstance(node, ast.Constant)]
+  return names == ["__name__"] and consts == ["__main__"]
+
+
+class ImportCollector(object):
+  """
+  Walks the module-scope statements of a module and collects import edges.
+  """
+
+  def __init__(self, package):
+    self.package = package
+    self.edges = []
+    # Names of the modules imported by import statements (as opposed to the
+    # names in a ``from`` import which may or may not be submodules)
+    self.attempted = []
+    self.dynamic = False
+    self.relative = False
+
+  def resolve_relative(self, module, level):
+    """
+    Return the absolute name of a relative import, or None if it can't be
+    resolved.
+    """
+    self.relative = True
+    if not self.package:
+      return None
+    parts = self.package.split(".")
+    if level > len(parts):
+      return None
+    base = ".".join(parts[:len(parts) - level + 1])
+    if module:
+      return "{}.{}".format(base, module)
+    return base
+
+  def add(self, name, optional, unless):
+    self.edges.append(ImportEdge(name, optional, unless))
+
+  def visit_import(self, node, optional, unless):
+    for alias in node.names:
+      self.add(alias.name, optional, unless)
+      self.attempted.append(alias.name)
+
+  def visit_importfrom(self, node, optional, unless):
+    if node.level:
+      module = self.resolve_relative(node.module, node.level)
+      if module is None:
+        return
+    else:
+      module = node.module
+    self.add(module, optional, unless)
+    self.attempted.append(module)
+    for alias in node.names:
+      if alias.name != "*":
+        self.add("{}.{}".format(module, alias.name), True, unless)
+
+  def check_expression(self, node):
+    """
+    Look for dynamic imports and modifications of ``sys.path`` in the
+    expressions of a statement.
+    """
+    pending = [node]
+    while pending:
+      child = pending.pop()
+      if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                            ast.Lambda)):
+        # NOTE(josh): not executed at import time
+        continue
+      if isinstance(child, ast.Call):
+        func = child.func
+        if isinstance(func, ast.Name) and func.id in DYNAMIC_CALL_NAMES:
+          self.dynamic = True
+        elif (isinstance(func, ast.Attribute)
+              and func.attr in DYNAMIC_CALL_NAMES):
+          self.dynamic = True
+      elif (isinstance(child, ast.Attribute) and child.attr == "path"
+            and isinstance(child.value, ast.Name)
+            and child.value.id == "sys"):
+        self.dynamic = True
+      pending.extend(ast.iter_child_nodes(child))
+
+  def visit_body(self, body, optional, unless=()):
+    for node in body:
+      self.visit(node, optional, unless)
+
+  def visit(self, node, optional, unless):
+    # pylint: disable=too-many-branches
+    if isinstance(node, ast.Import):
+      self.visit_import(node, optional, unless)
+    elif isinstance(node, ast.ImportFrom):
+      self.visit_importfrom(node, optional, unless)
+    elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+      # NOTE(josh): the body isn't executed at import time, but the
+      # decorators and default values are
+      for child in node.decorator_list + node.args.defaults:
+        self.check_expression(child)
+    elif isinstance(node, ast.ClassDef):
+      for child in node.decorator_list + node.bases:
+        self.check_expression(child)
+      self.visit_body(node.body, optional, unless)
+    elif isinstance(node, ast.If):
+      self.check_expression(node.test)
+      value = evaluate_test(node.test)
+      if is_type_checking(node.test) or is_main_check(node.test):
+        value = False
+      if value is not False:
+        self.visit_body(node.body, optional, unless)
+      if value is not True:
+        self.visit_body(node.orelse, optional, unless)
+    elif isinstance(node, ast.Try) or (
+        hasattr(ast, "TryStar") and isinstance(node, ast.TryStar)):
+      guarded = any(handles_import_error(handler)
+                    for handler in node.handlers)
+      nattempted = len(self.attempted)
+      self.visit_body(node.body, optional or guarded, unless)
+      # NOTE(josh): the handlers are only executed if something in the body
+      # fails, and the only failure that we can predict is a failed import
+      attempted = tuple(self.attempted[nattempted:])
+      for handler in node.handlers:
+        self.visit_body(handler.body, True, unless + attempted)
+      self.visit_body(node.orelse, optional, unless)
+      self.visit_body(node.finalbody, optional, unless)
+    elif isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+      self.check_expression(getattr(node, "iter", None) or node.test)
+      self.visit_body(node.body, optional, unless)
+      self.visit_body(node.orelse, optional, unless)
+    elif isinstance(node, (ast.With, ast.AsyncWith)):
+      for item in node.items:
+        self.check_expression(item.context_expr)
+      self.visit_body(node.body, optional, unless)
+    elif hasattr(ast, "Match") and isinstance(node, ast.Match):
+      self.check_expression(node.subject)
+      for case in node.cases:
+        self.visit_body(case.body, optional, unless)
+    else:
+      self.check_expression(node)
+
+
+def parse_module(path, package):
+  """
+  Parse the python source file at path and return a `ParsedModule`, or None
+  if it can't be parsed. ``package`` is the package that relative imports are
+  relative to.
+  """
+  try:
+    with open(path, "rb") as infile:
+      tree = ast.parse(infile.read(), path)
+  except (IOError, OSError, SyntaxError, ValueError):
+    return None
+  collector = ImportCollector(package)
+  collector.visit_body(tree.body, False)
+  return ParsedModule(collector.edges, collector.dynamic, collector.relative)
+
+
+def get_baseline():
+  """
+  Return the module search path of a clean dependency mapping interpreter,
+  and the list of ``(name, filepath)`` of the modules that it has loaded
+  before it executes anything.
+  """
+  output = subprocess.check_output(
+      [sys.executable, "-Bm", "makelint.get_dependencies", "--baseline"],
+      stderr=subprocess.DEVNULL)
+  data = json.loads(output.decode("utf-8"))
+  return data["path"], [tuple(item) for item in data["modules"]]
+
+
+class ImportResolver(object):
+  """
+  Resolves module names to files and caches the import edges of each module.
+  The caches are shared by every file mapped with the same resolver, so each
+  module is located and parsed at most once.
+  """
+
+  def __init__(self, source_tree, search_path=None, baseline=None):
+    self.source_tree = os.path.realpath(source_tree)
+    if search_path is None or baseline is None:
+      search_path, baseline = get_baseline()
+    self.search_path = list(search_path)
+    if self.source_tree not in self.search_path:
+      self.search_path.append(self.source_tree)
+    self.baseline = list(baseline)
+    self.baseline_names = set(name for name, _ in self.baseline)
+
+    # Maps module name to it's ModuleInfo, or None if it can't be found
+    self.modules = {}
+
+    # Maps file path to it's ParsedModule, or None if it can't be parsed
+    self.parsed = {}
+
+  def find_module(self, name):
+    """
+    Return the `ModuleInfo` for the module with the given (absolute) name, or
+    None if it can't be found.
+    """
+    if name in self.modules:
+      return self.modules[name]
+
+    info = None
+    parent, _, _ = name.rpartition(".")
+    if parent:
+      parent_info = self.find_module(parent)
+      if parent_info is not None and parent_info.search_locations:
+        info = self.find_spec(name, parent_info.search_locations)
+    elif name in sys.builtin_module_names:
+      info = ModuleInfo(name, None, None)
+    else:
+      info = self.find_spec(name, self.search_path)
+    self.modules[name] = info
+    return info
+
+  @staticmethod
+  def find_spec(name, search_path):
+    spec = importlib.machinery.PathFinder.find_spec(name, search_path)
+    if spec is None:
+      return None
+    path = None
+    if spec.has_location and spec.origin:
+      path = os.path.realpath(spec.origin)
+    locations = spec.submodule_search_locations
+    if locations is not None:
+      locations = list(locations)
+    return ModuleInfo(name, path, locations)
+
+  def parse(self, info):
+    """
+    Return the `ParsedModule` for a module, or None if it is not a python
+    source file or it can't be parsed.
+    """
+    if info.path is None or not info.path.endswith(".py"):
+      return None
+    if info.path not in self.parsed:
+      package = info.name
+      if info.search_locations is None:
+        package = info.name.rpartition(".")[0]
+      self.parsed[info.path] = parse_module(info.path, package)
+    return self.parsed[info.path]
+
+  def can_import(self, name):
+    """
+    Return true if the module with the given name (and all of it's parents)
+    can be found.
+    """
+    return self.find_module(name) is not None
+
+  def is_in_tree(self, path):
+    return path is not None and path.startswith(self.source_tree + os.sep)
+
+  def get_closure(self, parsed):
+    """
+    Return a dictionary mapping the name of each module that is loaded when a
+    module with the given import edges is executed, to it's file path. Returns
+    None if the closure can't be determined statically.
+    """
+    closure = {}
+    queue = [(edge, True) for edge in parsed.edges]
+    while queue:
+      edge, strict = queue.pop()
+      if edge.unless and all(self.can_import(name) for name in edge.unless):
+        continue
+      parts = edge.name.split(".")
+      for idx in range(1, len(parts) + 1):
+        name = ".".join(parts[:idx])
+        if name in closure or name in self.baseline_names:
+          continue
+        info = self.find_module(name)
+        if info is None:
+          if strict and not edge.optional:
+            logger.debug("Can't resolve import of %s", edge.name)
+            return None
+          break
+        closure[name] = info.path
+        child = self.parse(info)
+        in_tree = self.is_in_tree(info.path)
+        if in_tree and info.path.endswith(".py"):
+          if child is None or child.dynamic:
+            logger.debug("Can't statically analyze %s", info.path)
+            return None
+        if child is not None:
+          queue.extend((child_edge, in_tree) for child_edge in child.edges)
+    return closure
+
+  def map(self, target_tree, module_relpath, digest_suffix):
+    """
+    Return the dependency map of the file at module_relpath (the content of
+    it's dependency map file, see `makelint.depmap`), or None if it can't be
+    determined statically.
+    """
+    # NOTE(josh): imported here because importing it from the package
+    # confuses ``python -m makelint.get_dependencies``
+    from makelint import get_dependencies
+
+    module_path = os.path.join(self.source_tree, module_relpath)
+    parsed = parse_module(module_path, None)
+    if parsed is None or parsed.dynamic or parsed.relative:
+      return None
+    closure = self.get_closure(parsed)
+    if closure is None:
+      return None
+
+    module_files = list(self.baseline)
+    for name, path in closure.items():
+      if path is not None and os.path.exists(path):
+        module_files.append((name, path))
+    module_files.sort()
+    outlist = get_dependencies.get_dependency_list(
+        self.source_tree, os.path.realpath(target_tree), module_relpath,
+        os.path.basename(module_relpath), digest_suffix, module_files)
+    outfile = io.BytesIO()
+    get_dependencies.dump_dependency_list(outlist, outfile)
+    return outfile.getvalue()
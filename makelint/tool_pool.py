@@ -0,0 +1,148 @@
+"""
+Pool of long-lived linter workers. Each worker is an interpreter running
+`makelint/lint_worker.py`, which imports the linter (pylint or flake8) once
+and then checks one file at a time, so that interpreter startup, importing the
+linter, and (for pylint) inferring the modules which are shared by many files
+is paid once per worker rather than once per file. Workers exit on their own
+after a number of files or once they grow past a memory ceiling, and are
+replaced on demand, which bounds any leaks in the linter.
+"""
+
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger()
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), "lint_worker.py")
+
+
+class WorkerUnavailable(Exception):
+  """
+  Raised when a worker can't load the linter.
+  """
+
+
+class LintWorker(object):
+  """
+  A single worker process.
+  """
+
+  def __init__(self, tool_name, source_tree, env, max_files, max_memory):
+    self.proc = subprocess.Popen(
+        [sys.executable, "-B", WORKER_SCRIPT, "--tool", tool_name,
+         "--max-files", str(max_files), "--max-memory", str(max_memory)],
+        cwd=source_tree, env=env, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    self.retired = False
+
+    line = self.proc.stdout.readline().decode("utf-8", "replace").strip()
+    if line != "ready":
+      self.close()
+      raise WorkerUnavailable(line or "worker exited")
+
+  def execute(self, source_relpath):
+    """
+    Check the given file and return ``(returncode, output)``. Raises
+    `IOError` if the worker has died.
+    """
+    request = {"source_relpath": source_relpath}
+    self.proc.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+    self.proc.stdin.flush()
+    line = self.proc.stdout.readline()
+    if not line:
+      raise IOError("Lint worker {} exited".format(self.proc.pid))
+    returncode, size, retire = (int(field) for field in line.split())
+    content = self.proc.stdout.read(size)
+    if len(content) != size:
+      raise IOError("Lint worker {} exited".format(self.proc.pid))
+    self.retired = bool(retire)
+    return returncode, content.decode("utf-8", "surrogateescape")
+
+  def close(self):
+    try:
+      self.proc.stdin.close()
+    except (IOError, OSError):
+      pass
+    self.proc.wait()
+
+
+class LintPool(object):
+  """
+  Up to ``njobs`` workers for one tool, started on demand. `execute()` may be
+  called concurrently from up to ``njobs`` threads.
+  """
+
+  def __init__(self, tool_name, source_tree, env, njobs, max_files,
+               max_memory):
+    self.tool_name = tool_name
+    self.source_tree = source_tree
+    self.env = env
+    self.njobs = max(njobs, 1)
+    self.max_files = max_files
+    self.max_memory = max_memory
+    self.idle = queue.Queue()
+    self.workers = []
+    self.lock = threading.Lock()
+
+  def new_worker(self):
+    return LintWorker(self.tool_name, self.source_tree, self.env,
+                      self.max_files, self.max_memory)
+
+  def start(self):
+    """
+    Start the first worker. Raises `WorkerUnavailable` if the linter can't be
+    loaded in-process.
+    """
+    worker = self.new_worker()
+    with self.lock:
+      self.workers.append(worker)
+    self.idle.put(worker)
+
+  def get_worker(self):
+    with self.lock:
+      if self.idle.empty() and len(self.workers) < self.njobs:
+        worker = self.new_worker()
+        self.workers.append(worker)
+        return worker
+    return self.idle.get()
+
+  def release(self, worker):
+    if not worker.retired:
+      self.idle.put(worker)
+      return
+    with self.lock:
+      self.workers.remove(worker)
+    worker.close()
+
+  def execute(self, source_relpath):
+    """
+    Check the given file and return ``(returncode, output)``, or None if it
+    could not be checked by a worker.
+    """
+    try:
+      worker = self.get_worker()
+    except WorkerUnavailable as ex:
+      logger.warning("Failed to start %s worker: %s", self.tool_name, ex)
+      return None
+
+    try:
+      result = worker.execute(source_relpath)
+    except (IOError, OSError, ValueError) as ex:
+      logger.warning("Lint worker failed: %s", ex)
+      worker.retired = True
+      self.release(worker)
+      return None
+    self.release(worker)
+    return result
+
+  def close(self):
+    with self.lock:
+      workers = self.workers
+      self.workers = []
+    for worker in workers:
+      worker.close()
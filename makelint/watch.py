@@ -0,0 +1,393 @@
+"""
+Watch mode: keep the manifest index in memory, receive change notifications
+from the kernel (Linux inotify), and re-run only the jobs that are affected
+by each change.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import shutil
+import struct
+import sys
+import time
+
+import makelint
+from makelint import depindex
+from makelint import depmap_pool
+from makelint import depmapper
+from makelint import fsmemo
+from makelint import latch
+from makelint import manifest
+from makelint import scheduler
+
+logger = logging.getLogger()
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Events which change the listing of a directory
+IN_LISTING_CHANGED = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_LISTING_CHANGED | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEAD = struct.Struct("iIII")
+
+# How long to wait for a burst of events (e.g. an editor writing a backup
+# file, then renaming it over the original) to finish, and the longest we
+# will delay processing while events keep arriving.
+DEBOUNCE_SECONDS = 0.05
+MAX_DELAY_SECONDS = 0.5
+
+
+class Inotify(object):
+  """
+  Thin wrapper around the inotify system calls.
+  """
+
+  def __init__(self):
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.file_descriptor = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.file_descriptor < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+
+  def fileno(self):
+    return self.file_descriptor
+
+  def add_watch(self, path, mask):
+    watch_descriptor = self.libc.inotify_add_watch(
+        self.file_descriptor, os.fsencode(path), ctypes.c_uint32(mask))
+    if watch_descriptor < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOSPC:
+        logger.error(
+            "Out of inotify watches, consider increasing "
+            "/proc/sys/fs/inotify/max_user_watches")
+      raise OSError(err, os.strerror(err), path)
+    return watch_descriptor
+
+  def rm_watch(self, watch_descriptor):
+    # NOTE(josh): the kernel removes the watch by itself when the directory
+    # is deleted, so failure here is not an error.
+    self.libc.inotify_rm_watch(self.file_descriptor, watch_descriptor)
+
+  def read_events(self):
+    """
+    Return a list of (watch_descriptor, mask, cookie, name) for all pending
+    events
+    """
+    events = []
+    while True:
+      try:
+        buf = os.read(self.file_descriptor, 64 * 1024)
+      except (IOError, OSError) as ex:
+        if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+      offset = 0
+      while offset < len(buf):
+        watch_descriptor, mask, cookie, size = EVENT_HEAD.unpack_from(
+            buf, offset)
+        offset += EVENT_HEAD.size
+        name = os.fsdecode(buf[offset:offset + size].rstrip(b"\0"))
+        offset += size
+        events.append((watch_descriptor, mask, cookie, name))
+    return events
+
+  def close(self):
+    os.close(self.file_descriptor)
+
+
+def is_under(relpath, relpath_dir):
+  """
+  Return true if relpath is relpath_dir, or is inside of it
+  """
+  if not relpath_dir:
+    return True
+  return relpath == relpath_dir or relpath.startswith(relpath_dir + os.sep)
+
+
+class Watcher(object):
+  """
+  Holds the in-memory state of the source tree between rounds of changes.
+  """
+
+  def __init__(self, cfg, merged_log):
+    self.cfg = cfg
+    self.merged_log = merged_log
+    self.path_filter = cfg.get_path_filter()
+    self.progress = makelint.NullProgressReport()
+    self.result_cache = cfg.get_result_cache()
+    self.remote_cache = cfg.get_remote_cache()
+    self.depmap_pool = None
+    if cfg.depmap_engine == "pool":
+      self.depmap_pool = depmap_pool.DependencyPool(
+          cfg.jobs, cfg.depmap_preload)
+    self.index = None
+    self.inotify = Inotify()
+    self.wd_map = {}
+    self.path_map = {}
+
+  def add_watch(self, relpath_cwd):
+    if relpath_cwd in self.path_map:
+      return
+    watch_descriptor = self.inotify.add_watch(
+        os.path.join(self.cfg.source_tree, relpath_cwd), WATCH_MASK)
+    self.wd_map[watch_descriptor] = relpath_cwd
+    self.path_map[relpath_cwd] = watch_descriptor
+
+  def rm_watch(self, relpath_cwd):
+    watch_descriptor = self.path_map.pop(relpath_cwd, None)
+    if watch_descriptor is not None:
+      self.wd_map.pop(watch_descriptor, None)
+      self.inotify.rm_watch(watch_descriptor)
+
+  def discover(self):
+    """
+    (Re-)index the whole source tree and make sure that every tracked
+    directory is watched.
+    """
+    cfg = self.cfg
+    self.index = makelint.discover_sourcetree(
+        cfg.source_tree, cfg.target_tree, self.path_filter, self.progress,
+        cfg.jobs, cfg.discovery)
+    tracked = set(record.relpath for record in self.index.records)
+    for relpath_cwd in list(self.path_map):
+      if relpath_cwd not in tracked:
+        self.rm_watch(relpath_cwd)
+    for relpath_cwd in sorted(tracked):
+      self.add_watch(relpath_cwd)
+
+  def get_tracked_files(self):
+    return set(os.path.join(relpath_cwd, filename)
+               for relpath_cwd, filename in self.index.iter_files())
+
+  def apply_events(self, events):
+    """
+    Update the manifest index for a batch of events. Return the set of
+    relpaths of files which were changed, created or deleted.
+    """
+    dirty_dirs = set()
+    touched_files = set()
+    for watch_descriptor, mask, _, name in events:
+      if mask & IN_Q_OVERFLOW:
+        logger.warning("inotify queue overflowed, rescanning everything")
+        before = self.get_tracked_files()
+        self.discover()
+        return before.union(self.get_tracked_files())
+
+      relpath_cwd = self.wd_map.get(watch_descriptor, None)
+      if relpath_cwd is None:
+        continue
+      if mask & IN_IGNORED:
+        self.wd_map.pop(watch_descriptor, None)
+        if self.path_map.get(relpath_cwd) == watch_descriptor:
+          self.path_map.pop(relpath_cwd)
+        continue
+      if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        # NOTE(josh): we'll get the corresponding event in the parent
+        continue
+
+      relpath = os.path.join(relpath_cwd, name)
+      if mask & IN_ISDIR:
+        if mask & IN_LISTING_CHANGED:
+          dirty_dirs.add(relpath_cwd)
+        continue
+
+      if mask & IN_LISTING_CHANGED:
+        record = self.index.get(relpath_cwd)
+        if ((record is not None and name in record.filenames)
+            or self.path_filter.includes_file(relpath)):
+          dirty_dirs.add(relpath_cwd)
+      touched_files.add(relpath)
+
+    if dirty_dirs:
+      touched_files.update(self.rescan(dirty_dirs))
+    return touched_files
+
+  def rescan(self, dirty_dirs):
+    """
+    Rescan the given directories, recursively indexing any new
+    subdirectories and purging any removed ones. Return the set of relpaths
+    of files that were added to or removed from the index.
+    """
+    cfg = self.cfg
+    records = dict((record.relpath, record) for record in self.index.records)
+    before = self.get_tracked_files()
+
+    for relpath_cwd in sorted(dirty_dirs, key=manifest.get_walk_key):
+      if relpath_cwd not in records:
+        # Purged along with one of its parents
+        continue
+      source_cwd = os.path.join(cfg.source_tree, relpath_cwd)
+      try:
+        mtime_ns = os.stat(source_cwd).st_mtime_ns
+        record, child_mtimes = makelint.scan_directory(
+            cfg.source_tree, relpath_cwd, mtime_ns, self.path_filter)
+      except (IOError, OSError):
+        # The directory itself is gone, the parent will handle it
+        continue
+
+      old_record = records[relpath_cwd]
+      records[relpath_cwd] = record
+      for dirname in set(old_record.dirnames).difference(record.dirnames):
+        relpath_dir = os.path.join(relpath_cwd, dirname)
+        for relpath in list(records):
+          if is_under(relpath, relpath_dir):
+            records.pop(relpath)
+            self.rm_watch(relpath)
+
+      for dirname in sorted(
+          set(record.dirnames).difference(old_record.dirnames)):
+        # NOTE(josh): add the watch before scanning so that we don't miss
+        # anything created in the new directory while we index it
+        stack = [(os.path.join(relpath_cwd, dirname),
+                  child_mtimes.get(dirname))]
+        while stack:
+          relpath_dir, mtime_ns = stack.pop()
+          try:
+            self.add_watch(relpath_dir)
+            subrecord, submtimes = makelint.visit_directory(
+                cfg.source_tree, cfg.target_tree, self.index, relpath_dir,
+                self.path_filter, mtime_ns)
+          except (IOError, OSError):
+            continue
+          records[relpath_dir] = subrecord
+          stack.extend((os.path.join(relpath_dir, name), submtimes.get(name))
+                       for name in subrecord.dirnames)
+
+    for relpath_cwd in self.index.replace(records.values()):
+      target_cwd = os.path.join(cfg.target_tree, relpath_cwd)
+      if relpath_cwd and os.path.isdir(target_cwd):
+        shutil.rmtree(target_cwd)
+    self.index.save()
+
+    return before.symmetric_difference(self.get_tracked_files())
+
+  def run_jobs(self, relpaths=None):
+    """
+    Run the digest, depmap and tool phases for the given files (or all files
+    if relpaths is None), plus all files which depend on them. Return the
+    combined exit status of the tools.
+    """
+    cfg = self.cfg
+    tracked = self.get_tracked_files()
+    if relpaths is None:
+      changed = tracked
+      affected = tracked
+    else:
+      changed = tracked.intersection(relpaths)
+      affected = set(changed)
+      affected.update(depindex.DependencyIndex.load(
+          cfg.target_tree).get_dependents(relpaths))
+      affected.intersection_update(tracked)
+
+    if not affected:
+      return 0
+
+    # NOTE(josh): a new memo for each round, since files may have changed
+    # since the last one
+    memo = fsmemo.FileMemo()
+    makelint.digest_sourcetree_content(
+        cfg.source_tree, cfg.target_tree, self.progress, cfg.jobs,
+        relpaths=changed, digest_algorithm=cfg.digest_algorithm, memo=memo)
+    depmapper.map_sourcetree_dependencies(
+        cfg, self.progress, relpaths=affected, pool=self.depmap_pool,
+        memo=memo)
+
+    retcode = scheduler.execute_tools_ontree(
+        cfg, self.progress, relpaths=affected, memo=memo,
+        merged_log=self.merged_log, result_cache=self.result_cache,
+        remote_cache=self.remote_cache)
+    if self.result_cache is not None:
+      self.result_cache.trim()
+    if self.merged_log:
+      self.merged_log.flush()
+
+    nfailed = 0
+    for relpath in affected:
+      relpath_cwd, filename = os.path.split(relpath)
+      target_cwd = os.path.join(cfg.target_tree, relpath_cwd)
+      for tool in cfg.tools:
+        try:
+          with open(tool.get_stamp(target_cwd, filename)) as infile:
+            if infile.read().strip() == "fail":
+              nfailed += 1
+              break
+        except (IOError, OSError):
+          pass
+
+    print("[{}] checked {} file(s), {} failed"
+          .format(time.strftime("%H:%M:%S"), len(affected), nfailed))
+    sys.stdout.flush()
+    return retcode
+
+  def wait_for_events(self):
+    """
+    Block until there is at least one event, then keep collecting events
+    until the source tree has been quiet for a moment.
+    """
+    select.select([self.inotify], [], [])
+    events = self.inotify.read_events()
+    deadline = time.time() + MAX_DELAY_SECONDS
+    while time.time() < deadline:
+      ready, _, _ = select.select([self.inotify], [], [], DEBOUNCE_SECONDS)
+      if not ready:
+        break
+      events.extend(self.inotify.read_events())
+    return events
+
+  def run(self):
+    """
+    Index and check the whole tree, then re-check incrementally on each
+    change until interrupted.
+    """
+    self.discover()
+    self.run_jobs()
+
+    while True:
+      events = self.wait_for_events()
+      touched_files = self.apply_events(events)
+      if "" not in self.path_map:
+        logger.error("%s is gone", self.cfg.source_tree)
+        return 1
+      if touched_files:
+        self.run_jobs(touched_files)
+
+
+def watch_sourcetree(cfg, merged_log):
+  """
+  Run in watch mode until interrupted.
+  """
+  makelint.check_digest_algorithm(cfg.target_tree, cfg.digest_algorithm)
+  makelint.check_depmap_format(cfg.target_tree)
+  latch.check_configuration(cfg)
+  watcher = Watcher(cfg, merged_log)
+  try:
+    return watcher.run()
+  except KeyboardInterrupt:
+    return 0
+  finally:
+    watcher.inotify.close()
+    if watcher.remote_cache is not None:
+      watcher.remote_cache.close()
+    if watcher.depmap_pool is not None:
+      watcher.depmap_pool.close()